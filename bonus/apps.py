@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BonusConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bonus'
+
+    def ready(self):
+        from .catalog import catalog
+        catalog.connect()
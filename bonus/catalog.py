@@ -0,0 +1,5 @@
+from bot.catalog import Catalog
+
+from .models import Category, Product
+
+catalog = Catalog(Category, Product)
@@ -0,0 +1,77 @@
+from collections import namedtuple
+
+from telegram._utils.defaultvalue import DefaultValue
+from telegram.ext import BaseUpdateProcessor
+from telegram.request import BaseRequest
+
+from bot.dispatch import OrderedDispatcher
+
+# Updates accepted at once, running or waiting behind an earlier update of their chat
+PENDING_PER_RUNNING = 4
+
+
+def update_key(update):
+    user = getattr(update, 'effective_user', None)
+    chat = getattr(update, 'effective_chat', None)
+    return user.id if user else chat.id if chat else None
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Update processor for Application.builder().concurrent_updates(): updates
+    of different users run concurrently, those of the same user in order.
+    """
+
+    def __init__(self, limit=None):
+        self.dispatcher = OrderedDispatcher(limit)
+        super().__init__(max_concurrent_updates=self.dispatcher.limit * PENDING_PER_RUNNING)
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            await coroutine
+        else:
+            await self.dispatcher.run(key, coroutine)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        await self.dispatcher.join()
+
+
+# What HTTPXRequest reads of a RequestData, which itself can not be pickled
+RelayedData = namedtuple('RelayedData', 'multipart_data json_parameters')
+
+
+class RelayedRequest(BaseRequest):
+    """
+    Bot API connection of a `runbot --workers` worker: each request is made
+    by the receiver, over its own connection (see bot.workers).
+    """
+
+    def __init__(self, link):
+        self.link = link
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        timeouts = {
+            'read_timeout': read_timeout,
+            'write_timeout': write_timeout,
+            'connect_timeout': connect_timeout,
+            'pool_timeout': pool_timeout,
+        }
+        return await self.link.call({
+            'url': url,
+            'method': method,
+            'request_data': request_data and RelayedData(request_data.multipart_data, request_data.json_parameters),
+            # Left to the receiver's defaults unless given
+            **{name: value for name, value in timeouts.items() if not isinstance(value, DefaultValue)},
+        })
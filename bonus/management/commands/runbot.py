@@ -1,37 +1,46 @@
 import asyncio
 import logging
+import time
 import uuid
 from datetime import datetime
-from io import BytesIO
 
-import qrcode
 from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from qrcode.image.pil import PilImage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from telegram import (
     InlineKeyboardButton, InlineKeyboardMarkup,
     Update, InputFile, ReplyKeyboardMarkup,
 )
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (
     CommandHandler, ContextTypes,
     CallbackQueryHandler, ConversationHandler,
-    MessageHandler, filters, Application,
+    MessageHandler, filters, Application, TypeHandler,
 )
 
-from bonus.models import TgUser, Order, Category, Product, OrderItem
+from bonus.catalog import catalog
+from bonus.dispatch import OrderedUpdateProcessor, RelayedRequest, update_key
+from bonus.models import TgUser, Order, OrderItem
+from bonus.reaper import stale_pending_orders
+from bot.keyboards import KeyboardCache
+from bot.outbox import Outbox
+from bot.qr import qr_codes
+from bot.reaper import reap_periodically
+from bot.workers import WorkerLink, WorkerPool
 
 
 class Command(BaseCommand):
     help = 'Rulează botul Telegram.'
     logger = logging.getLogger(__name__)
+    in_worker = False
 
     GET_ITEM = 1
     GET_QUANTITY = 2
     GET_MANUAL_QUANTITY = 3
     FINALIZE_ORDER = 4
 
-    PURCHASES_FOR_FREE_COFFEE = 5
+    PURCHASES_FOR_FREE_COFFEE = settings.LOYALTY_COFFEE_LIMIT
 
     keyboard_customer = [
         [
@@ -54,8 +63,124 @@ class Command(BaseCommand):
         else:
             return InlineKeyboardMarkup(self.keyboard_customer)
 
+    def add_arguments(self, parser):
+        parser.add_argument('--webhook', action='store_true',
+                            help='Primește actualizările prin webhook în loc de polling')
+        parser.add_argument('--listen', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=settings.TELEGRAM_WEBHOOK_PORT)
+        parser.add_argument('--workers', type=int, default=settings.BOT_WORKERS,
+                            help='Procese care rulează handler-ele (implicit: toate în acest proces)')
+
     def handle(self, *args, **options):
-        application = Application.builder().token(settings.TELEGRAM_BOT_TOKEN).build()
+        if options['workers']:
+            application = self.build_receiver(options['workers'])
+        else:
+            application = self.build_application()
+        if options['webhook']:
+            self.run_webhook(application, options['listen'], options['port'])
+        else:
+            application.run_polling()
+
+    def run_webhook(self, application, listen, port):
+        import uvicorn
+        from bonus.webhook import webhook_for
+
+        if not settings.TELEGRAM_WEBHOOK_SECRET:
+            raise CommandError("TELEGRAM_WEBHOOK_SECRET trebuie setat pentru modul webhook")
+
+        self.stdout.write(f"Webhook pe http://{listen}:{port}{settings.TELEGRAM_WEBHOOK_PATH}")
+        uvicorn.run(
+            webhook_for(application),
+            host=listen,
+            port=port,
+            lifespan='on',
+            limit_concurrency=settings.TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+        )
+
+    def build_receiver(self, workers):
+        """
+        The receiver of `--workers`: forwards every update to the worker of
+        its user and makes the requests of the workers (see bot.workers).
+        """
+        async def perform(request):
+            return await application.bot.request.do_request(**request)
+
+        pool = WorkerPool(f'{__name__}.Command', perform, workers)
+
+        async def start_workers(application):
+            await pool.start()
+
+            # Only here, not in every worker; each worker drops the reaped carts it holds
+            async def forget_orders(order_ids):
+                await pool.broadcast({'reaped_orders': order_ids})
+
+            application.create_task(reap_periodically(stale_pending_orders, forget_orders))
+
+        async def stop_workers(application):
+            await pool.stop()
+
+        application = (
+            Application.builder()
+            .token(settings.TELEGRAM_BOT_TOKEN)
+            # Shared by the requests of all the workers
+            .connection_pool_size(settings.BOT_CONCURRENT_UPDATES * workers)
+            .post_init(start_workers)
+            .post_stop(stop_workers)
+            .build()
+        )
+
+        async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            await pool.submit(update_key(update) or 0, update.to_dict())
+
+        application.add_handler(TypeHandler(Update, forward))
+        return application
+
+    def work(self, sock, workers):
+        self.in_worker = True
+
+        async def main():
+            link = WorkerLink(sock)
+            await link.open()
+            application = self.build_application(RelayedRequest(link), workers)
+            async with application:
+                await self.post_init(application)
+                await application.start()
+                async for data in link.updates():
+                    if 'reaped_orders' in data:
+                        self.forget_orders(application, data['reaped_orders'])
+                        continue
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+                await application.stop()
+                await self.post_stop(application)
+
+        asyncio.run(main())
+
+    def build_application(self, request=None, workers=1):
+        self.keyboards = KeyboardCache(
+            catalog,
+            lambda text, data: InlineKeyboardButton(text, callback_data=data),
+            InlineKeyboardMarkup,
+            footer=[("Înapoi la categorii", 'barista_menu'), ("Finalizați comanda", 'checkout')],
+        )
+        builder = (
+            Application.builder()
+            .token(settings.TELEGRAM_BOT_TOKEN)
+            .post_init(self.post_init)
+            .post_stop(self.post_stop)
+            .concurrent_updates(OrderedUpdateProcessor())
+        )
+        if request is not None:
+            # Worker of `--workers`: updates and requests go through the receiver
+            builder = builder.request(request).updater(None)
+        application = builder.build()
+
+        # Customer notifications go through the outbox, barista replies are sent directly
+        self.outbox = Outbox(
+            lambda chat_id, text: application.bot.send_message(chat_id=chat_id, text=text),
+            flood_wait=lambda error: error.retry_after if isinstance(error, RetryAfter) else None,
+            is_transient=lambda error: isinstance(error, NetworkError) and not isinstance(error, BadRequest),
+            rate=settings.OUTBOX_GLOBAL_RATE / workers,
+        )
 
         # Add handlers using chaining
         application.add_handler(ConversationHandler(
@@ -78,8 +203,43 @@ class Command(BaseCommand):
         application.add_handler(CallbackQueryHandler(self.menu_callback))
         application.add_handler(CallbackQueryHandler(self.handle_quantity_callback, pattern='^quantity_'))
         application.add_error_handler(self.error_handler)
+        return application
+
+    async def post_init(self, application: Application):
+        await self.warm_up(application)
+
+        async def forget_orders(order_ids):
+            self.forget_orders(application, order_ids)
 
-        asyncio.run(application.run_polling())
+        if not self.in_worker:
+            # Workers of `--workers` are sent the orders their receiver reaped
+            application.create_task(reap_periodically(stale_pending_orders, forget_orders))
+        self.outbox.start()
+
+    def forget_orders(self, application: Application, order_ids):
+        order_ids = set(order_ids)
+        for user_data in application.user_data.values():
+            order = user_data.get('current_order')
+            if order is not None and order.id in order_ids:
+                user_data.pop('current_order')
+
+    async def post_stop(self, application: Application):
+        await self.outbox.close(timeout=settings.OUTBOX_CLOSE_TIMEOUT)
+
+    async def warm_up(self, application: Application):
+        """
+        Loads before the first update the catalog, the barista list and the DB
+        connection. The bot identity is already resolved by Application.initialize().
+        Carts live in user_data, so none are left to load after a restart.
+        """
+        started = time.perf_counter()
+        self.barista_usernames = frozenset(settings.BARISTA_USERNAMES)
+        await sync_to_async(connection.ensure_connection)()
+        await sync_to_async(catalog.load)()
+        self.stdout.write(
+            f"Bot pregătit în {time.perf_counter() - started:.2f}s: @{application.bot.username}, "
+            f"{len(catalog.snapshot().products)} produse"
+        )
 
     async def menu_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
@@ -175,38 +335,25 @@ class Command(BaseCommand):
             return
 
         try:
-            # Extract category ID from callback data
-            category_id = int(data.split('_')[1])
-            category = await sync_to_async(Category.objects.get)(id=category_id)
-            products = await sync_to_async(list)(category.products.all())
+            # Callback data is category_<id> or category_<id>_<page>
+            parts = data.split('_')
+            category_id = int(parts[1])
+            page = await self.keyboards.category_page(category_id, int(parts[2]) if len(parts) > 2 else 0)
+            if page is None:
+                await query.edit_message_text(text="Categoria selectată nu există.")
+                return
 
-            if not products:
+            if not page.product_count:
                 await query.edit_message_text(text="Nu există produse în această categorie.")
                 return
 
-            # Create inline keyboard buttons for products
-            keyboard = [
-                [InlineKeyboardButton(f"{product.name} - {product.price} MDL", callback_data=f"product_{product.id}")]
-                for product in products
-            ]
-
-            # Add navigation buttons
-            keyboard.append([
-                InlineKeyboardButton("Înapoi la categorii", callback_data='barista_menu'),
-                InlineKeyboardButton("Finalizați comanda", callback_data='checkout'),
-            ])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            await query.edit_message_text(
-                text=f"Produse în categoria {category.name}:",
-                reply_markup=reply_markup
-            )
+            text = f"Produse în categoria {page.category.name}:"
+            if page.pages > 1:
+                text = f"Produse în categoria {page.category.name} (pagina {page.page + 1}/{page.pages}):"
+            await query.edit_message_text(text=text, reply_markup=page.markup)
 
         except (IndexError, ValueError):
             await query.edit_message_text(text="Identificator de categorie invalid.")
-        except Category.DoesNotExist:
-            await query.edit_message_text(text="Categoria selectată nu există.")
 
     async def handle_product_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user, data: str):
         query = update.callback_query
@@ -217,7 +364,11 @@ class Command(BaseCommand):
 
         try:
             product_id = int(data.split('_')[1])
-            product = await sync_to_async(Product.objects.get)(id=product_id)
+            snapshot = await catalog.asnapshot()
+            product = snapshot.products.get(product_id)
+            if product is None:
+                await query.edit_message_text(text="Produsul selectat nu există.")
+                return
             context.user_data['selected_product'] = product
 
             # Use InlineKeyboardMarkup for better button handling
@@ -239,8 +390,6 @@ class Command(BaseCommand):
 
         except (IndexError, ValueError):
             await query.edit_message_text(text="Identificator de produs invalid.")
-        except Product.DoesNotExist:
-            await query.edit_message_text(text="Produsul selectat nu există.")
 
     async def handle_quantity_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
@@ -354,14 +503,14 @@ class Command(BaseCommand):
             context.user_data['current_order'] = order
 
         # Add or update product in the order
-        existing_item = await sync_to_async(OrderItem.objects.filter(order=order, product=product).first)()
+        existing_item = await sync_to_async(OrderItem.objects.filter(order=order, product_id=product.id).first)()
         if existing_item:
             existing_item.quantity += quantity
             await sync_to_async(existing_item.save)()
         else:
             await sync_to_async(OrderItem.objects.create)(
                 order=order,
-                product=product,
+                product_id=product.id,
                 quantity=quantity
             )
 
@@ -426,7 +575,7 @@ class Command(BaseCommand):
             defaults={
                 'username': tg_user.username,
                 'first_name': tg_user.first_name,
-                'role': 'barista' if tg_user.username in settings.BARISTA_USERNAMES else 'customer',
+                'role': 'barista' if tg_user.username in self.barista_usernames else 'customer',
             }
         )
         return user
@@ -482,7 +631,7 @@ class Command(BaseCommand):
                         f"☕ Comanda dumneavoastră a fost servită!\n\nComanda:\n{order_summary}\n\n"
                         f"Mai aveți nevoie de {purchases_left} achiziție(i) pentru a primi o cafea gratuită."
                     )
-                    await context.bot.send_message(chat_id=customer.user_id, text=customer_message)
+                    self.outbox.notify(customer.user_id, customer_message)
 
                     # Notify the barista
                     await update.effective_chat.send_message(
@@ -517,33 +666,31 @@ class Command(BaseCommand):
         parameter = f"create_order_{customer_id}"
         deep_link = f"https://t.me/{bot_username}?start={parameter}"
 
-        # Generate the QR code asynchronously
-        qr_img = await asyncio.to_thread(self.generate_qr_code, deep_link)
-
-        buffer = BytesIO()
-        qr_img.save(buffer, format='PNG')
-        buffer.seek(0)
-
         caption = "Aici este codul dumneavoastră QR unic. Prezentați-l baristei când comandați."
 
         if edit_message:
             query = update.callback_query
-            await query.message.reply_photo(
-                photo=InputFile(buffer, filename='qr_code.png'),
-                caption=caption
-            )
-            await query.delete_message()
+            send_photo = query.message.reply_photo
         else:
-            await update.effective_chat.send_photo(
-                photo=InputFile(buffer, filename='qr_code.png'),
-                caption=caption
-            )
+            send_photo = update.effective_chat.send_photo
+
+        message = None
+        if user.qr_file_id:
+            try:
+                message = await send_photo(photo=user.qr_file_id, caption=caption)
+            except BadRequest:
+                # The file id belongs to another bot token: upload again
+                self.logger.warning("Stored QR file id of %s is no longer valid", user)
+
+        if message is None:
+            # Rendered once per user in a worker thread, then served from the cache
+            buffer = await qr_codes.get_file(bot_username, customer_id, deep_link)
+            message = await send_photo(photo=InputFile(buffer, filename='qr_code.png'), caption=caption)
+            user.qr_file_id = message.photo[-1].file_id
+            await sync_to_async(TgUser.objects.filter(pk=user.pk).update)(qr_file_id=user.qr_file_id)
 
-    def generate_qr_code(self, data):
-        qr = qrcode.QRCode(version=1, box_size=10, border=4)
-        qr.add_data(data)
-        qr.make(fit=True)
-        return qr.make_image(fill_color='black', back_color='white', image_factory=PilImage)
+        if edit_message:
+            await query.delete_message()
 
     async def info(self, update: Update, context: ContextTypes.DEFAULT_TYPE, edit_message=False):
         """
@@ -617,7 +764,7 @@ class Command(BaseCommand):
             f"☕ {item} dumneavoastră a fost servit(ă)! Mai aveți nevoie de {purchases_left} achiziție(i) "
             "pentru a primi o cafea gratuită."
         )
-        await context.bot.send_message(chat_id=customer.user_id, text=customer_message)
+        self.outbox.notify(customer.user_id, customer_message)
 
         await update.effective_chat.send_message(
             f"Comanda pentru @{customer.username} ({item}) a fost creată și confirmată."
@@ -662,14 +809,14 @@ class Command(BaseCommand):
             context.user_data['current_order'] = order
 
         # Add or update product in the order
-        existing_item = await sync_to_async(OrderItem.objects.filter(order=order, product=product).first)()
+        existing_item = await sync_to_async(OrderItem.objects.filter(order=order, product_id=product.id).first)()
         if existing_item:
             existing_item.quantity += quantity
             await sync_to_async(existing_item.save)()
         else:
             await sync_to_async(OrderItem.objects.create)(
                 order=order,
-                product=product,
+                product_id=product.id,
                 quantity=quantity
             )
 
@@ -817,24 +964,14 @@ class Command(BaseCommand):
         """
         query = update.callback_query
 
-        # Get all categories
-        categories = await sync_to_async(list)(Category.objects.all())
-
-        if not categories:
+        snapshot = await catalog.asnapshot()
+        if not snapshot.categories:
             await query.edit_message_text("Nu există categorii disponibile.")
             return
 
-        # Create inline keyboard buttons for categories
-        keyboard = [
-            [InlineKeyboardButton(category.name, callback_data=f"category_{category.id}")]
-            for category in categories
-        ]
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
         await query.edit_message_text(
             text="Selectați o categorie:",
-            reply_markup=reply_markup
+            reply_markup=await self.keyboards.categories()
         )
 
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
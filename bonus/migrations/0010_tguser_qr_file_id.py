@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-17 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bonus', '0009_alter_order_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tguser',
+            name='qr_file_id',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 
 class TgUser(models.Model):
@@ -11,6 +12,7 @@ class TgUser(models.Model):
     first_name = models.CharField(max_length=255, null=True, blank=True)
     purchase_count = models.IntegerField(default=0)
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default='customer')
+    qr_file_id = models.CharField(max_length=255, null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.username} ({self.role})" or str(self.user_id)
@@ -20,11 +22,13 @@ class Order(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
         ('confirmed', 'Confirmed'),
+        ('cancelled', 'Cancelled'),
     )
     user = models.ForeignKey(TgUser, on_delete=models.CASCADE, null=True, blank=True)
     item = models.CharField(max_length=255)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     date = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     session_name = models.CharField(max_length=255, unique=True, null=True, blank=True)
 
     def __str__(self):
@@ -40,6 +44,11 @@ class OrderItem(models.Model):
     def __str__(self):
         return f"{self.product.name} x {self.quantity}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # A cart being filled in is not abandoned, see bonus.reaper
+        Order.objects.filter(pk=self.order_id).update(updated_at=timezone.now())
+
 
 class Category(models.Model):
     name = models.CharField("Nume Categorie", max_length=255)
@@ -0,0 +1,10 @@
+from bot.reaper import pending_cutoff
+
+from .models import Order
+
+
+def stale_pending_orders(max_age):
+    """
+    Pending bonus bot orders left unchanged for more than `max_age` seconds.
+    """
+    return Order.objects.filter(status='pending', updated_at__lt=pending_cutoff(max_age))
@@ -1,3 +1,112 @@
-from django.test import TestCase
+import asyncio
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from django.test import SimpleTestCase, TestCase
+from telegram import InputFile, Update
+from telegram.error import BadRequest
+from telegram.ext import Application
+
+from bot.qr import qr_codes
+from .management.commands.runbot import Command
+from .models import TgUser
+from .webhook import TelegramWebhook
+
+SECRET = 'test-secret'
+
+# A /start message as delivered by Telegram
+RECORDED_UPDATE = {
+    'update_id': 100000001,
+    'message': {
+        'message_id': 42,
+        'date': 1729152000,
+        'chat': {'id': 5550001, 'type': 'private', 'first_name': 'Ana'},
+        'from': {'id': 5550001, 'is_bot': False, 'first_name': 'Ana', 'username': 'ana'},
+        'text': '/start',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    },
+}
+
+
+class TelegramWebhookTests(SimpleTestCase):
+    def setUp(self):
+        self.application = Application.builder().token('123456:TEST').build()
+        self.webhook = TelegramWebhook(self.application, secret_token=SECRET, path='/telegram/')
+
+    def post(self, path='/telegram/', json=RECORDED_UPDATE, secret=SECRET):
+        async def request():
+            transport = httpx.ASGITransport(app=self.webhook)
+            async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+                headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+                return await client.post(path, json=json, headers=headers)
+
+        return asyncio.run(request())
+
+    def test_recorded_update_is_queued(self):
+        response = self.post()
+
+        self.assertEqual(response.status_code, 200)
+        update = self.application.update_queue.get_nowait()
+        self.assertIsInstance(update, Update)
+        self.assertEqual(update.update_id, RECORDED_UPDATE['update_id'])
+        self.assertEqual(update.message.text, '/start')
+        self.assertEqual(update.effective_user.username, 'ana')
+
+    def test_wrong_or_missing_secret_is_refused(self):
+        self.assertEqual(self.post(secret='wrong').status_code, 403)
+        self.assertEqual(self.post(secret=None).status_code, 403)
+        self.assertTrue(self.application.update_queue.empty())
+
+    def test_invalid_body_is_rejected(self):
+        self.assertEqual(self.post(json=['not', 'an', 'update']).status_code, 400)
+        self.assertTrue(self.application.update_queue.empty())
+
+    def test_oversized_body_is_refused(self):
+        self.webhook.max_body_size = 100
+        self.assertEqual(self.post().status_code, 413)
+        self.assertTrue(self.application.update_queue.empty())
+
+    def test_other_paths_are_not_found(self):
+        self.assertEqual(self.post(path='/admin/').status_code, 404)
+
+
+class QRFileIdTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = TgUser.objects.create(user_id=5550001, username='ana', first_name='Ana', qr_file_id='stored-id')
+
+    def setUp(self):
+        patcher = mock.patch.object(qr_codes, 'get_file', mock.AsyncMock(side_effect=lambda *args: b'png'))
+        self.get_file = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def get_qr(self, reject=None):
+        sent = []
+
+        async def send_photo(photo, caption):
+            if reject and isinstance(photo, str):
+                raise reject
+            sent.append(photo)
+            return mock.Mock(photo=[mock.Mock(file_id='small-id'), mock.Mock(file_id='new-id')])
+
+        update = mock.Mock()
+        update.effective_user = mock.Mock(id=self.user.user_id, username='ana', first_name='Ana')
+        update.effective_chat.send_photo = send_photo
+        context = mock.Mock()
+        context.bot.username = 'zxcbot'
+        await Command().get_qr(update, context)
+        await self.user.arefresh_from_db()
+        return sent
+
+    async def test_a_stored_file_id_is_sent_without_uploading(self):
+        self.assertEqual(await self.get_qr(), ['stored-id'])
+        self.assertEqual(self.user.qr_file_id, 'stored-id')
+        self.get_file.assert_not_called()
+
+    async def test_a_rejected_file_id_is_uploaded_again_and_replaced(self):
+        with self.assertLogs(Command.logger, level='WARNING'):
+            sent = await self.get_qr(reject=BadRequest('Wrong file identifier/http url specified'))
+
+        self.assertEqual(len(sent), 1)
+        self.assertIsInstance(sent[0], InputFile)
+        self.assertEqual(self.user.qr_file_id, 'new-id')
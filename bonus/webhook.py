@@ -0,0 +1,154 @@
+"""
+Webhook endpoint of the bonus bot, as a small ASGI app in front of a
+python-telegram-bot Application.
+
+`runbot --webhook` serves it with uvicorn on a local port, behind the proxy
+that terminates TLS. With TELEGRAM_WEBHOOK_MOUNT it wraps zxc.asgi instead, and
+every other path goes to Django. Either way the ASGI lifespan starts and
+stops the Application, and registers the webhook if TELEGRAM_WEBHOOK_URL is set.
+
+Telegram sends the secret given to setWebhook in the
+X-Telegram-Bot-Api-Secret-Token header; requests without it are refused, and
+so are bodies over TELEGRAM_WEBHOOK_MAX_BODY_SIZE bytes.
+"""
+import hmac
+import json
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = b'x-telegram-bot-api-secret-token'
+
+
+class TelegramWebhook:
+    def __init__(self, application, secret_token, path='/telegram/', webhook_url=None, max_connections=40,
+                 fallback=None, max_body_size=1024 * 1024):
+        self.application = application
+        self.secret_token = secret_token
+        self.path = path
+        self.webhook_url = webhook_url
+        self.max_connections = max_connections
+        self.fallback = fallback
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['path'] == self.path:
+            await self.handle_update(scope, receive, send)
+        elif self.fallback is not None:
+            await self.fallback(scope, receive, send)
+        else:
+            await self.respond(send, 404)
+
+    async def start(self):
+        application = self.application
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if self.webhook_url:
+            await application.bot.set_webhook(
+                url=self.webhook_url,
+                secret_token=self.secret_token,
+                max_connections=self.max_connections,
+                allowed_updates=Update.ALL_TYPES,
+            )
+
+    async def stop(self):
+        application = self.application
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.start()
+                except Exception as e:
+                    logger.exception("Could not start the Telegram bot")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_update(self, scope, receive, send):
+        if scope['method'] != 'POST':
+            await self.respond(send, 405)
+            return
+
+        headers = dict(scope['headers'])
+        token = headers.get(SECRET_TOKEN_HEADER, b'').decode('latin-1')
+        if not self.secret_token or not hmac.compare_digest(token, self.secret_token):
+            logger.warning("Webhook request with a wrong secret token")
+            await self.respond(send, 403)
+            return
+
+        content_length = headers.get(b'content-length', b'0')
+        if content_length.isdigit() and int(content_length) > self.max_body_size:
+            await self.respond(send, 413)
+            return
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > self.max_body_size:
+                logger.warning("Webhook request over %d bytes", self.max_body_size)
+                await self.respond(send, 413)
+                return
+            if not message.get('more_body'):
+                break
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            logger.warning("Webhook request with an invalid update")
+            await self.respond(send, 400)
+            return
+
+        await self.application.update_queue.put(update)
+        await self.respond(send, 200)
+
+    @staticmethod
+    async def respond(send, status):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def webhook_for(application, fallback=None):
+    """
+    A TelegramWebhook for `application` configured from the TELEGRAM_WEBHOOK_* settings.
+    """
+    if not settings.TELEGRAM_WEBHOOK_SECRET:
+        raise ImproperlyConfigured("TELEGRAM_WEBHOOK_SECRET must be set to receive updates by webhook")
+    return TelegramWebhook(
+        application,
+        secret_token=settings.TELEGRAM_WEBHOOK_SECRET,
+        path=settings.TELEGRAM_WEBHOOK_PATH,
+        webhook_url=settings.TELEGRAM_WEBHOOK_URL,
+        max_connections=settings.TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+        fallback=fallback,
+        max_body_size=settings.TELEGRAM_WEBHOOK_MAX_BODY_SIZE,
+    )
+
+
+def mount(django_application):
+    """
+    Serves the bonus bot's webhook next to Django, for zxc.asgi. Use a single
+    worker: conversation state lives in the Application's memory.
+    """
+    from bonus.management.commands.runbot import Command
+    return webhook_for(Command().build_application(), fallback=django_application)
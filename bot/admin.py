@@ -1,16 +1,21 @@
 from datetime import timedelta
 
+from django import forms
 from django.contrib import admin
 from django.contrib.admin import SimpleListFilter
 from django.contrib.auth.models import User, Group
-from django.db.models import Sum, F, ExpressionWrapper, DecimalField, Q, IntegerField
+from django.db import transaction
+from django.db.models import Sum, F, DecimalField, Q, IntegerField
 from django.db.models.functions import Coalesce
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from pytz import timezone as pytz_timezone
 from unfold.admin import ModelAdmin, TabularInline
 
+from .broadcast import recipients
 from .filters import BaristaUserFilter
-from .models import Category, Product, Customer, Order, OrderItem, ProductSalesReport
+from .models import Broadcast, Category, Product, Customer, LoyaltyEntry, Order, OrderItem, ProductSalesReport
+from .utils import to_business_date
 
 admin.site.unregister(User)
 admin.site.unregister(Group)
@@ -19,7 +24,7 @@ admin.site.unregister(Group)
 class OrderItemInline(TabularInline):
     model = OrderItem
     extra = 0
-    readonly_fields = ('product',)
+    readonly_fields = ('product', 'unit_price')
 
 
 class ProductInline(TabularInline):
@@ -49,7 +54,7 @@ class OrderInline(TabularInline):
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         # Optimize query by prefetching related items and products
-        return qs.prefetch_related('items__product')
+        return qs.select_related('user_created').prefetch_related('items__product')
 
     def created_at_chisinau(self, obj):
         chisinau_tz = pytz_timezone('Europe/Chisinau')
@@ -59,13 +64,13 @@ class OrderInline(TabularInline):
     created_at_chisinau.short_description = 'Created At (Chisinau)'
 
     def products_list(self, obj):
-        products = obj.items.select_related('product')
-        product_names = [f'{item.quantity}-{item.product.name}' for item in products]
+        product_names = [f'{item.quantity}-{item.product.name}' for item in obj.items.all()]
         return ', '.join(product_names)
 
     products_list.short_description = 'Products'
 
     def order_total(self, obj):
+        # The stored totals, as the bot, /info and total_paid use them
         total, _ = obj.total_price()
         return '{:.2f}'.format(total)
 
@@ -80,7 +85,7 @@ class OrderInline(TabularInline):
 
 @admin.register(Order)
 class OrderAdmin(ModelAdmin):
-    list_filter = ('created_at', 'products__category', 'status', BaristaUserFilter, 'free_drinks',)
+    list_filter = ('business_date', 'products__category', 'status', BaristaUserFilter, 'free_drinks',)
     list_display = (
         'id',
         'products_list',
@@ -103,13 +108,13 @@ class OrderAdmin(ModelAdmin):
     created_at_chisinau.short_description = 'Created At'
 
     def products_list(self, obj):
-        products = obj.items.select_related('product')
-        product_names = [f'{item.quantity}-{item.product.name}' for item in products]
+        product_names = [f'{item.quantity}-{item.product.name}' for item in obj.items.all()]
         return ', '.join(product_names)
 
     products_list.short_description = 'Products'
 
     def order_total(self, obj):
+        # The stored totals, as the bot, /info and total_paid use them
         total, _ = obj.total_price()
         return '{:.2f}'.format(total)
 
@@ -121,12 +126,18 @@ class OrderAdmin(ModelAdmin):
     user_created.admin_order_field = 'user_created'
     user_created.short_description = 'User Created'
 
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        # Every column of the changelist is served from these joins, so a page
+        # costs the same number of queries whatever its size
+        return qs.select_related('customer', 'user_created').prefetch_related('items__product')
+
     def changelist_view(self, request, extra_context=None):
-        has_created_at_filter = any(param.startswith('created_at__gte') for param in request.GET)
+        has_business_date_filter = any(param.startswith('business_date__gte') for param in request.GET)
 
-        if not has_created_at_filter:
+        if not has_business_date_filter:
             q = request.GET.copy()
-            q['created_at__gte'] = timezone.now().date()
+            q['business_date__gte'] = to_business_date()
             request.GET = q
             request.META['QUERY_STRING'] = request.GET.urlencode()
         response = super().changelist_view(request, extra_context=extra_context)
@@ -150,17 +161,45 @@ class CategoryAdmin(ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(ModelAdmin):
-    list_display = ['name', 'category', 'price']
-    list_filter = ['category']
+    list_display = ['name', 'category', 'price', 'is_coffee']
+    list_filter = ['category', 'is_coffee']
     search_fields = ['name']
 
 
+class LoyaltyEntryInline(TabularInline):
+    model = LoyaltyEntry
+    fields = ('created_at', 'kind', 'order', 'coffees', 'free_drinks')
+    readonly_fields = fields
+    can_delete = False
+    extra = 0
+    ordering = ('-id',)
+    verbose_name_plural = 'Loyalty Ledger'
+
+    def has_add_permission(self, request, obj):
+        return False  # Entries are only appended by orders and balance edits
+
+
+class CustomerAdminForm(forms.ModelForm):
+    adjust_coffees = forms.IntegerField(
+        initial=0, required=False, help_text="Added to the coffees towards a free one, negative to take off",
+    )
+    adjust_free_drinks = forms.IntegerField(
+        initial=0, required=False, help_text="Added to the free coffees, negative to take off",
+    )
+
+    class Meta:
+        model = Customer
+        fields = '__all__'
+
+
 @admin.register(Customer)
 class CustomerAdmin(ModelAdmin):
+    form = CustomerAdminForm
     list_display = ['first_name', 'username', 'coffees_count', 'coffees_free', 'total_paid', 'total_quantity']
     search_fields = ['username', 'user_id']
     list_filter = ['role']
-    inlines = [OrderInline]
+    readonly_fields = ['coffees_count', 'coffees_free']
+    inlines = [OrderInline, LoyaltyEntryInline]
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
@@ -191,6 +230,53 @@ class CustomerAdmin(ModelAdmin):
     total_quantity.short_description = 'Total Quantity'
     total_quantity.admin_order_field = 'total_quantity_sum'
 
+    def save_model(self, request, obj, form, change):
+        # The balance is never written from the form: the adjustments entered are
+        # added to it through the ledger, on top of whatever it is by then
+        coffees = form.cleaned_data.get('adjust_coffees') or 0
+        free_drinks = form.cleaned_data.get('adjust_free_drinks') or 0
+        with transaction.atomic():
+            if change:
+                obj.save(update_fields=[
+                    name for name in form.changed_data if name not in ('adjust_coffees', 'adjust_free_drinks')
+                ])
+            else:
+                obj.save()
+            if coffees or free_drinks:
+                LoyaltyEntry.record(obj, LoyaltyEntry.ADJUSTED, coffees=coffees, free_drinks=free_drinks)
+
+
+@admin.register(Broadcast)
+class BroadcastAdmin(ModelAdmin):
+    list_display = ('id', 'short_text', 'status', 'sent', 'failed', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('status', 'progress', 'sent', 'failed', 'started_at', 'finished_at')
+    actions = ['queue_broadcasts']
+
+    def short_text(self, obj):
+        return obj.text[:60]
+
+    short_text.short_description = 'Text'
+
+    def progress(self, obj):
+        if obj.status == Broadcast.DONE:
+            return '100%'
+        total = recipients().count()
+        remaining = recipients().filter(pk__gt=obj.last_customer_id).count()
+        return f'{100 * (total - remaining) // total}%' if total else '-'
+
+    progress.short_description = 'Progress'
+
+    def has_change_permission(self, request, obj=None):
+        # The text cannot change once customers may have received it
+        return obj is None or obj.status == Broadcast.DRAFT
+
+    @admin.action(description='Queue for sending to all customers')
+    def queue_broadcasts(self, request, queryset):
+        # Sent by the send_broadcasts command, outside of the web process
+        queued = queryset.filter(status=Broadcast.DRAFT).update(status=Broadcast.QUEUED)
+        self.message_user(request, f'{queued} broadcast(s) queued, the send_broadcasts command will send them.')
+
 
 class DateRangeFilter(SimpleListFilter):
     title = 'Date Range'
@@ -214,6 +300,15 @@ class ProductSalesReportAdmin(admin.ModelAdmin):
     list_filter = ('category', DateRangeFilter,)
 
     def changelist_view(self, request, extra_context=None):
+        # A custom range (?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD) overrides the
+        # Date Range filter. The ChangeList rejects unknown parameters, so they
+        # are taken off the query string here and read back in get_queryset.
+        q = request.GET.copy()
+        request.sales_date_from = parse_date(q.pop('date_from', [''])[-1] or '')
+        request.sales_date_to = parse_date(q.pop('date_to', [''])[-1] or '')
+        request.GET = q
+        request.META['QUERY_STRING'] = request.GET.urlencode()
+
         response = super().changelist_view(request, extra_context)
         try:
             qs = response.context_data['cl'].queryset
@@ -227,32 +322,24 @@ class ProductSalesReportAdmin(admin.ModelAdmin):
         qs = super().get_queryset(request)
         date_range = request.GET.get('date_range')
 
-        if date_range == 'today':
-            today = timezone.now().date()
-            start_date = end_date = today
-        elif date_range == 'this_week':
-            today = timezone.now().date()
+        today = to_business_date()
+        if date_range == 'this_week':
             start_date = today - timedelta(days=today.weekday())
             end_date = today
         elif date_range == 'this_month':
-            today = timezone.now().date()
             start_date = today.replace(day=1)
             end_date = today
         else:
-            today = timezone.now().date()
             start_date = end_date = today
 
-        qs = qs.filter(orderitem__order__status='confirmed').annotate(
-            total_quantity_sold=Sum(
-                'orderitem__quantity',
-                filter=Q(orderitem__order__created_at__date__gte=start_date) & Q(
-                    orderitem__order__created_at__date__lte=end_date)
-            ),
-            total_sales=Sum(
-                ExpressionWrapper(F('orderitem__quantity') * F('price'), output_field=DecimalField()),
-                filter=Q(orderitem__order__created_at__date__gte=start_date) & Q(
-                    orderitem__order__created_at__date__lte=end_date)
-            )
+        start_date = getattr(request, 'sales_date_from', None) or start_date
+        end_date = getattr(request, 'sales_date_to', None) or end_date
+
+        # Served from the ProductDailySales rollup, so the cost depends on the
+        # number of days in the range rather than on the whole sales history
+        qs = qs.filter(daily_sales__business_date__range=(start_date, end_date)).annotate(
+            total_quantity_sold=Sum('daily_sales__quantity'),
+            total_sales=Sum('daily_sales__revenue'),
         )
 
         qs = qs.filter(total_quantity_sold__gt=0)
@@ -0,0 +1,175 @@
+"""
+Order and revenue series for the admin dashboard charts.
+
+Buckets are hours or days in the cafe's time zone and count confirmed orders
+by creation time. A settled bucket is computed once, with the other missing
+settled buckets of its series in a single grouped query, and kept in the
+cache. A bucket stays open, and is queried on every page load, for
+PENDING_ORDER_MAX_AGE after it ends, as a cart started in it may still be
+confirmed until then. Saving or deleting an order (a late confirmation, an
+admin cancellation, a total_paid edit) drops its cached buckets.
+"""
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Sum, DecimalField, Value
+from django.db.models.functions import Coalesce, TruncHour
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from .models import Order
+from .utils import business_timezone, to_business_date
+
+CHART_CACHE_PREFIX = 'orders_chart'
+CHART_CACHE_TIMEOUT = 60 * 60 * 24 * 40
+
+ORDERS_COLOR = 'rgba(75, 192, 192, 1)'
+REVENUE_COLOR = 'rgba(153, 102, 255, 1)'
+
+CHART_OPTIONS = {
+    'scales': {
+        'y': {'beginAtZero': True, 'position': 'left', 'ticks': {'stepSize': 1}},
+        'revenue': {'beginAtZero': True, 'position': 'right', 'grid': {'drawOnChartArea': False}},
+    },
+}
+
+
+def _grouped_stats(queryset, bucket):
+    return queryset.filter(status='confirmed').values(bucket).annotate(
+        order_count=Count('id'),
+        revenue=Coalesce(Sum('total_paid'), Value(0), output_field=DecimalField()),
+    ).order_by()
+
+
+def _cache_key(kind, bucket):
+    return f'{CHART_CACHE_PREFIX}:{kind}:{bucket.isoformat()}'
+
+
+def _hour_of(value, tz):
+    return timezone.localtime(value, tz).replace(minute=0, second=0, microsecond=0)
+
+
+def _open_since():
+    """
+    When the oldest bucket that may still change starts: a cart can be
+    confirmed up to PENDING_ORDER_MAX_AGE after it was started.
+    """
+    return timezone.now() - timedelta(seconds=settings.PENDING_ORDER_MAX_AGE)
+
+
+def _series(kind, buckets, open_buckets, load):
+    """
+    Returns {bucket: (order_count, revenue)} for `buckets`. `load(first, last)`
+    runs one grouped query over the buckets between `first` and `last`.
+    """
+    keys = {bucket: _cache_key(kind, bucket) for bucket in buckets}
+    settled = [bucket for bucket in buckets if bucket not in open_buckets]
+
+    cached = cache.get_many([keys[bucket] for bucket in settled])
+    values = {bucket: cached[keys[bucket]] for bucket in settled if keys[bucket] in cached}
+
+    missing = [bucket for bucket in settled if bucket not in values]
+    if missing:
+        loaded = load(min(missing), max(missing))
+        fresh = {bucket: loaded.get(bucket, (0, 0)) for bucket in missing}
+        cache.set_many({keys[bucket]: value for bucket, value in fresh.items()}, CHART_CACHE_TIMEOUT)
+        values.update(fresh)
+
+    current = [bucket for bucket in buckets if bucket in open_buckets]
+    if current:
+        loaded = load(min(current), max(current))
+        values.update({bucket: loaded.get(bucket, (0, 0)) for bucket in current})
+
+    return {bucket: values[bucket] for bucket in buckets}
+
+
+def hourly_series(day=None):
+    """
+    Orders and revenue per local hour of `day` (default: today), up to the current hour.
+    """
+    tz = business_timezone()
+    day = day or to_business_date()
+    current_hour = _hour_of(timezone.now(), tz)
+    open_since = _hour_of(_open_since(), tz)
+
+    hours = [datetime.combine(day, time(hour), tzinfo=tz) for hour in range(24)]
+    hours = [hour for hour in hours if hour <= current_hour]
+    open_hours = {hour for hour in hours if hour >= open_since}
+
+    def load(first, last):
+        orders = Order.objects.filter(
+            business_date=day, created_at__gte=first, created_at__lt=last + timedelta(hours=1),
+        ).annotate(hour=TruncHour('created_at', tzinfo=tz))
+        return {
+            timezone.localtime(row['hour'], tz): (row['order_count'], row['revenue'])
+            for row in _grouped_stats(orders, 'hour')
+        }
+
+    return _series('hour', hours, open_hours, load)
+
+
+def daily_series(days=7):
+    """
+    Orders and revenue per business day for the last `days` days, today included.
+    """
+    today = to_business_date()
+    dates = [today - timedelta(days=offset) for offset in range(days - 1, -1, -1)]
+    open_since = to_business_date(_open_since())
+    open_dates = {date for date in dates if date >= open_since}
+
+    def load(first, last):
+        orders = Order.objects.filter(business_date__range=(first, last))
+        return {
+            row['business_date']: (row['order_count'], row['revenue'])
+            for row in _grouped_stats(orders, 'business_date')
+        }
+
+    return _series('day', dates, open_dates, load)
+
+
+def _order_changed(instance, **kwargs):
+    keys = [
+        _cache_key('hour', _hour_of(instance.created_at, business_timezone())),
+        _cache_key('day', instance.business_date),
+    ]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def connect():
+    post_save.connect(_order_changed, sender=Order, dispatch_uid='orders_chart_save')
+    post_delete.connect(_order_changed, sender=Order, dispatch_uid='orders_chart_delete')
+
+
+def chart_data(series, label_format):
+    labels = [bucket.strftime(label_format) for bucket in series]
+    return {
+        'labels': labels,
+        'datasets': [
+            {
+                'label': 'Number of Orders',
+                'borderColor': ORDERS_COLOR,
+                'backgroundColor': 'rgba(75, 192, 192, 0.2)',
+                'borderWidth': 1,
+                'data': [order_count for order_count, _ in series.values()],
+                'yAxisID': 'y',
+            },
+            {
+                'label': 'Revenue (MDL)',
+                'borderColor': REVENUE_COLOR,
+                'backgroundColor': 'rgba(153, 102, 255, 0.2)',
+                'borderWidth': 1,
+                'data': [float(revenue) for _, revenue in series.values()],
+                'yAxisID': 'revenue',
+            },
+        ],
+    }
+
+
+def get_todays_orders_chart_data(request=None):
+    return chart_data(hourly_series(), '%H:%M')
+
+
+def get_daily_orders_chart_data(request=None, days=7):
+    return chart_data(daily_series(days), '%Y-%m-%d')
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class BotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bot'
+
+    def ready(self):
+        from . import admin_utils
+        from .catalog import catalog
+        from .customers import customers
+        admin_utils.connect()
+        catalog.connect()
+        customers.connect()
@@ -0,0 +1,137 @@
+"""
+Sending a Broadcast to every customer within Telegram's limits. Baristas
+are staff, not customers, and don't receive broadcasts.
+
+Customers are read from the database BROADCAST_CHUNK_SIZE at a time, after
+the broadcast's checkpoint, and each chunk is sent through a token bucket
+that lets out at most BROADCAST_RATE messages a second. Once a chunk is done
+the checkpoint and the sent/failed counts are saved, so after a crash a
+broadcast resumes with the next chunk; at most the unsaved chunk is sent twice.
+
+Like bot.outbox, the sender only needs a `send(chat_id, text)` coroutine and
+the library's flood and transient error checks, so it runs the same against
+a fake client in the tests.
+"""
+import asyncio
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Broadcast, Customer
+from .outbox import is_network_error
+
+logger = logging.getLogger(__name__)
+
+
+def recipients():
+    return Customer.objects.exclude(role=Customer.BARISTA)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            wait = max(self._updated - time.monotonic(), 0) + (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Lets nothing out for `seconds`, as Telegram asked on a flood error.
+        """
+        self._tokens = 0
+        self._updated = max(self._updated, time.monotonic() + seconds)
+
+
+class BroadcastSender:
+    def __init__(self, send, flood_wait=lambda error: None, is_transient=is_network_error,
+                 rate=None, chunk_size=None, max_retries=None, retry_delay=None):
+        self.send = send
+        self.flood_wait = flood_wait
+        self.is_transient = is_transient
+        self.rate = rate or settings.BROADCAST_RATE
+        self.chunk_size = chunk_size or settings.BROADCAST_CHUNK_SIZE
+        self.max_retries = max_retries if max_retries is not None else settings.OUTBOX_MAX_RETRIES
+        self.retry_delay = retry_delay if retry_delay is not None else settings.OUTBOX_RETRY_DELAY
+
+    @staticmethod
+    def _start(broadcast):
+        Broadcast.objects.filter(pk=broadcast.pk, started_at__isnull=True).update(started_at=timezone.now())
+        Broadcast.objects.filter(pk=broadcast.pk).update(status=Broadcast.SENDING)
+        broadcast.refresh_from_db()
+
+    def _next_chunk(self, after):
+        return list(
+            recipients().filter(pk__gt=after).order_by('pk').values_list('pk', 'user_id')[:self.chunk_size]
+        )
+
+    @staticmethod
+    def _checkpoint(broadcast, last_customer_id, sent, failed):
+        Broadcast.objects.filter(pk=broadcast.pk).update(
+            last_customer_id=last_customer_id,
+            sent=F('sent') + sent,
+            failed=F('failed') + failed,
+        )
+
+    @staticmethod
+    def _finish(broadcast):
+        Broadcast.objects.filter(pk=broadcast.pk).update(status=Broadcast.DONE, finished_at=timezone.now())
+        broadcast.refresh_from_db()
+
+    async def run(self, broadcast):
+        """
+        Sends `broadcast` to the customers after its checkpoint. Returns the
+        broadcast with its final counts.
+        """
+        await sync_to_async(self._start)(broadcast)
+        bucket = TokenBucket(self.rate)
+        last_customer_id = broadcast.last_customer_id
+        while True:
+            chunk = await sync_to_async(self._next_chunk)(last_customer_id)
+            if not chunk:
+                break
+            delivered = await asyncio.gather(*[
+                self._send_one(bucket, user_id, broadcast.text) for _, user_id in chunk
+            ])
+            last_customer_id = chunk[-1][0]
+            sent = sum(delivered)
+            await sync_to_async(self._checkpoint)(broadcast, last_customer_id, sent, len(chunk) - sent)
+        await sync_to_async(self._finish)(broadcast)
+        return broadcast
+
+    async def _send_one(self, bucket, chat_id, text):
+        attempts = 0
+        while True:
+            await bucket.acquire()
+            try:
+                await self.send(chat_id, text)
+                return True
+            except Exception as error:
+                wait = self.flood_wait(error)
+                if wait is not None:
+                    logger.warning("Flood control: broadcast paused for %ss", wait)
+                    bucket.pause(wait)
+                elif self.is_transient(error) and attempts < self.max_retries:
+                    await asyncio.sleep(self.retry_delay * 2 ** attempts)
+                    attempts += 1
+                else:
+                    logger.info("Broadcast not delivered to %s: %r", chat_id, error)
+                    return False
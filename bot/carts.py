@@ -0,0 +1,119 @@
+"""
+Cart operations of the Telegram bot, each run as a single unit of work: one
+thread-pool hop and one transaction per tap, returning a plain `Cart` the
+handler can render without touching the ORM again.
+
+Every operation has a sync version (usable from the shell and tests) and an
+async one prefixed with `a` for the bot handlers.
+"""
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .models import Customer, LoyaltyEntry, Order, loyalty_change
+
+CartLine = namedtuple('CartLine', ['name', 'price', 'quantity'])
+Cart = namedtuple('Cart', ['order_id', 'lines', 'total', 'used_free', 'coffee_count'])
+ConfirmedCart = namedtuple('ConfirmedCart', ['cart', 'customer_user_id', 'earned_free'])
+
+
+def _pending_order(order_id, lock=False):
+    if not order_id:
+        return None
+    orders = Order.objects.filter(pk=order_id, status='pending')
+    if lock:
+        orders = orders.select_for_update()
+    return orders.first()
+
+
+def _cart(order):
+    lines = [
+        CartLine(*line)
+        for line in order.items.order_by('id').values_list('product__name', 'unit_price', 'quantity')
+    ]
+    total, used_free = order.total_price()
+    return Cart(order.id, lines, total, used_free, order.coffee_count)
+
+
+def get_cart(order_id):
+    """
+    The pending order `order_id` as a Cart, or None if it was confirmed or removed.
+    """
+    order = _pending_order(order_id)
+    return _cart(order) if order else None
+
+
+@transaction.atomic
+def add_to_cart(order_id, product_id, quantity, barista_user_id):
+    """
+    Adds `quantity` of a product to the pending order `order_id`, starting a
+    new order for the barista if there is none.
+    """
+    order = _pending_order(order_id, lock=True)
+    if order is None:
+        barista = Customer.objects.filter(user_id=barista_user_id).first()
+        order = Order.objects.create(status='pending', user_created=barista)
+    order.add_item(product_id, quantity)
+    return _cart(order)
+
+
+@transaction.atomic
+def use_free_drinks(order_id, customer_id):
+    """
+    Applies all the free drinks of the customer to the pending order, starting
+    one if needed. Returns None when the customer has no free drinks.
+    """
+    customer = Customer.objects.filter(pk=customer_id, coffees_free__gt=0).first()
+    if customer is None:
+        return None
+
+    order = _pending_order(order_id, lock=True) or Order(status='pending')
+    order.customer = customer
+    order.free_drinks = customer.coffees_free
+    order.save()
+    return _cart(order)
+
+
+@transaction.atomic
+def confirm_cart(order_id, customer_id, coffee_limit=None):
+    """
+    Confirms the pending order and, if there is a customer, records the coffees
+    earned or redeemed in their loyalty ledger, all in one transaction.
+    Returns None if the order is no longer pending.
+    """
+    order = _pending_order(order_id, lock=True)
+    if order is None:
+        return None
+    coffee_limit = coffee_limit or settings.LOYALTY_COFFEE_LIMIT
+
+    # The row lock keeps the earned count right when two baristas serve the same customer
+    customer = Customer.objects.select_for_update().filter(pk=customer_id).first() if customer_id else None
+    earned_free = 0
+    if customer:
+        purchased_coffees = order.total_coffees()
+        coffee_free = abs(purchased_coffees - order.free_drinks) or 1 if order.free_drinks else 0
+        order.free_drinks = coffee_free
+        order.customer = customer
+
+    order.status = 'confirmed'
+    order.is_anonymous = not customer
+    order.save()
+    order.total_paid = order.total_price()[0]
+    order.save(update_fields=['total_paid'])
+
+    if customer:
+        coffees, free_drinks = loyalty_change(customer.coffees_count, purchased_coffees, coffee_free, coffee_limit)
+        if free_drinks < 0:
+            LoyaltyEntry.record(customer, LoyaltyEntry.REDEEMED, order=order, free_drinks=free_drinks)
+        elif coffees or free_drinks:
+            earned_free = free_drinks
+            LoyaltyEntry.record(customer, LoyaltyEntry.EARNED, order=order, coffees=coffees, free_drinks=free_drinks)
+    return ConfirmedCart(_cart(order), customer.user_id if customer else None, earned_free)
+
+
+aget_cart = sync_to_async(get_cart)
+aadd_to_cart = sync_to_async(add_to_cart)
+ause_free_drinks = sync_to_async(use_free_drinks)
+aconfirm_cart = sync_to_async(confirm_cart)
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+from types import MappingProxyType
+from typing import Mapping
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from .models import Category, Product
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CatalogProduct:
+    id: int
+    category_id: int
+    name: str
+    price: Decimal
+    is_coffee: bool
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class CatalogCategory:
+    id: int
+    name: str
+    product_ids: tuple
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """
+    Immutable view of the menu at a given version. Categories and products are
+    keyed by id and kept in id order, the same order the bots used to list them.
+    """
+    version: int
+    loaded_at: float
+    categories: Mapping[int, CatalogCategory]
+    products: Mapping[int, CatalogProduct]
+
+    def category_products(self, category_id):
+        category = self.categories.get(category_id)
+        if category is None:
+            return []
+        return [self.products[product_id] for product_id in category.product_ids]
+
+
+class Catalog:
+    """
+    Process-wide holder of the current CatalogSnapshot.
+
+    The snapshot is dropped whenever a category or product is saved or deleted
+    in this process and rebuilt on the next read. Edits made from another
+    process (the admin site) are picked up once the snapshot is older than
+    CATALOG_MAX_AGE seconds.
+    """
+
+    def __init__(self, category_model, product_model):
+        self.category_model = category_model
+        self.product_model = product_model
+        self._snapshot = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'CATALOG_MAX_AGE', 300)
+
+    def is_fresh(self):
+        snapshot = self._snapshot
+        return snapshot is not None and time.monotonic() - snapshot.loaded_at < self.max_age
+
+    def load(self):
+        categories = list(self.category_model.objects.order_by('id').values_list('id', 'name'))
+        products = list(
+            self.product_model.objects.order_by('id').values_list('id', 'category_id', 'name', 'price', 'is_coffee')
+        )
+
+        product_map = {}
+        product_ids = {category_id: [] for category_id, _ in categories}
+        for product_id, category_id, name, price, is_coffee in products:
+            product_map[product_id] = CatalogProduct(product_id, category_id, name, price, is_coffee)
+            product_ids.setdefault(category_id, []).append(product_id)
+
+        category_map = {
+            category_id: CatalogCategory(category_id, name, tuple(product_ids[category_id]))
+            for category_id, name in categories
+        }
+
+        with self._lock:
+            self._version += 1
+            self._snapshot = CatalogSnapshot(
+                version=self._version,
+                loaded_at=time.monotonic(),
+                categories=MappingProxyType(category_map),
+                products=MappingProxyType(product_map),
+            )
+        logger.info(
+            f"Catalog v{self._version} loaded: {len(category_map)} categories, {len(product_map)} products"
+        )
+        return self._snapshot
+
+    def snapshot(self):
+        if not self.is_fresh():
+            return self.load()
+        return self._snapshot
+
+    async def asnapshot(self):
+        if not self.is_fresh():
+            return await sync_to_async(self.load)()
+        return self._snapshot
+
+    def invalidate(self, **kwargs):
+        """Signal receiver: drop the snapshot so the next read rebuilds it."""
+        with self._lock:
+            self._snapshot = None
+
+    def connect(self):
+        for model in (self.category_model, self.product_model):
+            uid = f'catalog_{model._meta.label_lower}'
+            post_save.connect(self.invalidate, sender=model, weak=False, dispatch_uid=f'{uid}_save')
+            post_delete.connect(self.invalidate, sender=model, weak=False, dispatch_uid=f'{uid}_delete')
+
+
+catalog = Catalog(Category, Product)
@@ -0,0 +1,187 @@
+"""
+Read-through cache of the customers the Telegram bot talks to, keyed by
+Telegram user id, so role checks and QR scans do not hit the database on
+every update.
+
+An entry is dropped whenever the customer or their loyalty ledger changes in
+this process. Changes made elsewhere (the admin site, recompute_loyalty) are
+picked up once the entry is older than CUSTOMER_CACHE_TTL seconds.
+
+The ids of the baristas are kept apart, in a set that never expires, so their
+updates are always told apart from the customers' (see update_priority in
+run_telegram_bot). It follows role changes in this process and is reloaded
+every CUSTOMER_CACHE_TTL seconds for those made elsewhere.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from .models import Customer, LoyaltyEntry
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CachedCustomer:
+    id: int
+    user_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    role: str
+    coffees_count: int
+    coffees_free: int
+    qr_file_id: Optional[str]
+
+    FIELDS = ('id', 'user_id', 'username', 'first_name', 'role', 'coffees_count', 'coffees_free', 'qr_file_id')
+
+    def __str__(self):
+        return self.username or self.first_name or f"User {self.user_id}"
+
+    def is_barista(self):
+        return self.role == Customer.BARISTA
+
+    @classmethod
+    def from_customer(cls, customer):
+        return cls(**{field: getattr(customer, field) for field in cls.FIELDS})
+
+
+class CustomerCache:
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else settings.CUSTOMER_CACHE_TTL
+        self.max_entries = max_entries if max_entries is not None else settings.CUSTOMER_CACHE_MAX_ENTRIES
+        self._customers = OrderedDict()
+        self._barista_ids = frozenset()
+        self._lock = threading.Lock()  # signals arrive from the ORM thread
+
+    def _cached(self, user_id):
+        with self._lock:
+            entry = self._customers.get(user_id)
+            if entry is None:
+                return None
+            loaded_at, customer = entry
+            if time.monotonic() - loaded_at >= self.ttl:
+                del self._customers[user_id]
+                return None
+            self._customers.move_to_end(user_id)
+            return customer
+
+    def _remember(self, customer):
+        with self._lock:
+            self._customers[customer.user_id] = (time.monotonic(), customer)
+            self._customers.move_to_end(customer.user_id)
+            while len(self._customers) > self.max_entries:
+                self._customers.popitem(last=False)
+        return customer
+
+    def _load(self, user_id):
+        row = Customer.objects.filter(user_id=user_id).values(*CachedCustomer.FIELDS).first()
+        return self._remember(CachedCustomer(**row)) if row else None
+
+    def _get_or_create(self, user_id, defaults):
+        customer, created = Customer.objects.get_or_create(user_id=user_id, defaults=defaults)
+        return self._remember(CachedCustomer.from_customer(customer)), created
+
+    async def get(self, user_id):
+        """
+        The customer with Telegram id `user_id`, or None if there is none.
+        """
+        customer = self._cached(user_id)
+        if customer is None:
+            customer = await sync_to_async(self._load)(user_id)
+        return customer
+
+    async def get_or_create(self, user_id, defaults):
+        """
+        Like Customer.objects.get_or_create(), returns (customer, created).
+        """
+        customer = self._cached(user_id)
+        if customer is not None:
+            return customer, False
+        return await sync_to_async(self._get_or_create)(user_id, defaults)
+
+    def peek(self, user_id):
+        """
+        The cached customer with Telegram id `user_id`, never going to the database.
+        """
+        return self._cached(user_id)
+
+    def _preload(self, filters):
+        rows = Customer.objects.filter(**filters).values(*CachedCustomer.FIELDS)
+        return len([self._remember(CachedCustomer(**row)) for row in rows])
+
+    async def preload(self, **filters):
+        """
+        Caches the customers matching `filters`. Returns how many were loaded.
+        """
+        return await sync_to_async(self._preload)(filters)
+
+    def is_barista(self, user_id):
+        """
+        Whether `user_id` is a barista, never going to the database.
+        """
+        return user_id in self._barista_ids
+
+    def _load_baristas(self):
+        self._barista_ids = frozenset(Customer.objects.filter(role=Customer.BARISTA).values_list('user_id', flat=True))
+        return len(self._barista_ids)
+
+    async def load_baristas(self):
+        """
+        Loads the barista ids. Returns how many there are.
+        """
+        return await sync_to_async(self._load_baristas)()
+
+    async def reload_baristas_periodically(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.load_baristas()
+            except Exception:
+                logger.exception("Reloading the baristas failed")
+
+    def _set_barista(self, user_id, is_barista):
+        with self._lock:
+            if is_barista:
+                self._barista_ids = self._barista_ids | {user_id}
+            else:
+                self._barista_ids = self._barista_ids - {user_id}
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._customers.pop(user_id, None)
+
+    def _invalidate_on_commit(self, user_id):
+        # Before the commit, a concurrent read would cache the old row again
+        transaction.on_commit(lambda: self.invalidate(user_id))
+
+    def _customer_changed(self, instance, **kwargs):
+        self._invalidate_on_commit(instance.user_id)
+
+    def _customer_saved(self, instance, **kwargs):
+        self._customer_changed(instance)
+        is_barista = instance.role == Customer.BARISTA
+        transaction.on_commit(lambda: self._set_barista(instance.user_id, is_barista))
+
+    def _customer_deleted(self, instance, **kwargs):
+        self._customer_changed(instance)
+        transaction.on_commit(lambda: self._set_barista(instance.user_id, False))
+
+    def _ledger_changed(self, instance, **kwargs):
+        self._invalidate_on_commit(instance.customer.user_id)
+
+    def connect(self):
+        post_save.connect(self._customer_saved, sender=Customer, weak=False, dispatch_uid='customer_cache_save')
+        post_delete.connect(self._customer_deleted, sender=Customer, weak=False, dispatch_uid='customer_cache_delete')
+        post_save.connect(self._ledger_changed, sender=LoyaltyEntry, weak=False, dispatch_uid='customer_cache_ledger')
+
+
+customers = CustomerCache()
@@ -0,0 +1,201 @@
+"""
+Ordered, prioritised dispatch of bot updates.
+
+Updates of different users are handled concurrently, at most
+BOT_CONCURRENT_UPDATES at a time, so a slow report or QR render of one user
+does not hold up the others. Updates of the same user run strictly one after
+the other, in arrival order, so handlers can read-modify-write that user's
+session and cart without racing.
+
+When every slot is busy, the next free one goes to the waiting update with the
+best priority: baristas working on orders before customers asking for their
+QR code or balance. Once more than BOT_SHED_THRESHOLD updates are waiting,
+new low priority updates are turned away (the bot answers "busy, try again"),
+and past BOT_MAX_PENDING_UPDATES every new update is.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = {HIGH: 'high', NORMAL: 'normal', LOW: 'low'}
+
+
+class PriorityStats:
+    def __init__(self):
+        self.pending = 0
+        self.started = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def average_wait(self):
+        return self.total_wait / self.started if self.started else 0.0
+
+    def as_dict(self):
+        return {
+            'pending': self.pending,
+            'started': self.started,
+            'shed': self.shed,
+            'average_wait': self.average_wait,
+            'max_wait': self.max_wait,
+        }
+
+
+def copy_event(event):
+    """
+    A shallow copy of a Telethon event. Its attributes are copied directly:
+    NewMessage events forward unknown attributes to their message.
+    """
+    copied = object.__new__(type(event))
+    copied.__dict__.update(event.__dict__)
+    return copied
+
+
+class OrderedDispatcher:
+    def __init__(self, limit=None, max_pending=None, shed_threshold=None):
+        self.limit = limit or settings.BOT_CONCURRENT_UPDATES
+        self.max_pending = max_pending or settings.BOT_MAX_PENDING_UPDATES
+        self.shed_threshold = shed_threshold or settings.BOT_SHED_THRESHOLD
+        self._running = 0
+        self._waiters = []  # heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+        self._queues = {}
+        self._tasks = set()
+        self._stats = {priority: PriorityStats() for priority in PRIORITY_NAMES}
+
+    # Slots: a freed slot is handed straight to the best waiting job
+
+    async def _acquire(self, priority):
+        if self._running < self.limit and not self._waiters:
+            self._running += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._running -= 1
+
+    # Queues
+
+    @property
+    def pending(self):
+        return sum(stats.pending for stats in self._stats.values())
+
+    def accepts(self, priority):
+        pending = self.pending
+        if pending >= self.max_pending:
+            return False
+        return priority < LOW or pending < self.shed_threshold
+
+    def submit(self, key, handler, *args, priority=NORMAL):
+        """
+        Schedules `handler(*args)` after the jobs already submitted for `key`.
+        Returns False, without scheduling it, if the job is shed.
+        """
+        stats = self._stats[priority]
+        if not self.accepts(priority):
+            stats.shed += 1
+            return False
+
+        stats.pending += 1
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            task = asyncio.ensure_future(self._drain(key, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append((handler, args, priority, time.monotonic()))
+        return True
+
+    async def _drain(self, key, queue):
+        try:
+            while queue:
+                handler, args, priority, submitted_at = queue.popleft()
+                await self._acquire(priority)
+
+                stats = self._stats[priority]
+                wait = time.monotonic() - submitted_at
+                stats.pending -= 1
+                stats.started += 1
+                stats.total_wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+                try:
+                    await handler(*args)
+                except Exception:
+                    logger.exception("Unhandled exception in %s", getattr(handler, '__name__', handler))
+                finally:
+                    self._release()
+        finally:
+            del self._queues[key]
+
+    async def run(self, key, awaitable, priority=NORMAL):
+        """
+        Awaits `awaitable` in its turn for `key` and returns its result, or
+        None if it was shed.
+        """
+        done = asyncio.get_running_loop().create_future()
+
+        async def job():
+            try:
+                done.set_result(await awaitable)
+            except Exception as e:
+                done.set_exception(e)
+
+        if not self.submit(key, job, priority=priority):
+            awaitable.close()
+            return None
+        return await done
+
+    def handler(self, handler, key=lambda event: event.sender_id, priority=lambda event: NORMAL, on_shed=None):
+        """
+        Wraps an event handler so that it only queues the event and returns.
+        `priority(event)` picks the event's priority class; `on_shed(event)` is
+        run, once per event, when the event is turned away.
+        """
+        async def dispatch(event):
+            if getattr(event, '_dispatch_shed', False):
+                return  # already turned away for an earlier handler
+            # Telethon passes the same event to every matching builder, and each
+            # builder overwrites its pattern_match/data_match before this handler runs
+            if not self.submit(key(event), handler, copy_event(event), priority=priority(event)):
+                event._dispatch_shed = True
+                if on_shed is not None:
+                    task = asyncio.ensure_future(on_shed(event))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+
+        dispatch.__name__ = handler.__name__
+        return dispatch
+
+    def stats(self):
+        return {
+            'running': self._running,
+            'pending': self.pending,
+            'priorities': {name: self._stats[priority].as_dict() for priority, name in PRIORITY_NAMES.items()},
+        }
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
@@ -0,0 +1,93 @@
+"""
+Inline keyboards of the catalog, built once per catalog snapshot and reused
+for every tap until a category or product changes.
+
+Products are paged, KEYBOARD_PAGE_SIZE per page, with previous/next buttons
+carrying `category_<id>_<page>` callback data. The same cache serves both bots:
+they pass their library's button and markup constructors.
+"""
+import math
+import threading
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .catalog import CatalogCategory
+
+
+@dataclass(frozen=True)
+class CategoryPage:
+    category: CatalogCategory
+    markup: object
+    page: int
+    pages: int
+    product_count: int
+
+
+class KeyboardCache:
+    def __init__(self, catalog, button, markup, footer=(), page_size=None):
+        """
+        `button(text, data)` makes a callback button and `markup(rows)` a
+        keyboard out of rows of buttons. `footer` is a row of (text, data)
+        pairs added under every product page.
+        """
+        self.catalog = catalog
+        self.button = button
+        self.markup = markup
+        self.footer = footer
+        self.page_size = page_size or settings.KEYBOARD_PAGE_SIZE
+        self._version = None
+        self._categories = None
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def _build(self, snapshot):
+        categories = self.markup([
+            [self.button(category.name, f"category_{category.id}")] for category in snapshot.categories.values()
+        ])
+
+        pages = {}
+        for category in snapshot.categories.values():
+            products = snapshot.category_products(category.id)
+            page_count = max(math.ceil(len(products) / self.page_size), 1)
+            for page in range(page_count):
+                start = page * self.page_size
+                rows = [
+                    [self.button(f"{product.name} - {product.price} MDL", f"product_{product.id}")]
+                    for product in products[start:start + self.page_size]
+                ]
+                navigation = []
+                if page > 0:
+                    navigation.append(self.button("⬅️ Înapoi", f"category_{category.id}_{page - 1}"))
+                if page < page_count - 1:
+                    navigation.append(self.button("Înainte ➡️", f"category_{category.id}_{page + 1}"))
+                if navigation:
+                    rows.append(navigation)
+                if self.footer:
+                    rows.append([self.button(text, data) for text, data in self.footer])
+                pages[category.id, page] = CategoryPage(category, self.markup(rows), page, page_count, len(products))
+        return categories, pages
+
+    def _current(self, snapshot):
+        with self._lock:
+            if self._version != snapshot.version:
+                self._categories, self._pages = self._build(snapshot)
+                self._version = snapshot.version
+            return self._categories, self._pages
+
+    async def categories(self):
+        snapshot = await self.catalog.asnapshot()
+        categories, _ = self._current(snapshot)
+        return categories
+
+    async def category_page(self, category_id, page=0):
+        """
+        The CategoryPage of `category_id`, clamped to its last page, or None
+        if there is no such category.
+        """
+        snapshot = await self.catalog.asnapshot()
+        if category_id not in snapshot.categories:
+            return None
+        _, pages = self._current(snapshot)
+        last_page = pages[category_id, 0].pages - 1
+        return pages[category_id, min(max(page, 0), last_page)]
@@ -0,0 +1,33 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from bot.reaper import reap_orders, stale_pending_orders
+
+
+class Command(BaseCommand):
+    help = (
+        'Șterge (sau anulează) comenzile ambilor boți neschimbate de mai mult de '
+        'PENDING_ORDER_MAX_AGE și rămase în așteptare'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=settings.PENDING_ORDER_MAX_AGE,
+                            help='Timpul minim de la ultima modificare a comenzii, în secunde')
+        parser.add_argument('--batch-size', type=int, default=settings.PENDING_ORDER_REAP_BATCH_SIZE)
+        parser.add_argument('--cancel', action='store_true', default=settings.PENDING_ORDER_REAP_ACTION == 'cancel',
+                            help='Marchează comenzile ca anulate în loc să le șteargă')
+
+    def handle(self, *args, **options):
+        stale_orders = [stale_pending_orders]
+        if apps.is_installed('bonus'):
+            from bonus.reaper import stale_pending_orders as stale_bonus_orders
+            stale_orders.append(stale_bonus_orders)
+
+        action = 'anulate' if options['cancel'] else 'șterse'
+        for stale in stale_orders:
+            queryset = stale(options['max_age'])
+            order_ids = reap_orders(queryset, batch_size=options['batch_size'], cancel=options['cancel'])
+            self.stdout.write(self.style.SUCCESS(
+                f"{queryset.model._meta.label}: {len(order_ids)} comenzi abandonate au fost {action}"
+            ))
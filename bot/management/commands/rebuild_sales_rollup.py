@@ -0,0 +1,49 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, F, ExpressionWrapper, DecimalField
+
+from bot.models import OrderItem, ProductDailySales
+
+
+class Command(BaseCommand):
+    help = 'Reconstruiește vânzările zilnice pe produse din comenzile confirmate'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help='YYYY-MM-DD, inclusiv')
+        parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help='YYYY-MM-DD, inclusiv')
+
+    def handle(self, *args, **options):
+        date_from = options['date_from']
+        date_to = options['date_to']
+
+        items = OrderItem.objects.filter(order__status='confirmed')
+        rollup = ProductDailySales.objects.all()
+        if date_from:
+            items = items.filter(order__business_date__gte=date_from)
+            rollup = rollup.filter(business_date__gte=date_from)
+        if date_to:
+            items = items.filter(order__business_date__lte=date_to)
+            rollup = rollup.filter(business_date__lte=date_to)
+
+        rows = items.values('product_id', 'order__business_date').annotate(
+            total_quantity=Sum('quantity'),
+            total_revenue=Sum(ExpressionWrapper(F('quantity') * F('unit_price'), output_field=DecimalField())),
+        ).order_by()
+
+        sales = [
+            ProductDailySales(
+                product_id=row['product_id'],
+                business_date=row['order__business_date'],
+                quantity=row['total_quantity'],
+                revenue=row['total_revenue'],
+            )
+            for row in rows
+        ]
+
+        with transaction.atomic():
+            rollup.delete()
+            ProductDailySales.objects.bulk_create(sales, batch_size=1000)
+
+        self.stdout.write(self.style.SUCCESS(f"{len(sales)} rânduri de vânzări zilnice reconstruite"))
@@ -0,0 +1,112 @@
+import heapq
+from itertools import groupby
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import CharField, Value
+
+from bot.models import Customer, LoyaltyEntry, Order, loyalty_change
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalculează soldul de fidelitate (cafele acumulate și gratuite) al clienților din istoricul comenzilor '
+        'confirmate: regula este aplicată din nou tuturor comenzilor, inclusiv celor de dinainte de registru, '
+        'în locul soldului inițial, iar ajustările manuale din registru sunt păstrate.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--coffee-limit', type=int, default=settings.LOYALTY_COFFEE_LIMIT)
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Clienți blocați odată; confirmarea comenzilor lor așteaptă lotul')
+        parser.add_argument('--keep-opening-balances', action='store_true',
+                            help='Pornește de la soldul inițial în loc de comenzile de dinainte de registru '
+                                 '(care păstrează și modificările manuale de atunci)')
+        parser.add_argument('--dry-run', action='store_true', help='Afișează diferențele fără a le salva')
+
+    def handle(self, *args, **options):
+        self.coffee_limit = options['coffee_limit']
+        self.chunk_size = options['chunk_size']
+        self.keep_opening_balances = options['keep_opening_balances']
+        dry_run = options['dry_run']
+
+        checked = changed = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                customers = Customer.objects.filter(pk__gt=last_id).order_by('pk')
+                if not dry_run:
+                    # Orders are confirmed under this same lock (see bot.carts), so
+                    # none can slip in between the replay and the correction
+                    customers = customers.select_for_update()
+                customers = list(customers.values_list('pk', 'coffees_count', 'coffees_free')[:options['batch_size']])
+                if not customers:
+                    break
+                last_id = customers[-1][0]
+
+                balances = self.replay(customers[0][0], last_id)
+                corrections = []
+                for customer_id, coffees_count, coffees_free in customers:
+                    count, free = balances.get(customer_id, (0, 0))
+                    if (count, free) == (coffees_count, coffees_free):
+                        continue
+                    if dry_run:
+                        self.stdout.write(f"Client {customer_id}: cafele {coffees_count} -> {count}, "
+                                          f"gratuite {coffees_free} -> {free}")
+                    corrections.append((Customer(pk=customer_id, coffees_count=count, coffees_free=free),
+                                        count - coffees_count, free - coffees_free))
+                if corrections and not dry_run:
+                    self.save_batch(corrections)
+            checked += len(customers)
+            changed += len(corrections)
+
+        verb = 'ar fi actualizați' if dry_run else 'actualizați'
+        self.stdout.write(self.style.SUCCESS(f"{changed} din {checked} clienți {verb}"))
+
+    def replay(self, first_id, last_id):
+        """
+        {customer_id: (coffees_count, coffees_free)} of the customers in
+        [first_id, last_id]: their confirmed orders from before the ledger,
+        then their ledger in the order it was written.
+        """
+        skipped = [LoyaltyEntry.RECOMPUTED]  # corrections of earlier runs, made again below
+        if not self.keep_opening_balances:
+            skipped.append(LoyaltyEntry.OPENING)
+        entries = LoyaltyEntry.objects.filter(customer__pk__range=(first_id, last_id)).exclude(
+            kind__in=skipped,
+        ).order_by('customer_id', 'created_at', 'pk').values_list(
+            'customer_id', 'kind', 'coffees', 'free_drinks', 'order__coffee_count', 'order__free_drinks',
+        ).iterator(chunk_size=self.chunk_size)
+
+        rows = entries
+        if not self.keep_opening_balances:
+            # Confirmed orders that never made it to the ledger. Those confirmed
+            # since only have no entry when they changed nothing.
+            orders = Order.objects.filter(
+                customer__pk__range=(first_id, last_id), status='confirmed', loyalty_entries__isnull=True,
+            ).order_by('customer_id', 'created_at', 'pk').values_list(
+                'customer_id', Value(None, output_field=CharField()), Value(0), Value(0), 'coffee_count', 'free_drinks',
+            ).iterator(chunk_size=self.chunk_size)
+            # For each customer, the orders come before the entries
+            rows = heapq.merge(orders, entries, key=lambda row: row[0])
+
+        balances = {}
+        for customer_id, customer_rows in groupby(rows, key=lambda row: row[0]):
+            count = free = 0
+            for _, kind, coffees, free_drinks, purchased_coffees, redeemed in customer_rows:
+                if kind != LoyaltyEntry.ADJUSTED and purchased_coffees is not None:
+                    coffees, free_drinks = loyalty_change(count, purchased_coffees, redeemed, self.coffee_limit)
+                count += coffees
+                free += free_drinks
+            balances[customer_id] = (count, free)
+        return balances
+
+    def save_batch(self, batch):
+        # The difference is written to the ledger too, so it still adds up to the balance
+        Customer.objects.bulk_update([customer for customer, _, _ in batch], ['coffees_count', 'coffees_free'])
+        LoyaltyEntry.objects.bulk_create([
+            LoyaltyEntry(customer=customer, kind=LoyaltyEntry.RECOMPUTED, coffees=coffees, free_drinks=free_drinks)
+            for customer, coffees, free_drinks in batch
+        ])
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bot.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Recalculează totalurile stocate (subtotal, cafele, reducere) ale comenzilor'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        order_ids = Order.objects.order_by('id').values_list('id', flat=True)
+        updated = 0
+        last_id = 0
+
+        while True:
+            batch = list(order_ids.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1]
+
+            with transaction.atomic():
+                updated += Order.objects.filter(id__in=batch).recompute_totals()
+
+        self.stdout.write(self.style.SUCCESS(f"Totaluri recalculate pentru {updated} comenzi"))
@@ -1,44 +1,255 @@
+import asyncio
 import logging
 import re
+import signal
+import time
 
 from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from telethon import TelegramClient, events, Button
-
-from bot.models import Customer, Category, Order, Product, OrderItem
-from bot.utils import generate_qr_code
-
-current_order = {}
-last_message_id = {}
-current_customer = {}
-awaiting_quantity = {}
+from django.db import connection
+from telethon import TelegramClient, events, Button, types, utils
+from telethon.errors import FloodWaitError, RPCError, ServerError
+from telethon.extensions import BinaryReader
+from telethon.sessions import MemorySession
+from telethon.tl.tlobject import TLObject
+
+from bot import carts
+from bot.catalog import catalog
+from bot.customers import customers
+from bot import dispatch
+from bot.dispatch import OrderedDispatcher
+from bot.keyboards import KeyboardCache
+from bot.models import Customer
+from bot.outbox import Outbox, is_network_error
+from bot.reaper import reap_periodically, stale_pending_orders
+from bot.reports import daily_orders_report
+from bot.sessions import get_session_store
+from bot.telethon_session import DatabaseSession
+from bot.qr import qr_codes
+from bot.utils import split_message, to_business_date
+from bot.workers import WorkerLink, WorkerPool
+
+
+
+def read_tl(data):
+    return BinaryReader(data).tgread_object()
+
+
+def pack_result(result):
+    """
+    An answer of Telegram, as sent to a worker: TL objects as bytes, plain
+    values (True, lists of objects) as they are.
+    """
+    if isinstance(result, TLObject):
+        return bytes(result)
+    if isinstance(result, list):
+        return [pack_result(item) for item in result]
+    return result
+
+
+def unpack_result(result):
+    if isinstance(result, bytes):
+        return read_tl(result)
+    if isinstance(result, list):
+        return [unpack_result(item) for item in result]
+    return result
+
+
+def update_user_id(update):
+    """
+    The user an update comes from, to pick its worker.
+    """
+    message = getattr(update, 'message', None)
+    if isinstance(message, types.Message):
+        return utils.get_peer_id(message.from_id or message.peer_id)
+    return getattr(update, 'user_id', 0)
+
+
+class RelayedClient(TelegramClient):
+    """
+    Client of a worker process of `--workers`. It never connects to Telegram:
+    its requests are made by the receiver and its updates come from it.
+    """
+
+    def __init__(self, link, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.link = link
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        if utils.is_list_like(request):
+            return [await self(item) for item in request]
+        await request.resolve(self, utils)
+        result = unpack_result(await self.link.call(bytes(request)))
+        self.session.process_entities(result)
+        return result
+
+    async def dispatch(self, payload):
+        update, entities = payload
+        entities = [read_tl(entity) for entity in entities]
+        users = [entity for entity in entities if isinstance(entity, types.User)]
+        chats = [entity for entity in entities if not isinstance(entity, types.User)]
+        # What TelegramClient does with an update it received itself
+        updates = await self._preprocess_updates([read_tl(update)], users, chats)
+        await self._dispatch_update(updates[0])
 
 
 class Command(BaseCommand):
     help = 'Pornește botul Telegram'
-    coffee_limit = 5
+    coffee_limit = settings.LOYALTY_COFFEE_LIMIT
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.BOT_WORKERS,
+                            help='Procese în care rulează handler-ele (0: totul într-un singur proces)')
 
     def handle(self, *args, **options):
-        API_ID = getattr(settings, 'TELEGRAM_API_ID', 'YOUR_API_ID')
-        API_HASH = getattr(settings, 'TELEGRAM_API_HASH', 'YOUR_API_HASH')
-        BOT_TOKEN = getattr(settings, 'TELEGRAM_BOT_TOKEN', 'YOUR_BOT_TOKEN')
+        if options['workers']:
+            self.receive(options['workers'])
+            return
+
+        client = self.create_client(TelegramClient, sequential_updates=True)
+        client.start(bot_token=settings.TELEGRAM_BOT_TOKEN)
+        sessions = get_session_store()
+        self.outbox = self.create_outbox(client)
+        client.loop.run_until_complete(self.warm_up(client, sessions))
+        self.add_handlers(client, sessions)
+        client.loop.create_task(reap_periodically(stale_pending_orders, sessions.forget_orders))
+        self.stop_on_signals(client.loop, lambda: self.shut_down(client))
+
+        print("Botul rulează...")
+        client.run_until_disconnected()
 
-        client = TelegramClient('coffee_bot', API_ID, API_HASH).start(bot_token=BOT_TOKEN)
+    def create_client(self, client_class, *args, **kwargs):
+        if settings.TELEGRAM_SESSION_BACKEND == 'database':
+            session = DatabaseSession(settings.TELEGRAM_SESSION_NAME)
+        elif client_class is RelayedClient:
+            session = MemorySession()  # the .session file is the receiver's
+        else:
+            session = settings.TELEGRAM_SESSION_NAME
+        return client_class(*args, session, settings.TELEGRAM_API_ID, settings.TELEGRAM_API_HASH, **kwargs)
+
+    def create_outbox(self, client, workers=1):
+        # Customer notifications go through the outbox, barista replies are sent directly
+        return Outbox(
+            client.send_message,
+            flood_wait=lambda error: error.seconds if isinstance(error, FloodWaitError) else None,
+            is_transient=lambda error: isinstance(error, ServerError) or is_network_error(error),
+            rate=settings.OUTBOX_GLOBAL_RATE / workers,
+        )
 
-        @client.on(events.NewMessage(pattern='/start'))
+    def receive(self, workers):
+        """
+        The receiver of `--workers`: forwards every update to the worker of
+        its user and makes the requests of the workers (see bot.workers).
+        """
+        client = self.create_client(TelegramClient, sequential_updates=True)
+        client.start(bot_token=settings.TELEGRAM_BOT_TOKEN)
+
+        async def perform(request):
+            return pack_result(await client(read_tl(request)))
+
+        pool = WorkerPool(f'{__name__}.Command', perform, workers)
+
+        @client.on(events.Raw)
+        async def forward(update):
+            entities = getattr(update, '_entities', {}).values()
+            await pool.submit(update_user_id(update), (bytes(update), [bytes(entity) for entity in entities]))
+
+        client.loop.run_until_complete(pool.start())
+        # Only here, not in every worker. A worker that still has a reaped cart
+        # in memory drops it on its next use (see get_cart).
+        client.loop.create_task(reap_periodically(stale_pending_orders, get_session_store().forget_orders))
+        self.stop_on_signals(client.loop, lambda: self.stop_receiving(client, pool))
+
+        print(f"Botul rulează cu {workers} procese...")
+        try:
+            client.run_until_disconnected()
+        finally:
+            client.loop.run_until_complete(pool.stop())
+
+    def work(self, sock, workers):
+        """
+        A worker process of `--workers`: runs the handlers for the updates
+        the receiver hands it.
+        """
+        async def main():
+            link = WorkerLink(sock)
+            await link.open()
+            client = self.create_client(RelayedClient, link)
+            sessions = get_session_store()
+            self.outbox = self.create_outbox(client, workers)
+            await self.warm_up(client, sessions)
+            self.add_handlers(client, sessions)
+            async for payload in link.updates():
+                await client.dispatch(payload)
+            await self.dispatcher.join()
+            await self.outbox.close(timeout=settings.OUTBOX_CLOSE_TIMEOUT)
+
+        asyncio.run(main())
+
+    def stop_on_signals(self, loop, shut_down):
+        """
+        Runs the coroutine `shut_down()` on the first SIGINT or SIGTERM.
+        """
+        def stop():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            self.shutdown_task = loop.create_task(shut_down())
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop)
+
+    async def shut_down(self, client):
+        """
+        Stops taking updates, finishes those already taken and sends the
+        queued customer notifications, then disconnects.
+        """
+        print("Botul se oprește...")
+        for callback, event in client.list_event_handlers():
+            client.remove_event_handler(callback, event)
+        await self.dispatcher.join()
+        await self.outbox.close(timeout=settings.OUTBOX_CLOSE_TIMEOUT)
+        await client.disconnect()
+
+    async def stop_receiving(self, client, pool):
+        """
+        Stops forwarding updates and lets the workers finish theirs, making
+        their requests meanwhile, then disconnects.
+        """
+        print("Botul se oprește...")
+        for callback, event in client.list_event_handlers():
+            client.remove_event_handler(callback, event)
+        await pool.stop()
+        await client.disconnect()
+
+    def add_handlers(self, client, sessions):
+        keyboards = KeyboardCache(catalog, Button.inline, TelegramClient.build_reply_markup)
+        # Updates are read one by one and handed to the dispatcher, which runs
+        # different baristas concurrently and each barista's taps in order
+        self.dispatcher = dispatcher = OrderedDispatcher()
+
+        def on(event_builder):
+            def register(handler):
+                client.add_event_handler(
+                    dispatcher.handler(handler, priority=self.update_priority, on_shed=self.reply_busy),
+                    event_builder,
+                )
+                return handler
+            return register
+
+        @on(events.NewMessage(pattern='/start'))
         async def start(event):
-            user = await event.get_sender()
-            me = await client.get_me()
-            user_id = user.id
-            username = user.username
-            bot_username = me.username
+            user_id = event.sender_id
 
             if event.raw_text.startswith('/start user_id'):
                 customer_id = event.raw_text.lstrip('/start user_id')
-                customer = await sync_to_async(Customer.objects.get)(user_id=customer_id)
-                current_customer[user_id] = customer
+                customer = await customers.get(int(customer_id))
+                if customer is None:
+                    await event.respond("Problemă cu codul QR. Clientul nu a fost găsit!")
+                    return
+                state = await sessions.get(user_id)
+                state.customer_id = customer.id
+                await sessions.save(state)
                 buttons = [
                     Button.inline('Adaugă produse', data="go_to_menu"),
                 ]
@@ -47,23 +258,15 @@ class Command(BaseCommand):
                     message += f"\nClientul are {customer.coffees_free} gratis!"
                     buttons.append(Button.inline('Folosește', data="use_free"))
 
-                if current_order.get(user_id):
+                if state.order_id:
                     buttons.append(Button.inline('Finalizați comanda', data="finish"))
 
                 await event.respond(message, buttons=buttons)
                 return
 
-            customer, created = await sync_to_async(Customer.objects.get_or_create)(
-                user_id=user.id,
-                defaults={
-                    'username': user.username,
-                    'first_name': user.first_name,
-                    'role': 'barista' if user.username in settings.BARISTA_USERNAMES else 'customer',
-                }
-            )
+            customer, created = await self.get_or_create_customer(event)
             if created:
-                qr_image = generate_qr_code(bot_username, user_id)
-                await client.send_file(event.chat_id, qr_image, caption=f"Cod QR pentru @{username}")
+                await self.send_qr(client, event.chat_id, customer, caption=f"Cod QR pentru @{customer.username}")
             else:
                 if customer.is_barista():
                     await menu(event)
@@ -71,77 +274,76 @@ class Command(BaseCommand):
 
                 await event.respond("Bine ați revenit la Coffee Shop-ul nostru!")
 
-        @client.on(events.NewMessage(pattern='/qr'))
+        @on(events.NewMessage(pattern='/qr'))
         async def qr(event):
-            user = await event.get_sender()
-            me = await client.get_me()
-            user_id = user.id
-            bot_username = me.username
+            customer, _ = await self.get_or_create_customer(event)
 
-            qr_image = generate_qr_code(bot_username, user_id)
             caption = "Aici este codul dumneavoastră QR unic. Prezentați-l baristei când comandați."
-            await client.send_file(event.chat_id, qr_image, caption=caption)
+            await self.send_qr(client, event.chat_id, customer, caption=caption)
 
-        @client.on(events.NewMessage(pattern='/menu'))
+        @on(events.NewMessage(pattern='/menu'))
         async def menu(event):
-            user = await event.get_sender()
-            customer = await self.get_or_create_user(user)
+            customer, _ = await self.get_or_create_customer(event)
             if not customer.is_barista():
                 return
 
-            categories = await sync_to_async(list)(Category.objects.prefetch_related('products').all())
-            buttons = [
-                [Button.inline(cat.name, data=f"category_{cat.id}")] for cat in categories
-            ]
-
-            await event.respond("Selectați categoria:", buttons=buttons)
+            await event.respond("Selectați categoria:", buttons=await keyboards.categories())
 
-        @client.on(events.NewMessage(pattern='/now'))
+        @on(events.NewMessage(pattern='/now'))
         async def now(event):
-            user = await event.get_sender()
-            customer = await self.get_or_create_user(user)
+            customer, _ = await self.get_or_create_customer(event)
             if not customer.is_barista():
                 return
 
-            order = current_order.get(user.id)
-            if not order:
+            cart = await self.get_cart(await sessions.get(customer.user_id))
+            if not cart:
                 await event.respond('Nu sunt produse adăugate!')
                 return
 
-            order_items = await sync_to_async(list)(order.items.select_related('product').all())
-            total_price, used_free = await sync_to_async(order.total_price)()
             order_summary = '\n'.join([
-                f"{item.product.name} x {item.quantity}" for item in order_items
+                f"{line.name} x {line.quantity}" for line in cart.lines
             ])
-            buttons = [
-                Button.inline('Adaugă încă', data="go_to_menu"),
-                Button.inline('Finalizați comanda', data='check_finish')
-            ]
             await event.respond(f"Comanda curentă:\n{order_summary}\n"
-                                f"Preț Total: {total_price}\n"
-                                f"Gratis: {used_free} cafele\n\n",
-                                buttons=buttons)
+                                f"Preț Total: {cart.total}\n"
+                                f"Gratis: {cart.used_free} cafele\n\n",
+                                buttons=self.cart_buttons())
+
+        @on(events.NewMessage(pattern='/stats'))
+        async def stats(event):
+            customer = await customers.get(event.sender_id)
+            if customer is None or not customer.is_barista():
+                return
+
+            stats = dispatcher.stats()
+            lines = [f"Actualizări în lucru: {stats['running']}, în așteptare: {stats['pending']}"]
+            for name, label in (('high', 'Bariste'), ('normal', 'Butoane'), ('low', 'Clienți')):
+                priority = stats['priorities'][name]
+                lines.append(
+                    f"{label}: {priority['pending']} în așteptare, {priority['started']} procesate, "
+                    f"{priority['shed']} refuzate, așteptare medie {priority['average_wait']:.2f}s, "
+                    f"maximă {priority['max_wait']:.2f}s"
+                )
+            await event.respond('\n'.join(lines))
 
-        @client.on(events.CallbackQuery(data=re.compile('category_(\\d+)')))
+        @on(events.CallbackQuery(data=re.compile('category_(\\d+)(?:_(\\d+))?$')))
         async def category_selected(event):
             category_id = int(event.data_match.group(1))
-            category = await sync_to_async(Category.objects.get)(id=category_id)
-            products = await sync_to_async(list)(category.products.all())
+            page = await keyboards.category_page(category_id, int(event.data_match.group(2) or 0))
 
-            if not products:
+            if not page or not page.product_count:
                 await event.edit("Nu există produse în această categorie.")
                 return
 
-            buttons = [
-                [Button.inline(f"{item.name} - {item.price} MDL", data=f"product_{item.id}")] for item in products
-            ]
+            text = "Alege un produs:"
+            if page.pages > 1:
+                text = f"Alege un produs (pagina {page.page + 1}/{page.pages}):"
+            await event.edit(text, buttons=page.markup)
 
-            await event.edit("Alege un produs:", buttons=buttons)
-
-        @client.on(events.CallbackQuery(data=re.compile('product_(\\d+)')))
+        @on(events.CallbackQuery(data=re.compile('product_(\\d+)')))
         async def product_selected(event):
             product_id = int(event.data_match.group(1))
-            product = await sync_to_async(Product.objects.get)(id=product_id)
+            snapshot = await catalog.asnapshot()
+            product = snapshot.products.get(product_id)
 
             if not product:
                 await event.edit("Nu există așa produs.")
@@ -154,180 +356,109 @@ class Command(BaseCommand):
 
             await event.edit("Alege cantitatea produselor:", buttons=buttons)
 
-        @client.on(events.CallbackQuery(data=re.compile('quantity_(\\d+)_more')))
+        @on(events.CallbackQuery(data=re.compile('quantity_(\\d+)_more')))
         async def quantity_more(event):
             user_id = event.sender_id
             product_id = int(event.data_match.group(1))
-            awaiting_quantity[user_id] = product_id
+            state = await sessions.get(user_id)
+            state.awaiting_product_id = product_id
+            await sessions.save(state)
             await event.respond('Introduceți cantitatea dorită (număr întreg):')
 
-        @client.on(events.CallbackQuery(data=re.compile('quantity_(\\d+)_(\\d+)')))
+        @on(events.CallbackQuery(data=re.compile('quantity_(\\d+)_(\\d+)')))
         async def quantity_selected(event):
-            user = await event.get_sender()
+            user_id = event.sender_id
             product_id = int(event.data_match.group(1))
             quantity = int(event.data_match.group(2))
-            product = await sync_to_async(Product.objects.get)(id=product_id)
+            snapshot = await catalog.asnapshot()
+            product = snapshot.products.get(product_id)
             if not product:
                 await event.edit("Eroare: produsul selectat nu a fost găsit.")
+                return
 
-            order = current_order.get(user.id)
-
-            if not order:
-                barista = await sync_to_async(Customer.objects.get)(user_id=user.id)
-                order = await sync_to_async(Order.objects.create)(
-                    status='pending',
-                    user_created=barista,
-                )
-                current_order[user.id] = order
-
-            existing_item = await sync_to_async(OrderItem.objects.filter(order=order, product=product).first)()
-            if existing_item:
-                existing_item.quantity += quantity
-                await sync_to_async(existing_item.save)()
-            else:
-                await sync_to_async(OrderItem.objects.create)(
-                    order=order,
-                    product=product,
-                    quantity=quantity
-                )
-
-            order_items = await sync_to_async(list)(order.items.select_related('product').all())
-            total_price, used_free = await sync_to_async(order.total_price)()
-            order_summary = '\n'.join([
-                f"- {item.product.name} - {item.product.price} MDL x {item.quantity}"
-                for item in order_items
-            ])
-            buttons = [
-                Button.inline('Adaugă încă', data="go_to_menu"),
-                Button.inline('Finalizați comanda', data='check_finish')
-            ]
+            state = await sessions.get(user_id)
+            cart = await carts.aadd_to_cart(state.order_id, product.id, quantity, user_id)
+            state.order_id = cart.order_id
 
             message = await event.edit(f"Ați adăugat {quantity} x {product.name} la comanda curentă.\n\n"
-                                       f"Comanda curentă:\n{order_summary}\n"
-                                       f"Preț Total: {total_price}\n"
-                                       f"Gratis: {used_free} cafele\n\n",
-                                       buttons=buttons)
-            last_message_id[user.id] = message.id
+                                       f"{self.cart_text(cart)}",
+                                       buttons=self.cart_buttons())
+            state.last_message_id = message.id
+            await sessions.save(state)
 
-        @client.on(events.NewMessage)
+        @on(events.NewMessage)
         async def handle_new_message(event):
             user_id = event.sender_id
-            if user_id in awaiting_quantity:
+            state = await sessions.get(user_id)
+            if state.awaiting_product_id:
                 text = event.raw_text.strip()
                 if text.isdigit():
                     quantity = int(text)
-                    product_id = awaiting_quantity.pop(user_id)
-                    product = await sync_to_async(Product.objects.get)(id=product_id)
+                    product_id = state.awaiting_product_id
+                    state.awaiting_product_id = None
+                    await sessions.save(state)
+                    snapshot = await catalog.asnapshot()
+                    product = snapshot.products.get(product_id)
 
                     if not product:
                         await event.respond("Eroare: produsul selectat nu a fost găsit.")
                         return
 
-                    order = current_order.get(user_id)
-                    if not order:
-                        order = await sync_to_async(Order.objects.create)(
-                            status='pending'
-                        )
-                        current_order[user_id] = order
-
-                    existing_item = await sync_to_async(OrderItem.objects.filter(order=order, product=product).first)()
-
-                    if existing_item:
-                        existing_item.quantity += quantity
-                        await sync_to_async(existing_item.save)()
-                    else:
-                        await sync_to_async(OrderItem.objects.create)(
-                            order=order,
-                            product=product,
-                            quantity=quantity
-                        )
-                    order_items = await sync_to_async(list)(order.items.select_related('product').all())
-                    total_price, used_free = await sync_to_async(order.total_price)()
-                    order_summary = '\n'.join([
-                        f"- {item.product.name} - {item.product.price} MDL x {item.quantity}"
-                        for item in order_items
-                    ])
-                    buttons = [
-                        Button.inline('Adaugă încă', data="go_to_menu"),
-                        Button.inline('Finalizați comanda', data='check_finish')
-                    ]
+                    cart = await carts.aadd_to_cart(state.order_id, product.id, quantity, user_id)
+                    state.order_id = cart.order_id
                     message = await event.respond(f"Ați adăugat {quantity} x {product.name} la comanda curentă.\n\n"
-                                                  f"Comanda curentă:\n{order_summary}\n"
-                                                  f"Preț Total: {total_price}\n"
-                                                  f"Gratis: {used_free} cafele\n\n",
-                                                  buttons=buttons)
-                    last_message_id[user_id] = message.id
+                                                  f"{self.cart_text(cart)}",
+                                                  buttons=self.cart_buttons())
+                    state.last_message_id = message.id
+                    await sessions.save(state)
                 else:
                     await event.respond('Vă rugăm să introduceți un număr întreg.')
 
-        @client.on(events.CallbackQuery(data='go_to_menu'))
+        @on(events.CallbackQuery(data='go_to_menu'))
         async def go_to_menu(event):
-            user_id = event.sender_id
-            message = await event.get_message()
-            await message.delete()
-            if user_id in last_message_id:
-                await client.delete_messages(event.chat_id, [last_message_id[user_id]])
+            state = await sessions.get(event.sender_id)
+            # The tapped message is known by id, no need to fetch it first
+            message_ids = [event.message_id]
+            if state.last_message_id and state.last_message_id != event.message_id:
+                message_ids.append(state.last_message_id)
+            await client.delete_messages(event.chat_id, message_ids)
 
             await menu(event)
 
-        @client.on(events.CallbackQuery(pattern='finish'))
+        @on(events.CallbackQuery(pattern='finish'))
         async def finish(event):
-            user = await event.get_sender()
-            c_order = current_order.get(user.id)
+            user_id = event.sender_id
+            state = await sessions.get(user_id)
+            confirmed = await carts.aconfirm_cart(state.order_id, state.customer_id, self.coffee_limit)
 
-            if not c_order:
+            if not confirmed:
+                state.order_id = None
+                await sessions.save(state)
                 await event.edit("Nu există comenzi active.")
                 await menu(event)
                 return
 
-            customer = current_customer.get(user.id)
+            if confirmed.earned_free:
+                message = f"🎉 Felicitări! Ați câștigat {confirmed.earned_free} cafea/cafele gratuită(e)! 🎉"
+                logging.info(message)
+                self.outbox.notify(confirmed.customer_user_id, message)
 
-            if customer:
-                purchased_coffees = await sync_to_async(c_order.total_coffees)()
-                coffee_free = abs(purchased_coffees - c_order.free_drinks) or 1 if c_order.free_drinks else 0
-                c_order.free_drinks = coffee_free
-
-                if purchased_coffees and not coffee_free:
-                    number_of_free_coffees = (purchased_coffees + customer.coffees_count) // self.coffee_limit
-
-                    if number_of_free_coffees:
-                        customer.coffees_count += purchased_coffees
-                        customer.coffees_count = customer.coffees_count - self.coffee_limit * number_of_free_coffees
-                        customer.coffees_free += number_of_free_coffees
-                        message = f"🎉 Felicitări! Ați câștigat {number_of_free_coffees} cafea/cafele gratuită(e)! 🎉"
-                        logging.info(message)
-                        await client.send_message(customer.user_id, message)
-                    else:
-                        customer.coffees_count += purchased_coffees
-                else:
-                    customer.coffees_free -= coffee_free
-
-                await sync_to_async(customer.save)()
-                c_order.customer = customer
-
-            c_order.status = 'confirmed'
-            c_order.is_anonymous = not customer
-            total_price, used_free = await sync_to_async(c_order.total_price)()
-            c_order.total_paid = total_price
-            await sync_to_async(c_order.save)()
-            current_order.pop(user.id, None)
-            current_customer.pop(user.id, None)
-            order_items = await sync_to_async(list)(c_order.items.select_related('product').all())
+            state.order_id = None
+            state.customer_id = None
+            await sessions.save(state)
             order_summary = '\n'.join([
-                f"- {item.product.name} x {item.quantity}" for item in order_items
+                f"- {line.name} x {line.quantity}" for line in confirmed.cart.lines
             ])
-            await event.edit(f"Comanda a fost adăugată cu succes!\n{order_summary}\nPreț Total: {total_price}")
+            await event.edit(f"Comanda a fost adăugată cu succes!\n{order_summary}\nPreț Total: {confirmed.cart.total}")
 
-        @client.on(events.CallbackQuery(pattern='check_finish'))
+        @on(events.CallbackQuery(pattern='check_finish'))
         async def check_finish(event):
-            user = await event.get_sender()
-            c_order = current_order.get(user.id)
-            if c_order:
-                coffee_count = await sync_to_async(c_order.total_coffees)()
-            else:
-                coffee_count = 0
+            user_id = event.sender_id
+            state = await sessions.get(user_id)
+            cart = await self.get_cart(state)
+            coffee_count = cart.coffee_count if cart else 0
 
-            if current_customer.get(user.id) or not coffee_count:
+            if state.customer_id or not coffee_count:
                 await finish(event)
                 return
             buttons = [
@@ -336,54 +467,28 @@ class Command(BaseCommand):
             ]
             await event.edit(f"Selectați pentru a finaliza comanda!", buttons=buttons)
 
-        @client.on(events.CallbackQuery(pattern='scan_qr_info'))
+        @on(events.CallbackQuery(pattern='scan_qr_info'))
         async def scan_qr_info(event):
             await event.edit(f"Deschide camera și scanează Codul QR!")
 
-        @client.on(events.CallbackQuery(pattern='use_free'))
+        @on(events.CallbackQuery(pattern='use_free'))
         async def use_free(event):
-            user = await event.get_sender()
-            customer = current_customer[user.id]
-            print('customer use free', customer)
-            if customer.coffees_free:
-                c_order = current_order.get(user.id)
-                if c_order:
-                    c_order.customer = customer
-                    c_order.free_drinks = customer.coffees_free
-                    await sync_to_async(c_order.save)()
-                else:
-                    c_order = await sync_to_async(Order.objects.create)(
-                        status='pending'
-                    )
-                    c_order.free_drinks = customer.coffees_free
-                    await sync_to_async(c_order.save)()
-                    current_order[user.id] = c_order
-
-            order_items = await sync_to_async(list)(c_order.items.select_related('product').all())
-            total_price, used_free = await sync_to_async(c_order.total_price)()
-            order_summary = '\n'.join([
-                f"- {item.product.name} - {item.product.price} MDL x {item.quantity}"
-                for item in order_items
-            ])
-            buttons = [
-                Button.inline('Adaugă încă', data="go_to_menu"),
-                Button.inline('Finalizați comanda', data='check_finish')
-            ]
+            user_id = event.sender_id
+            state = await sessions.get(user_id)
+            cart = await carts.ause_free_drinks(state.order_id, state.customer_id)
+            if not cart:
+                await event.edit("Clientul nu are cafele gratuite.")
+                return
+            state.order_id = cart.order_id
 
-            message = await event.edit(f"Comanda curentă:\n{order_summary}\n"
-                                       f"Preț Total: {total_price}\n"
-                                       f"Gratis: {used_free} cafele\n\n",
-                                       buttons=buttons)
-            last_message_id[user.id] = message.id
+            message = await event.edit(self.cart_text(cart), buttons=self.cart_buttons())
+            state.last_message_id = message.id
+            await sessions.save(state)
 
-        @client.on(events.NewMessage(pattern='/order'))
+        @on(events.NewMessage(pattern='/order'))
         async def add_order(event):
-            user = await event.get_sender()
-            user_id = user.id
-            try:
-                customer = Customer.objects.get(user_id=user_id)
-            except Customer.DoesNotExist:
-                customer = None
+            user_id = event.sender_id
+            customer = await customers.get(user_id)
 
             if customer:
                 await event.respond("Cod QR funcționează")
@@ -391,40 +496,30 @@ class Command(BaseCommand):
             else:
                 await event.respond("Problemă cu codul QR. Eroarea a fost salvată!")
 
-        @client.on(events.NewMessage(pattern='/info'))
+        @on(events.NewMessage(pattern='/info'))
         async def info(event):
-            user = await event.get_sender()
-            try:
-                customer = await sync_to_async(Customer.objects.get)(user_id=user.id)
-            except Customer.DoesNotExist:
-                customer = None
+            user_id = event.sender_id
+            customer = await customers.get(user_id)
 
             if customer:
                 if customer.is_barista():
-                    today = timezone.now().date()
+                    today = to_business_date()
 
-                    orders = await sync_to_async(list)(Order.objects.order_by('id').filter(created_at__date=today))
+                    summaries, total = await sync_to_async(daily_orders_report)(today)
 
-                    if not orders:
+                    if not summaries:
                         await event.respond("Nu există comenzi pentru astăzi.")
                         return
 
-                    # Build the message
-                    message = "Comenzile de astăzi:\n"
-                    total = 0
-                    count = 0
-                    for order in orders:
-                        order_items = await sync_to_async(list)(order.items.select_related('product').all())
-                        order_summary = ', '.join([
-                            f"{item.product.name} x {item.quantity}" for item in order_items
-                        ])
-                        total_price, used_free = await sync_to_async(order.total_price)()
-                        total += total_price
-                        count += 1
-                        message += f"#{count}: {order_summary} = {total_price}\n"
-
-                    message += f"\nTotal azi: {total} MDL\n\n"
-                    await event.respond(message)
+                    # Build the report, split into messages that fit Telegram's limit
+                    lines = ["Comenzile de astăzi:"]
+                    lines += [
+                        f"#{count}: {', '.join(summary.items)} = {summary.total}"
+                        for count, summary in enumerate(summaries, start=1)
+                    ]
+                    lines += ["", f"Total azi: {total} MDL"]
+                    for message in split_message(lines):
+                        await event.respond(message)
                     return
 
                 purchases_left = (
@@ -440,16 +535,118 @@ class Command(BaseCommand):
                 )
                 await event.respond(loyalty_status)
 
-        print("Botul rulează...")
-        client.run_until_disconnected()
-
-    async def get_or_create_user(self, user):
-        customer, created = await sync_to_async(Customer.objects.get_or_create)(
-            user_id=user.id,
-            defaults={
-                'username': user.username,
-                'first_name': user.first_name,
-                'role': 'barista' if user.username in settings.BARISTA_USERNAMES else 'customer',
-            }
+    def user_defaults(self, user):
+        return {
+            'username': user.username,
+            'first_name': user.first_name,
+            'role': 'barista' if user.username in self.barista_usernames else 'customer',
+        }
+
+    async def get_or_create_customer(self, event):
+        """
+        The sender's customer, and whether they were just registered. The
+        sender entity, which may cost a request to Telegram, is only resolved
+        for a customer not seen before.
+        """
+        customer = await customers.get(event.sender_id)
+        if customer is not None:
+            return customer, False
+        user = event.sender or await event.get_sender()
+        return await customers.get_or_create(user.id, self.user_defaults(user))
+
+    async def warm_up(self, client, sessions):
+        """
+        Does up front what the first updates would otherwise pay for: the bot
+        identity, the catalog, the barista list, the customers of the carts the
+        session store kept across the restart and the DB connection.
+        """
+        started = time.perf_counter()
+        self.bot_username = (await client.get_me()).username
+        self.barista_usernames = frozenset(settings.BARISTA_USERNAMES)
+        await sync_to_async(connection.ensure_connection)()
+        await sync_to_async(catalog.load)()
+        await customers.preload(role=Customer.BARISTA)
+        # Baristas get their updates scheduled first (see update_priority)
+        baristas = await customers.load_baristas()
+        asyncio.ensure_future(customers.reload_baristas_periodically())
+        carts = await sessions.warm_up()
+        # The customers those carts were scanned for, whose order comes next
+        await customers.preload(pk__in=[state.customer_id for state in carts if state.customer_id])
+        self.outbox.start()
+        self.stdout.write(
+            f"Bot pregătit în {time.perf_counter() - started:.2f}s: @{self.bot_username}, "
+            f"{len(catalog.snapshot().products)} produse, {baristas} bariste, {len(carts)} comenzi în curs reluate"
         )
-        return customer
\ No newline at end of file
+
+    def update_priority(self, event):
+        """
+        Baristas' updates first, then other button taps, then customer commands.
+        Decided from memory only, so it never waits on the database.
+        """
+        if customers.is_barista(event.sender_id):
+            return dispatch.HIGH
+        if isinstance(event, events.CallbackQuery.Event):
+            return dispatch.NORMAL
+        return dispatch.LOW
+
+    async def reply_busy(self, event):
+        message = "Sistemul este ocupat acum. Vă rugăm să încercați din nou în câteva momente."
+        try:
+            if isinstance(event, events.CallbackQuery.Event):
+                await event.answer(message, alert=True)
+            else:
+                await event.respond(message)
+        except RPCError:
+            logging.warning("Could not send the busy reply to %s", event.sender_id)
+
+    async def send_qr(self, client, chat_id, customer, caption):
+        """
+        Sends the customer's QR code, uploading it only the first time and
+        reusing the stored Telegram file id afterwards.
+        """
+        if customer.qr_file_id:
+            try:
+                return await client.send_file(chat_id, self.unpack_photo(customer.qr_file_id), caption=caption)
+            except (ValueError, RPCError):
+                # Ids of another bot, or an expired file reference: upload again
+                logging.warning("Stored QR file id of %s is no longer valid", customer)
+
+        qr_image = await qr_codes.get_file(self.bot_username, customer.user_id)
+        message = await client.send_file(chat_id, qr_image, caption=caption)
+        await sync_to_async(Customer.objects.filter(pk=customer.id).update)(qr_file_id=self.pack_photo(message.photo))
+        customers.invalidate(customer.user_id)
+        return message
+
+    @staticmethod
+    def pack_photo(photo):
+        return f"{photo.id}:{photo.access_hash}:{photo.file_reference.hex()}"
+
+    @staticmethod
+    def unpack_photo(file_id):
+        photo_id, access_hash, file_reference = file_id.split(':')
+        return types.InputPhoto(int(photo_id), int(access_hash), bytes.fromhex(file_reference))
+
+    async def get_cart(self, state):
+        """
+        The cart of a session, or None if its order was confirmed or removed.
+        """
+        if not state.order_id:
+            return None
+        cart = await carts.aget_cart(state.order_id)
+        if cart is None:
+            state.order_id = None
+        return cart
+
+    def cart_text(self, cart):
+        order_summary = '\n'.join([
+            f"- {line.name} - {line.price} MDL x {line.quantity}" for line in cart.lines
+        ])
+        return (f"Comanda curentă:\n{order_summary}\n"
+                f"Preț Total: {cart.total}\n"
+                f"Gratis: {cart.used_free} cafele\n\n")
+
+    def cart_buttons(self):
+        return [
+            Button.inline('Adaugă încă', data="go_to_menu"),
+            Button.inline('Finalizați comanda', data='check_finish')
+        ]
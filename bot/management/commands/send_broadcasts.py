@@ -0,0 +1,55 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from bot.broadcast import BroadcastSender
+from bot.models import Broadcast
+
+
+class Command(BaseCommand):
+    help = (
+        'Trimite tuturor clienților mesajele puse în coadă din admin. Un mesaj întrerupt '
+        'continuă de la ultimul client salvat. Rulați o singură instanță odată.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('broadcast_ids', nargs='*', type=int,
+                            help='Mesajele de trimis (implicit: cele din coadă și cele întrerupte)')
+        parser.add_argument('--rate', type=float, default=settings.BROADCAST_RATE,
+                            help='Mesaje pe secundă')
+        parser.add_argument('--chunk-size', type=int, default=settings.BROADCAST_CHUNK_SIZE,
+                            help='Clienți citiți și salvați odată')
+
+    def handle(self, *args, **options):
+        if options['broadcast_ids']:
+            broadcasts = Broadcast.objects.filter(pk__in=options['broadcast_ids']).exclude(status=Broadcast.DONE)
+        else:
+            broadcasts = Broadcast.objects.filter(status__in=[Broadcast.QUEUED, Broadcast.SENDING])
+        broadcasts = list(broadcasts.order_by('pk'))
+        if not broadcasts:
+            self.stdout.write("Nu există mesaje de trimis.")
+            return
+        if not settings.TELEGRAM_BOT_TOKEN:
+            raise CommandError("TELEGRAM_BOT_TOKEN nu este setat.")
+
+        asyncio.run(self.send_all(broadcasts, options))
+
+    async def send_all(self, broadcasts, options):
+        async with Bot(settings.TELEGRAM_BOT_TOKEN) as bot:
+            sender = BroadcastSender(
+                lambda chat_id, text: bot.send_message(chat_id=chat_id, text=text),
+                flood_wait=lambda error: error.retry_after if isinstance(error, RetryAfter) else None,
+                is_transient=lambda error: isinstance(error, NetworkError) and not isinstance(error, BadRequest),
+                rate=options['rate'],
+                chunk_size=options['chunk_size'],
+            )
+            for broadcast in broadcasts:
+                self.stdout.write(f"Se trimite: {broadcast}")
+                broadcast = await sender.run(broadcast)
+                duration = (broadcast.finished_at - broadcast.started_at).total_seconds()
+                self.stdout.write(self.style.SUCCESS(
+                    f"{broadcast}: {broadcast.sent} trimise, {broadcast.failed} eșuate, în {duration:.0f}s"
+                ))
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.15 on 2026-10-17 10:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0008_order_total_paid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSalesReport',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'Product Sales Report',
+                'verbose_name_plural': 'Product Sales Reports',
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('bot.product',),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='coffee_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='free_discount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='is_coffee',
+            field=models.BooleanField(default=False, help_text='Counts towards the free coffee loyalty program'),
+        ),
+        migrations.AlterField(
+            model_name='customer',
+            name='coffees_count',
+            field=models.IntegerField(default=0, help_text='Number of coffees to reach free coffee'),
+        ),
+    ]
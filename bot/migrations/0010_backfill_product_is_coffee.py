@@ -0,0 +1,17 @@
+from django.db import migrations
+
+
+def mark_coffee_products(apps, schema_editor):
+    Product = apps.get_model('bot', 'Product')
+    Product.objects.filter(category__name__iexact='coffee').update(is_coffee=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0009_productsalesreport_order_coffee_count_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(mark_coffee_products, migrations.RunPython.noop),
+    ]
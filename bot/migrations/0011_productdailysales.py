@@ -0,0 +1,28 @@
+# Generated by Django 5.1.15 on 2026-10-17 10:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0010_backfill_product_is_coffee'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('business_date', models.DateField()),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='bot.product')),
+            ],
+            options={
+                'verbose_name_plural': 'Product daily sales',
+                'constraints': [models.UniqueConstraint(fields=('product', 'business_date'), name='unique_product_daily_sales')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+
+def backfill_business_date(apps, schema_editor):
+    Order = apps.get_model('bot', 'Order')
+    Order.objects.update(
+        business_date=TruncDate('created_at', tzinfo=ZoneInfo(settings.BUSINESS_TIME_ZONE)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0011_productdailysales'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='business_date',
+            field=models.DateField(null=True, editable=False),
+        ),
+        migrations.RunPython(backfill_business_date, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='business_date',
+            field=models.DateField(db_index=True, editable=False, help_text='Day of the order in Chisinau time'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'business_date'], name='order_status_business_date'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user_created', 'business_date'], name='order_creator_business_date'),
+        ),
+    ]
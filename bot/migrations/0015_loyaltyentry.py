@@ -0,0 +1,29 @@
+# Generated by Django 5.1.15 on 2026-10-17 10:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0014_alter_order_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoyaltyEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('earned', 'Earned'), ('redeemed', 'Redeemed'), ('adjusted', 'Adjusted')], max_length=10)),
+                ('coffees', models.IntegerField(default=0, help_text='Change of the coffees counted towards a free one')),
+                ('free_drinks', models.IntegerField(default=0, help_text='Change of the free coffees')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='loyalty_entries', to='bot.customer')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='loyalty_entries', to='bot.order')),
+            ],
+            options={
+                'verbose_name_plural': 'Loyalty entries',
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def record_opening_balances(apps, schema_editor):
+    # Start every ledger from the balance the customer already has
+    Customer = apps.get_model('bot', 'Customer')
+    LoyaltyEntry = apps.get_model('bot', 'LoyaltyEntry')
+    customers = Customer.objects.exclude(coffees_count=0, coffees_free=0)
+    LoyaltyEntry.objects.bulk_create([
+        LoyaltyEntry(customer=customer, kind='adjusted', coffees=customer.coffees_count,
+                     free_drinks=customer.coffees_free)
+        for customer in customers.iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0015_loyaltyentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(record_opening_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-17 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0016_loyalty_opening_balances'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='qr_file_id',
+            field=models.CharField(blank=True, editable=False, help_text='Telegram file id of the uploaded QR code', max_length=255, null=True),
+        ),
+    ]
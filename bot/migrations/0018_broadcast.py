@@ -0,0 +1,27 @@
+# Generated by Django 5.1.15 on 2026-10-17 10:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0017_customer_qr_file_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Broadcast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField(max_length=4096)),
+                ('status', models.CharField(choices=[('draft', 'Draft'), ('queued', 'Queued'), ('sending', 'Sending'), ('done', 'Done')], default='draft', max_length=10)),
+                ('last_customer_id', models.IntegerField(default=0, editable=False, help_text='Customers up to this id were handled')),
+                ('sent', models.PositiveIntegerField(default=0, editable=False)),
+                ('failed', models.PositiveIntegerField(default=0, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, editable=False, null=True)),
+            ],
+        ),
+    ]
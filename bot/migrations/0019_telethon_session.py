@@ -0,0 +1,60 @@
+# Generated by Django 5.1.15 on 2026-10-17 10:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0018_broadcast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelethonSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('dc_id', models.IntegerField(default=0)),
+                ('server_address', models.CharField(blank=True, max_length=255, null=True)),
+                ('port', models.IntegerField(blank=True, null=True)),
+                ('auth_key', models.BinaryField(blank=True, null=True)),
+                ('takeout_id', models.BigIntegerField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TelethonEntity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity_id', models.BigIntegerField()),
+                ('access_hash', models.BigIntegerField()),
+                ('username', models.CharField(blank=True, max_length=100, null=True)),
+                ('phone', models.CharField(blank=True, max_length=32, null=True)),
+                ('name', models.CharField(blank=True, max_length=255, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entities', to='bot.telethonsession')),
+            ],
+            options={
+                'verbose_name_plural': 'Telethon entities',
+                'indexes': [models.Index(fields=['session', 'username'], name='bot_teletho_session_1c88e1_idx')],
+                'constraints': [models.UniqueConstraint(fields=('session', 'entity_id'), name='unique_telethon_entity')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TelethonUpdateState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity_id', models.BigIntegerField()),
+                ('pts', models.IntegerField()),
+                ('qts', models.IntegerField()),
+                ('date', models.DateTimeField()),
+                ('seq', models.IntegerField()),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='update_states', to='bot.telethonsession')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('session', 'entity_id'), name='unique_telethon_update_state')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_product_prices(apps, schema_editor):
+    OrderItem = apps.get_model('bot', 'OrderItem')
+    Product = apps.get_model('bot', 'Product')
+    OrderItem.objects.update(unit_price=Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0019_telethon_session'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, help_text='Price of the product when the line was added', max_digits=5),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_product_prices, migrations.RunPython.noop),
+    ]
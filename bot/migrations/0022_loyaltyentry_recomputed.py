@@ -0,0 +1,18 @@
+# Generated by Django 5.1.15 on 2026-10-17 10:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0021_order_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='loyaltyentry',
+            name='kind',
+            field=models.CharField(choices=[('earned', 'Earned'), ('redeemed', 'Redeemed'), ('adjusted', 'Adjusted'), ('recomputed', 'Recomputed')], max_length=10),
+        ),
+    ]
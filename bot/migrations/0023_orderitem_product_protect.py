@@ -0,0 +1,19 @@
+# Generated by Django 5.1.15 on 2026-10-17 11:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0022_loyaltyentry_recomputed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderitem',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='bot.product'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def mark_opening_balances(apps, schema_editor):
+    # The entries written by 0016: each customer's first entry, an adjustment
+    # without an order, from before the bot recorded any order in the ledger
+    LoyaltyEntry = apps.get_model('bot', 'LoyaltyEntry')
+    first_entries = LoyaltyEntry.objects.values('customer_id').annotate(first=Min('pk')).values('first')
+    openings = LoyaltyEntry.objects.filter(pk__in=first_entries, kind='adjusted', order__isnull=True)
+    first_order_entry = LoyaltyEntry.objects.exclude(kind='adjusted').order_by('created_at').first()
+    if first_order_entry is not None:
+        openings = openings.filter(created_at__lte=first_order_entry.created_at)
+    openings.update(kind='opening')
+
+
+def unmark_opening_balances(apps, schema_editor):
+    LoyaltyEntry = apps.get_model('bot', 'LoyaltyEntry')
+    LoyaltyEntry.objects.filter(kind='opening').update(kind='adjusted')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0023_orderitem_product_protect'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='loyaltyentry',
+            name='kind',
+            field=models.CharField(choices=[('earned', 'Earned'), ('redeemed', 'Redeemed'), ('adjusted', 'Adjusted'), ('recomputed', 'Recomputed'), ('opening', 'Opening balance')], max_length=10),
+        ),
+        migrations.RunPython(mark_opening_balances, unmark_opening_balances),
+    ]
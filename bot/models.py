@@ -1,7 +1,14 @@
 import uuid
+from collections import defaultdict, namedtuple
 
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import F, Q, Sum, Value, ExpressionWrapper, DecimalField
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .utils import to_business_date
 
 
 class Category(models.Model):
@@ -15,12 +22,27 @@ class Product(models.Model):
     category = models.ForeignKey(Category, related_name='products', on_delete=models.CASCADE)
     name = models.CharField(max_length=100)
     price = models.DecimalField(max_digits=5, decimal_places=2)
+    is_coffee = models.BooleanField(default=False, help_text="Counts towards the free coffee loyalty program")
 
     # Optionally add image, description, etc.
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_is_coffee = instance.__dict__.get('is_coffee')
+        return instance
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if self.is_coffee != getattr(self, '_saved_is_coffee', self.is_coffee):
+                # Open carts count their coffees again; confirmed orders keep theirs
+                Order.objects.filter(status='pending', items__product=self).distinct().recompute_totals()
+        self._saved_is_coffee = self.is_coffee
+
 
 class Customer(models.Model):
     BARISTA = 'barista'
@@ -36,6 +58,8 @@ class Customer(models.Model):
     coffees_count = models.IntegerField(default=0, help_text="Number of coffees to reach free coffee")
     coffees_free = models.IntegerField(default=0)
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default='customer')
+    qr_file_id = models.CharField(max_length=255, blank=True, null=True, editable=False,
+                                  help_text="Telegram file id of the uploaded QR code")
 
     def __str__(self):
         return self.username or self.first_name or f"User {self.user_id}"
@@ -44,61 +68,507 @@ class Customer(models.Model):
         return self.role == self.BARISTA
 
 
+def free_drinks_discount(free_drinks, coffee_lines):
+    """
+    Applies `free_drinks` to (quantity, price) coffee lines in order.
+    Returns the discounted amount and the number of drinks given for free.
+    """
+    discount = 0
+    free_to_use = free_drinks
+    for quantity, price in coffee_lines:
+        if free_to_use <= 0:
+            break
+        free_qty = min(free_to_use, quantity)
+        discount += free_qty * price
+        free_to_use -= free_qty
+    return discount, max(free_drinks, 0) - max(free_to_use, 0)
+
+
+def loyalty_change(coffees_count, purchased_coffees, redeemed, coffee_limit):
+    """
+    The loyalty rule: change of (coffees_count, coffees_free) for an order of
+    `purchased_coffees` coffees, `redeemed` of them given for free, by a
+    customer who had `coffees_count` towards the next free one.
+    """
+    if purchased_coffees and not redeemed:
+        earned = (coffees_count + purchased_coffees) // coffee_limit
+        return purchased_coffees - coffee_limit * earned, earned
+    return 0, -redeemed
+
+
+OrderPricing = namedtuple('OrderPricing', ['subtotal', 'coffee_count', 'free_discount', 'used_free'])
+
+
+class OrderQuerySet(models.QuerySet):
+
+    def pricing(self):
+        """
+        Prices every order of the queryset from its items:
+        {order_id: OrderPricing(subtotal, coffee_count, free_discount, used_free)}.
+
+        One grouped query gives the subtotal and coffee count of each order. Coffee
+        lines are only fetched, in a second query, for orders that use free drinks.
+        """
+        line_total = ExpressionWrapper(F('items__quantity') * F('items__unit_price'), output_field=DecimalField())
+        rows = Order.objects.filter(pk__in=self.values('pk')).order_by().annotate(
+            items_subtotal=Coalesce(Sum(line_total), Value(0), output_field=DecimalField()),
+            items_coffee_count=Coalesce(Sum('items__quantity', filter=Q(items__product__is_coffee=True)), Value(0)),
+        ).values_list('pk', 'free_drinks', 'items_subtotal', 'items_coffee_count')
+
+        totals = {}
+        free_orders = {}
+        for order_id, free_drinks, subtotal, coffee_count in rows:
+            totals[order_id] = (subtotal, coffee_count)
+            if free_drinks > 0 and coffee_count:
+                free_orders[order_id] = free_drinks
+
+        coffee_lines = defaultdict(list)
+        if free_orders:
+            lines = OrderItem.objects.filter(order_id__in=free_orders, product__is_coffee=True).order_by('order_id', 'id')
+            for order_id, quantity, price in lines.values_list('order_id', 'quantity', 'unit_price'):
+                coffee_lines[order_id].append((quantity, price))
+
+        pricing = {}
+        for order_id, (subtotal, coffee_count) in totals.items():
+            discount, used_free = free_drinks_discount(free_orders.get(order_id, 0), coffee_lines[order_id])
+            pricing[order_id] = OrderPricing(subtotal, coffee_count, discount, used_free)
+        return pricing
+
+    def recompute_totals(self):
+        """
+        Writes the stored totals of every order of the queryset again from its items.
+        """
+        orders = [
+            Order(pk=order_id, subtotal=price.subtotal, coffee_count=price.coffee_count,
+                  free_discount=price.free_discount)
+            for order_id, price in self.pricing().items()
+        ]
+        Order.objects.bulk_update(orders, Order.TOTAL_FIELDS)
+        return len(orders)
+
+
+class OrderItemQuerySet(models.QuerySet):
+    """
+    Bulk changes of items keep the stored totals of their orders and the sales
+    rollup right, as OrderItem.save() and delete() do for a single item.
+    """
+
+    def _change(self, change, other_order_ids=()):
+        with transaction.atomic():
+            orders = Order.objects.filter(pk__in={*self.values_list('order_id', flat=True), *other_order_ids})
+            confirmed = list(orders.filter(status='confirmed'))
+            for order in confirmed:
+                ProductDailySales.add_order(order, sign=-1)
+            result = change()
+            orders.recompute_totals()
+            for order in confirmed:
+                ProductDailySales.add_order(order)
+        return result
+
+    def update(self, **kwargs):
+        moved_to = kwargs.get('order', kwargs.get('order_id'))
+        other_order_ids = [getattr(moved_to, 'pk', moved_to)] if moved_to is not None else []
+        return self._change(lambda: super(OrderItemQuerySet, self).update(**kwargs), other_order_ids)
+
+    update.alters_data = True
+
+    def delete(self):
+        return self._change(lambda: super(OrderItemQuerySet, self).delete())
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
 class Order(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
         ('confirmed', 'Confirmed'),
+        ('cancelled', 'Cancelled'),
     )
     user_created = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True,
                                      related_name='user_created')
     customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True)
     products = models.ManyToManyField(Product, through='OrderItem')
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, help_text="Last change of the order or its items")
+    business_date = models.DateField(db_index=True, editable=False, help_text="Day of the order in Chisinau time")
     is_anonymous = models.BooleanField(default=False)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     free_drinks = models.IntegerField(default=0)
     total_paid = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
 
+    # Running totals, maintained by OrderItem.save()/delete(), bulk item changes and recompute_order_totals
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+    coffee_count = models.PositiveIntegerField(default=0, editable=False)
+    free_discount = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+
+    TOTAL_FIELDS = ('subtotal', 'coffee_count', 'free_discount')
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'business_date'], name='order_status_business_date'),
+            models.Index(fields=['user_created', 'business_date'], name='order_creator_business_date'),
+        ]
+
     def __str__(self):
         return f"Order {self.id} - {'Anonymous' if self.is_anonymous else self.customer}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_free_drinks = instance.__dict__.get('free_drinks')
+        instance._saved_status = instance.__dict__.get('status')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # The running totals are only written by the item bookkeeping below, so a
+        # stale in-memory order can never overwrite them.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.TOTAL_FIELDS
+            ]
+
+        if self.business_date is None:
+            self.business_date = to_business_date(self.created_at)
+
+        with transaction.atomic():
+            free_drinks_changed = self.free_drinks != getattr(self, '_saved_free_drinks', 0)
+            if free_drinks_changed and self.pk:
+                self.free_discount = self.compute_free_discount()
+                if kwargs.get('update_fields') is not None:
+                    kwargs['update_fields'] = [*kwargs['update_fields'], 'free_discount']
+            super().save(*args, **kwargs)
+
+            update_fields = kwargs.get('update_fields')
+            status_saved = update_fields is None or 'status' in update_fields
+            confirmed = self.status == 'confirmed'
+            if status_saved and confirmed != (getattr(self, '_saved_status', None) == 'confirmed'):
+                ProductDailySales.add_order(self, sign=1 if confirmed else -1)
+
+        self._saved_free_drinks = self.free_drinks
+        self._saved_status = self.status
+
+    @property
+    def used_free(self):
+        return min(self.free_drinks, self.coffee_count)
+
     def total_coffees(self):
-        return OrderItem.objects.filter(order=self,
-                                        product__category__name='Coffee').aggregate(sum=Sum('quantity'))['sum']
+        return self.coffee_count
 
     def total_price(self):
-        total = 0
-        used_free = 0
-        coffee_items = OrderItem.objects.filter(order=self, product__category__name__iexact='coffee')
-        other_items = OrderItem.objects.filter(order=self).exclude(product__category__name__iexact='coffee')
-
-        # Apply free drinks to coffee items
-        free_to_use = self.free_drinks
-        for item in coffee_items.select_related('product'):
-            if free_to_use > 0:
-                free_qty = min(free_to_use, item.quantity)
-                used_free += free_qty
-                payable_qty = item.quantity - free_qty
-                total += payable_qty * item.product.price
-                free_to_use -= free_qty
+        return self.subtotal - self.free_discount, self.used_free
+
+    def compute_free_discount(self):
+        """
+        Value of the free drinks applied to this order's coffee items, in item order.
+        """
+        if self.free_drinks <= 0:
+            return 0
+
+        coffee_items = self.items.filter(product__is_coffee=True).order_by('id')
+        discount, _ = free_drinks_discount(self.free_drinks, coffee_items.values_list('quantity', 'unit_price'))
+        return discount
+
+    def add_item(self, product_id, quantity):
+        """
+        Adds `quantity` of a product to the order, merging with an existing line.
+        """
+        with transaction.atomic():
+            item = self.items.select_for_update().filter(product_id=product_id).first()
+            if item:
+                item.quantity += quantity
             else:
-                total += item.quantity * item.product.price
+                item = OrderItem(product_id=product_id, quantity=quantity)
+            item.order = self
+            item.save()
+        return item
 
-        # Add other categories normally
-        for item in other_items.select_related('product'):
-            total += item.quantity * item.product.price
+    def apply_item_change(self, product, quantity_delta, unit_price):
+        """
+        Moves the running totals by `quantity_delta` units of `product` sold at `unit_price`.
+        """
+        if not quantity_delta:
+            return
 
-        return total, used_free
+        coffee_delta = quantity_delta if product.is_coffee else 0
+        with transaction.atomic():
+            Order.objects.filter(pk=self.pk).update(
+                subtotal=F('subtotal') + quantity_delta * unit_price,
+                coffee_count=F('coffee_count') + coffee_delta,
+                updated_at=timezone.now(),
+            )
+            if coffee_delta and self.free_drinks:
+                Order.objects.filter(pk=self.pk).update(free_discount=self.compute_free_discount())
+            if getattr(self, '_saved_status', None) == 'confirmed':
+                ProductDailySales.add_lines(
+                    self.business_date, [(product.pk, quantity_delta, quantity_delta * unit_price)],
+                )
+            self.refresh_from_db(fields=self.TOTAL_FIELDS)
 
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
-    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    # A product that was sold is kept, so the orders' lines and totals stay whole
+    product = models.ForeignKey(Product, on_delete=models.PROTECT)
     quantity = models.PositiveIntegerField(default=1)
+    unit_price = models.DecimalField(max_digits=5, decimal_places=2, editable=False,
+                                     help_text="Price of the product when the line was added")
+
+    objects = OrderItemQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_line = tuple(instance.__dict__.get(name) for name in ('product_id', 'quantity', 'unit_price'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        previous = getattr(self, '_saved_line', None)
+        # A line keeps the price it was started at, so the totals take off what they added
+        if self.unit_price is None or (previous and previous[0] != self.product_id):
+            self.unit_price = self._meta.get_field('unit_price').to_python(self.product.price)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if previous and previous[0] != self.product_id:
+                self.order.apply_item_change(self._product_for(previous[0]), -previous[1], previous[2])
+                previous = None
+            self.order.apply_item_change(self.product, self.quantity - (previous[1] if previous else 0), self.unit_price)
+        self._saved_line = (self.product_id, self.quantity, self.unit_price)
+
+    def delete(self, *args, **kwargs):
+        previous = getattr(self, '_saved_line', None) or (self.product_id, self.quantity, self.unit_price)
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            self.order.apply_item_change(self._product_for(previous[0]), -previous[1], previous[2])
+        self._saved_line = None
+        return result
+
+    def _product_for(self, product_id):
+        if product_id == self.product_id:
+            return self.product
+        return Product.objects.get(pk=product_id)
+
+
+class ProductDailySales(models.Model):
+    """
+    Quantity and revenue of each product per day, over confirmed orders.
+    Kept up to date as orders are confirmed, unconfirmed, deleted and their
+    items edited; rebuild_sales_rollup recomputes it.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    business_date = models.DateField()
+    quantity = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = 'Product daily sales'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'business_date'], name='unique_product_daily_sales'),
+        ]
+
+    def __str__(self):
+        return f"{self.product} {self.business_date}: {self.quantity}"
+
+    @classmethod
+    def add_lines(cls, business_date, lines):
+        """
+        Adds (product_id, quantity, revenue) lines to the rows of `business_date`.
+        Negative lines take sales off; a row left with nothing sold is removed.
+        """
+        with transaction.atomic():
+            for product_id, quantity, revenue in lines:
+                if quantity > 0:
+                    row, _ = cls.objects.get_or_create(product_id=product_id, business_date=business_date)
+                    rows = cls.objects.filter(pk=row.pk)
+                else:
+                    rows = cls.objects.filter(product_id=product_id, business_date=business_date)
+                rows.update(quantity=F('quantity') + quantity, revenue=F('revenue') + revenue)
+                if quantity < 0:
+                    rows.filter(quantity=0).delete()
+
+    @classmethod
+    def add_order(cls, order, sign=1):
+        """
+        Adds the items of `order` to its day, or takes them off with `sign=-1`.
+        """
+        lines = order.items.values('product_id').annotate(
+            line_quantity=Sum('quantity'),
+            line_revenue=Sum(ExpressionWrapper(F('quantity') * F('unit_price'), output_field=DecimalField())),
+        ).order_by()
+        cls.add_lines(order.business_date, [
+            (line['product_id'], sign * line['line_quantity'], sign * line['line_revenue']) for line in lines
+        ])
+
+
+@receiver(pre_delete, sender=Order)
+def _take_deleted_order_off_sales(sender, instance, **kwargs):
+    # Before the cascade removes its items; also runs for queryset deletes
+    if instance.status == 'confirmed':
+        ProductDailySales.add_order(instance, sign=-1)
+
+
+class LoyaltyEntry(models.Model):
+    """
+    Append-only ledger of a customer's loyalty card. Each entry records the
+    change it made to Customer.coffees_count and Customer.coffees_free, which
+    remain the running balance.
+    """
+    EARNED = 'earned'
+    REDEEMED = 'redeemed'
+    ADJUSTED = 'adjusted'
+    RECOMPUTED = 'recomputed'
+    OPENING = 'opening'  # the balance from before the ledger, see recompute_loyalty
+    KIND_CHOICES = (
+        (EARNED, 'Earned'),
+        (REDEEMED, 'Redeemed'),
+        (ADJUSTED, 'Adjusted'),
+        (RECOMPUTED, 'Recomputed'),
+        (OPENING, 'Opening balance'),
+    )
+
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='loyalty_entries')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='loyalty_entries')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    coffees = models.IntegerField(default=0, help_text="Change of the coffees counted towards a free one")
+    free_drinks = models.IntegerField(default=0, help_text="Change of the free coffees")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = 'Loyalty entries'
+
+    def __str__(self):
+        return f"{self.customer} {self.kind}: {self.coffees:+} / {self.free_drinks:+} free"
+
+    @classmethod
+    def record(cls, customer, kind, coffees=0, free_drinks=0, order=None):
+        """
+        Appends an entry and applies it to the customer's balance with a single
+        UPDATE, so concurrent confirmations for the same customer add up.
+        """
+        with transaction.atomic():
+            entry = cls.objects.create(
+                customer=customer, order=order, kind=kind, coffees=coffees, free_drinks=free_drinks,
+            )
+            Customer.objects.filter(pk=customer.pk).update(
+                coffees_count=F('coffees_count') + coffees,
+                coffees_free=F('coffees_free') + free_drinks,
+            )
+        customer.refresh_from_db(fields=['coffees_count', 'coffees_free'])
+        return entry
+
+
+class BotSessionState(models.Model):
+    """
+    Conversation state of a barista in the Telegram bot, see bot.sessions.
+    """
+    user_id = models.BigIntegerField(unique=True)  # Telegram user ID
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True)
+    customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True)
+    awaiting_product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Session {self.user_id}"
+
+
+class TelethonSession(models.Model):
+    """
+    Auth key and data center of a Telethon client, see bot.telethon_session.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    dc_id = models.IntegerField(default=0)
+    server_address = models.CharField(max_length=255, blank=True, null=True)
+    port = models.IntegerField(blank=True, null=True)
+    auth_key = models.BinaryField(blank=True, null=True)
+    takeout_id = models.BigIntegerField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class TelethonEntity(models.Model):
+    """
+    A user or chat the Telethon client has seen, with the access hash needed
+    to message it. `entity_id` is Telethon's marked peer id.
+    """
+    session = models.ForeignKey(TelethonSession, on_delete=models.CASCADE, related_name='entities')
+    entity_id = models.BigIntegerField()
+    access_hash = models.BigIntegerField()
+    username = models.CharField(max_length=100, blank=True, null=True)
+    phone = models.CharField(max_length=32, blank=True, null=True)
+    name = models.CharField(max_length=255, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'Telethon entities'
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'entity_id'], name='unique_telethon_entity'),
+        ]
+        indexes = [
+            models.Index(fields=['session', 'username']),
+        ]
+
+    def __str__(self):
+        return self.name or self.username or str(self.entity_id)
+
+
+class TelethonUpdateState(models.Model):
+    """
+    Where the Telethon client's update stream stopped (`entity_id` 0 is the
+    account's common state, others are channels), so missed updates are fetched
+    after a restart.
+    """
+    session = models.ForeignKey(TelethonSession, on_delete=models.CASCADE, related_name='update_states')
+    entity_id = models.BigIntegerField()
+    pts = models.IntegerField()
+    qts = models.IntegerField()
+    date = models.DateTimeField()
+    seq = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'entity_id'], name='unique_telethon_update_state'),
+        ]
+
+
+class Broadcast(models.Model):
+    """
+    A message to every customer, sent by the send_broadcasts command (see
+    bot.broadcast). Customers are handled in primary key order and
+    last_customer_id is the checkpoint, so an interrupted broadcast resumes
+    after the last customer it saved.
+    """
+    DRAFT = 'draft'
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    DONE = 'done'
+    STATUS_CHOICES = (
+        (DRAFT, 'Draft'),
+        (QUEUED, 'Queued'),
+        (SENDING, 'Sending'),
+        (DONE, 'Done'),
+    )
+
+    text = models.TextField(max_length=4096)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=DRAFT)
+    last_customer_id = models.IntegerField(default=0, editable=False, help_text="Customers up to this id were handled")
+    sent = models.PositiveIntegerField(default=0, editable=False)
+    failed = models.PositiveIntegerField(default=0, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True, editable=False)
+    finished_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    def __str__(self):
+        return f"Broadcast {self.pk}: {self.text[:40]}"
+
 
 class ProductSalesReport(Product):
     class Meta:
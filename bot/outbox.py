@@ -0,0 +1,161 @@
+"""
+Queue of the messages the bots send to customers on their own (order
+confirmations, free coffee notices), so a barista's reply never waits on them.
+
+One background sender delivers them within Telegram's limits: at most
+OUTBOX_GLOBAL_RATE messages a second overall, and one message every
+OUTBOX_CHAT_INTERVAL seconds to the same chat. Messages still waiting for the
+same chat go out together, as one message, when they fit. When Telegram asks
+to slow down (FloodWait, RetryAfter) the sender pauses for as long as asked;
+network errors are retried with exponential backoff, up to OUTBOX_MAX_RETRIES
+times. Any other error drops the message.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .utils import TELEGRAM_MESSAGE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+
+def is_network_error(error):
+    return isinstance(error, (OSError, asyncio.TimeoutError))
+
+
+class Outbox:
+    def __init__(self, send, flood_wait=lambda error: None, is_transient=is_network_error,
+                 rate=None, chat_interval=None, max_retries=None, retry_delay=None):
+        """
+        `send(chat_id, text)` delivers one message. `flood_wait(error)` is the
+        number of seconds Telegram asked to wait if `error` is a flood error,
+        else None, and `is_transient(error)` tells whether sending may be retried.
+        """
+        self.send = send
+        self.flood_wait = flood_wait
+        self.is_transient = is_transient
+        self.rate = rate or settings.OUTBOX_GLOBAL_RATE
+        self.chat_interval = chat_interval if chat_interval is not None else settings.OUTBOX_CHAT_INTERVAL
+        self.max_retries = max_retries if max_retries is not None else settings.OUTBOX_MAX_RETRIES
+        self.retry_delay = retry_delay if retry_delay is not None else settings.OUTBOX_RETRY_DELAY
+        self.sent = 0
+        self.dropped = 0
+        self._chats = {}  # chat id -> deque of (text, attempts)
+        self._ready = []  # heap of (ready at, sequence, chat id), one entry per chat in _chats
+        self._sequence = itertools.count()
+        self._next_send = {}  # chat id -> earliest time of its next message
+        self._last_send = 0.0
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = None
+
+    @property
+    def pending(self):
+        return sum(len(queue) for queue in self._chats.values())
+
+    def notify(self, chat_id, text):
+        """
+        Queues `text` for `chat_id` and returns at once.
+        """
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+            ready_at = max(time.monotonic(), self._next_send.pop(chat_id, 0.0))
+            heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+        queue.append((text, 0))
+        self._idle.clear()
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    async def close(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for the queued messages to go out, then
+        stops the sender.
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox closed with %d unsent messages", self.pending)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            ready_at, _, chat_id = self._ready[0]
+            start_at = max(ready_at, self._paused_until, self._last_send + 1 / self.rate)
+            delay = start_at - time.monotonic()
+            if delay > 0:
+                # Woken up early if a message for another chat comes in meanwhile
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._ready)
+            try:
+                await self._deliver(chat_id)
+            except Exception:
+                logger.exception("Outbox failed on chat %s", chat_id)
+
+    def _coalesce(self, queue):
+        text, attempts = queue.popleft()
+        while queue and len(text) + 2 + len(queue[0][0]) <= TELEGRAM_MESSAGE_LIMIT:
+            next_text, next_attempts = queue.popleft()
+            text = f"{text}\n\n{next_text}"
+            attempts = max(attempts, next_attempts)
+        return text, attempts
+
+    async def _deliver(self, chat_id):
+        queue = self._chats[chat_id]
+        text, attempts = self._coalesce(queue)
+        self._last_send = time.monotonic()
+        try:
+            await self.send(chat_id, text)
+        except Exception as error:
+            wait = self.flood_wait(error)
+            if wait is not None:
+                logger.warning("Flood control: outbound messages paused for %ss", wait)
+                self._paused_until = time.monotonic() + wait
+                queue.appendleft((text, attempts))
+                next_send = self._paused_until
+            elif self.is_transient(error) and attempts < self.max_retries:
+                queue.appendleft((text, attempts + 1))
+                next_send = time.monotonic() + self.retry_delay * 2 ** attempts
+            else:
+                logger.warning("Dropped the message to %s: %r", chat_id, error)
+                self.dropped += 1
+                next_send = time.monotonic() + self.chat_interval
+        else:
+            self.sent += 1
+            next_send = time.monotonic() + self.chat_interval
+
+        if queue:
+            heapq.heappush(self._ready, (next_send, next(self._sequence), chat_id))
+            return
+
+        del self._chats[chat_id]
+        self._next_send[chat_id] = next_send
+        if len(self._next_send) > 1000:
+            now = time.monotonic()
+            self._next_send = {chat: at for chat, at in self._next_send.items() if at > now}
+        if not self._chats:
+            self._idle.set()
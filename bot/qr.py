@@ -0,0 +1,75 @@
+"""
+QR codes of the customers' loyalty cards. A code never changes for the data
+it encodes, so it is rendered once, in a worker thread, and its PNG kept in an
+in-process LRU and, if QR_CACHE_DIR is set, on disk across restarts. Both are
+keyed by the encoded data: the two bots encode different links for the same
+user under the same bot username.
+"""
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .utils import qr_code_link, qr_file, render_qr_png
+
+
+class QRCodeCache:
+    def __init__(self, max_entries=None, directory=None):
+        self.max_entries = max_entries if max_entries is not None else settings.QR_CACHE_SIZE
+        self.directory = directory if directory is not None else settings.QR_CACHE_DIR
+        self._images = OrderedDict()
+        self._rendering = {}
+
+    def _path(self, data):
+        return os.path.join(self.directory, f'{hashlib.sha256(data.encode()).hexdigest()}.png')
+
+    def _load_or_render(self, data):
+        if self.directory:
+            try:
+                with open(self._path(data), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+
+        png = render_qr_png(data)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f'{self._path(data)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, self._path(data))
+        return png
+
+    def _remember(self, data, png):
+        self._images[data] = png
+        self._images.move_to_end(data)
+        while len(self._images) > self.max_entries:
+            self._images.popitem(last=False)
+
+    async def get_png(self, bot_username, user_id, data=None):
+        """
+        PNG bytes of the QR code of `user_id`, encoding `data` (by default the
+        /start link of the Telethon bot).
+        """
+        data = data or qr_code_link(bot_username, user_id)
+        if data in self._images:
+            self._images.move_to_end(data)
+            return self._images[data]
+
+        # Concurrent requests for the same code share a single render
+        task = self._rendering.get(data)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(self._load_or_render, data))
+            self._rendering[data] = task
+            task.add_done_callback(lambda _: self._rendering.pop(data, None))
+        png = await task
+        self._remember(data, png)
+        return png
+
+    async def get_file(self, bot_username, user_id, data=None):
+        return qr_file(await self.get_png(bot_username, user_id, data))
+
+
+qr_codes = QRCodeCache()
@@ -0,0 +1,86 @@
+"""
+Clean-up of carts that were started but never confirmed. Both bots create a
+pending order on the first tap, and a cart the barista walks away from would
+otherwise stay in every admin list and report forever.
+
+A cart's age is counted from its last change, so one still being filled in
+is never reaped. The bonus bot's orders are selected by bonus.reaper.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order
+from .utils import to_business_date
+
+logger = logging.getLogger(__name__)
+
+
+def pending_cutoff(max_age):
+    return timezone.now() - timedelta(seconds=max_age)
+
+
+def stale_pending_orders(max_age):
+    """
+    Pending orders left unchanged for more than `max_age` seconds.
+    """
+    cutoff = pending_cutoff(max_age)
+    # An order changed before the cutoff was also created before it, so the
+    # business_date bound lets the (status, business_date) index do the work
+    return Order.objects.filter(
+        status='pending', business_date__lte=to_business_date(cutoff), updated_at__lt=cutoff,
+    )
+
+
+def reap_orders(queryset, batch_size=500, cancel=False):
+    """
+    Deletes the orders of `queryset`, or marks them cancelled, `batch_size` at a
+    time, each batch in its own transaction. Returns the ids of the reaped orders.
+    """
+    reaped = []
+    while True:
+        order_ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not order_ids:
+            break
+
+        with transaction.atomic():
+            # Checked again under the lock: a cart confirmed or changed since
+            # it was picked is not stale any more
+            order_ids = list(
+                queryset.filter(pk__in=order_ids).select_for_update().values_list('pk', flat=True)
+            )
+            batch = queryset.model.objects.filter(pk__in=order_ids)
+            if cancel:
+                batch.update(status='cancelled')
+            else:
+                batch.delete()
+        reaped += order_ids
+    return reaped
+
+
+async def reap_periodically(stale_orders, on_reaped=None):
+    """
+    Reaps `stale_orders(max_age)` every PENDING_ORDER_REAP_INTERVAL seconds,
+    for as long as the bot runs. `on_reaped(order_ids)` is awaited after each
+    pass that removed something, so the bot can drop those carts from its state.
+    """
+    cancel = settings.PENDING_ORDER_REAP_ACTION == 'cancel'
+    while True:
+        await asyncio.sleep(settings.PENDING_ORDER_REAP_INTERVAL)
+        try:
+            order_ids = await sync_to_async(reap_orders)(
+                stale_orders(settings.PENDING_ORDER_MAX_AGE),
+                batch_size=settings.PENDING_ORDER_REAP_BATCH_SIZE,
+                cancel=cancel,
+            )
+            if order_ids:
+                logger.info("Reaped %d abandoned pending orders", len(order_ids))
+                if on_reaped:
+                    await on_reaped(order_ids)
+        except Exception:
+            logger.exception("Reaping pending orders failed")
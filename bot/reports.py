@@ -0,0 +1,24 @@
+from collections import namedtuple
+
+from .models import Order
+
+OrderSummary = namedtuple('OrderSummary', ['order_id', 'items', 'total'])
+
+
+def daily_orders_report(day):
+    """
+    Summaries of the orders created on `day` and their total, built from a
+    single query over the orders joined with their items.
+    """
+    rows = Order.objects.filter(business_date=day).order_by('id', 'items__id').values_list(
+        'id', 'subtotal', 'free_discount', 'items__quantity', 'items__product__name',
+    )
+
+    summaries = []
+    for order_id, subtotal, free_discount, quantity, product_name in rows:
+        if not summaries or summaries[-1].order_id != order_id:
+            summaries.append(OrderSummary(order_id, [], subtotal - free_discount))
+        if product_name is not None:
+            summaries[-1].items.append(f"{product_name} x {quantity}")
+
+    return summaries, sum(summary.total for summary in summaries)
@@ -0,0 +1,169 @@
+"""
+Per-barista conversation state of the Telegram bot: the cart being built, the
+scanned customer, the product waiting for a typed quantity and the last cart
+message. Only ids are kept, never ORM instances.
+
+The backend is chosen with the BOT_SESSION_STORE setting:
+
+- MemorySessionStore keeps the state in the bot process, bounded by
+  BOT_SESSION_MAX_ENTRIES and expired after BOT_SESSION_TTL seconds.
+- DatabaseSessionStore keeps it in the BotSessionState table, so carts survive
+  restarts and several bot processes can share them.
+"""
+import abc
+import dataclasses
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import BotSessionState
+
+
+@dataclass
+class SessionState:
+    user_id: int
+    order_id: Optional[int] = None
+    customer_id: Optional[int] = None
+    awaiting_product_id: Optional[int] = None
+    last_message_id: Optional[int] = None
+
+    def is_empty(self):
+        return not any((self.order_id, self.customer_id, self.awaiting_product_id, self.last_message_id))
+
+
+class BaseSessionStore(abc.ABC):
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else settings.BOT_SESSION_TTL
+        self.max_entries = max_entries if max_entries is not None else settings.BOT_SESSION_MAX_ENTRIES
+
+    @abc.abstractmethod
+    async def get(self, user_id):
+        """Returns the state of `user_id`, empty if there is none."""
+
+    @abc.abstractmethod
+    async def save(self, state):
+        """Stores `state`; an empty state is removed."""
+
+    @abc.abstractmethod
+    async def clear(self, user_id):
+        """Removes the state of `user_id`."""
+
+    @abc.abstractmethod
+    async def forget_orders(self, order_ids):
+        """Drops `order_ids` from every session, once those carts are gone; sessions left empty are removed."""
+
+    async def warm_up(self):
+        """
+        Prepares the store at bot startup. Returns the sessions with a cart in
+        progress that the store kept across the restart.
+        """
+        return []
+
+
+class MemorySessionStore(BaseSessionStore):
+    """
+    In-process LRU with a TTL. Entries are evicted once idle for `ttl` seconds
+    or when more than `max_entries` users hold state.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        super().__init__(ttl, max_entries)
+        self._states = OrderedDict()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._states:
+            touched_at, _ = next(iter(self._states.values()))
+            if len(self._states) <= self.max_entries and now - touched_at < self.ttl:
+                break
+            self._states.popitem(last=False)
+
+    async def get(self, user_id):
+        self._evict()
+        entry = self._states.pop(user_id, None)
+        if entry is None:
+            return SessionState(user_id)
+        self._states[user_id] = (time.monotonic(), entry[1])
+        return dataclasses.replace(entry[1])
+
+    async def save(self, state):
+        self._states.pop(state.user_id, None)
+        if not state.is_empty():
+            self._states[state.user_id] = (time.monotonic(), dataclasses.replace(state))
+        self._evict()
+
+    async def clear(self, user_id):
+        self._states.pop(user_id, None)
+
+    async def forget_orders(self, order_ids):
+        order_ids = set(order_ids)
+        for user_id, (touched_at, state) in list(self._states.items()):
+            if state.order_id in order_ids:
+                state.order_id = None
+                if state.is_empty():
+                    del self._states[user_id]
+
+
+class DatabaseSessionStore(BaseSessionStore):
+    """
+    State stored in BotSessionState rows. A row idle for longer than `ttl`
+    seconds is dropped when it is next read.
+    """
+    FIELDS = ('order_id', 'customer_id', 'awaiting_product_id', 'last_message_id')
+
+    def _get(self, user_id):
+        row = BotSessionState.objects.filter(user_id=user_id).values('updated_at', *self.FIELDS).first()
+        if row and row.pop('updated_at') < timezone.now() - timedelta(seconds=self.ttl):
+            BotSessionState.objects.filter(user_id=user_id).delete()
+            row = None
+        return SessionState(user_id, **(row or {}))
+
+    def _save(self, state):
+        if state.is_empty():
+            BotSessionState.objects.filter(user_id=state.user_id).delete()
+            return
+        BotSessionState.objects.update_or_create(
+            user_id=state.user_id,
+            defaults={field: getattr(state, field) for field in self.FIELDS},
+        )
+
+    async def get(self, user_id):
+        return await sync_to_async(self._get)(user_id)
+
+    async def save(self, state):
+        await sync_to_async(self._save)(state)
+
+    async def clear(self, user_id):
+        await sync_to_async(BotSessionState.objects.filter(user_id=user_id).delete)()
+
+    @staticmethod
+    def _forget_orders(order_ids):
+        with transaction.atomic():
+            BotSessionState.objects.filter(order_id__in=order_ids).update(order=None)
+            # Also the rows whose order was deleted, which the foreign key set to NULL
+            BotSessionState.objects.filter(
+                order__isnull=True, customer__isnull=True, awaiting_product__isnull=True, last_message_id__isnull=True,
+            ).delete()
+
+    async def forget_orders(self, order_ids):
+        await sync_to_async(self._forget_orders)(list(order_ids))
+
+    def _warm_up(self):
+        BotSessionState.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=self.ttl)).delete()
+        rows = BotSessionState.objects.filter(order__status='pending').values('user_id', *self.FIELDS)
+        return [SessionState(**row) for row in rows]
+
+    async def warm_up(self):
+        return await sync_to_async(self._warm_up)()
+
+
+def get_session_store():
+    return import_string(settings.BOT_SESSION_STORE)()
@@ -0,0 +1,243 @@
+"""
+Telethon session kept in the project database instead of a `.session`
+SQLite file, so the bot's auth key and its cache of users and their access
+hashes survive restarts and can be shared by several bot processes.
+
+Telethon calls its session synchronously from inside the event loop, where
+the ORM may not be used. DatabaseSession therefore answers from memory only:
+the stored session and all its entities are loaded when it is created, before
+the client connects, and changes are written behind on a dedicated thread.
+An entity missing from memory may have been seen by another process since;
+it is looked up on that thread without waiting, so a later call finds it, and
+a lookup that found nothing is not repeated for ENTITY_MISS_TTL seconds.
+
+The first time a name is used, an existing `<name>.session` file is imported,
+so the users the bot already knew are not lost.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, connections
+from telethon import utils
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
+from telethon.tl import types
+
+from .models import TelethonEntity, TelethonSession, TelethonUpdateState
+
+logger = logging.getLogger(__name__)
+
+ENTITY_FIELDS = ('entity_id', 'access_hash', 'username', 'phone', 'name')
+ENTITY_MISS_TTL = 60
+
+
+class DatabaseSession(MemorySession):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self._by_id = {}  # marked id -> (id, hash, username, phone, name)
+        self._by_username = {}
+        self._by_phone = {}
+        self._missed = {}  # entity lookup -> when it last found nothing
+        self._db = ThreadPoolExecutor(max_workers=1, thread_name_prefix='telethon-session')
+        self._session_id = self._run(self._load)
+
+    # Database thread
+
+    def _run(self, function, *args):
+        return self._db.submit(self._call, function, *args).result()
+
+    def _write(self, function, *args):
+        self._db.submit(self._call, function, *args).add_done_callback(self._write_done)
+
+    @staticmethod
+    def _call(function, *args):
+        close_old_connections()
+        return function(*args)
+
+    @staticmethod
+    def _write_done(future):
+        if future.exception() is not None:
+            logger.error("Could not save the Telethon session", exc_info=future.exception())
+
+    def _load(self):
+        session, created = TelethonSession.objects.get_or_create(name=self.name)
+        if created and os.path.exists(f'{self.name}.session'):
+            self._import_file(session, f'{self.name}.session')
+
+        self._dc_id = session.dc_id
+        self._server_address = session.server_address
+        self._port = session.port
+        self._auth_key = AuthKey(bytes(session.auth_key)) if session.auth_key else None
+        self._takeout_id = session.takeout_id
+        for row in session.entities.values_list(*ENTITY_FIELDS).iterator():
+            self._remember(row)
+        for state in session.update_states.all():
+            self._update_states[state.entity_id] = types.updates.State(
+                state.pts, state.qts, state.date, state.seq, unread_count=0,
+            )
+        return session.pk
+
+    @staticmethod
+    def _import_file(session, path):
+        with sqlite3.connect(path) as db:
+            row = db.execute('select dc_id, server_address, port, auth_key, takeout_id from sessions').fetchone()
+            if row:
+                session.dc_id, session.server_address, session.port, session.auth_key, session.takeout_id = row
+                session.save()
+            rows = db.execute('select id, hash, username, phone, name from entities').fetchall()
+            states = db.execute('select id, pts, qts, date, seq from update_state').fetchall()
+        TelethonEntity.objects.bulk_create(
+            [TelethonEntity(session=session, **dict(zip(ENTITY_FIELDS, row))) for row in rows],
+            batch_size=1000,
+        )
+        TelethonUpdateState.objects.bulk_create([
+            TelethonUpdateState(
+                session=session, entity_id=entity_id, pts=pts, qts=qts, seq=seq,
+                date=datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc),
+            )
+            for entity_id, pts, qts, date, seq in states
+        ])
+        logger.info("Imported %s: %d entities", path, len(rows))
+
+    def _save_session(self, values):
+        TelethonSession.objects.filter(pk=self._session_id).update(**values)
+
+    def _save_entities(self, rows):
+        TelethonEntity.objects.bulk_create(
+            [TelethonEntity(session_id=self._session_id, **dict(zip(ENTITY_FIELDS, row))) for row in rows],
+            update_conflicts=True,
+            unique_fields=['session', 'entity_id'],
+            update_fields=['access_hash', 'username', 'phone', 'name', 'updated_at'],
+        )
+
+    def _save_update_state(self, entity_id, state):
+        TelethonUpdateState.objects.update_or_create(
+            session_id=self._session_id, entity_id=entity_id,
+            defaults={'pts': state.pts, 'qts': state.qts, 'date': state.date, 'seq': state.seq},
+        )
+
+    def _fetch_entity(self, lookup):
+        return TelethonEntity.objects.filter(session_id=self._session_id, **lookup).values_list(*ENTITY_FIELDS).first()
+
+    # Session
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._write(self._save_session, {'dc_id': self._dc_id, 'server_address': server_address, 'port': port})
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._write(self._save_session, {'auth_key': value.key if value else None})
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._write(self._save_session, {'takeout_id': value})
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        self._write(self._save_update_state, entity_id, state)
+
+    def clone(self, to_instance=None):
+        # Used for connections to other data centers, which keep their own auth key
+        return to_instance or MemorySession()
+
+    def save(self):
+        self._run(lambda: None)  # waits for the writes queued so far
+
+    def close(self):
+        self.save()
+        self._run(connections.close_all)
+        self._db.shutdown()
+
+    def delete(self):
+        self._run(TelethonSession.objects.filter(pk=self._session_id).delete)
+
+    # Entities
+
+    def _remember(self, row):
+        entity_id, _, username, phone, _ = row
+        self._by_id[entity_id] = row
+        if username:
+            self._by_username[username] = row
+        if phone:
+            self._by_phone[phone] = row
+        return row
+
+    def process_entities(self, tlo):
+        changed = [row for row in self._entities_to_rows(tlo) if self._by_id.get(row[0]) != row]
+        if changed:
+            for row in changed:
+                self._remember(row)
+            self._write(self._save_entities, changed)
+
+    def _lookup(self, cache, key, **lookup):
+        row = cache.get(key)
+        if row is None:
+            self._fetch_later(lookup)
+        return row[:2] if row else None
+
+    def _fetch_later(self, lookup):
+        key = tuple(sorted(lookup.items()))
+        now = time.monotonic()
+        if now - self._missed.get(key, -ENTITY_MISS_TTL) < ENTITY_MISS_TTL:
+            return
+        if len(self._missed) > 10000:
+            self._missed = {missed: at for missed, at in self._missed.items() if now - at < ENTITY_MISS_TTL}
+        self._missed[key] = now
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        self._db.submit(self._call, self._fetch_entity, lookup).add_done_callback(
+            lambda future: self._fetched(future, key, loop)
+        )
+
+    def _fetched(self, future, key, loop):
+        if future.exception() is not None:
+            logger.error("Could not look up a Telethon entity", exc_info=future.exception())
+            return
+        row = future.result()
+        if row is None:
+            return
+        if loop is None or loop.is_closed():
+            self._found(key, row)
+        else:
+            # The caches are only changed on the event loop's thread
+            loop.call_soon_threadsafe(self._found, key, row)
+
+    def _found(self, key, row):
+        self._missed.pop(key, None)
+        self._remember(row)
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        if exact:
+            return self._lookup(self._by_id, id, entity_id=id)
+        ids = (
+            utils.get_peer_id(types.PeerUser(id)),
+            utils.get_peer_id(types.PeerChat(id)),
+            utils.get_peer_id(types.PeerChannel(id)),
+        )
+        for marked_id in ids:
+            if marked_id in self._by_id:
+                return self._by_id[marked_id][:2]
+        return self._lookup({}, None, entity_id__in=ids)
+
+    def get_entity_rows_by_username(self, username):
+        return self._lookup(self._by_username, username, username=username)
+
+    def get_entity_rows_by_phone(self, phone):
+        return self._lookup(self._by_phone, phone, phone=phone)
+
+    def get_entity_rows_by_name(self, name):
+        for entity_id, access_hash, _, _, found_name in self._by_id.values():
+            if found_name == name:
+                return entity_id, access_hash
+        return None
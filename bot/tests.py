@@ -1,3 +1,1186 @@
-from django.test import TestCase
+import asyncio
+import os
+import re
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from importlib import import_module
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F, ProtectedError, Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from telethon import TelegramClient, events
+from telethon.errors import FileReferenceExpiredError, MessageNotModifiedError
+from telethon.sessions import MemorySession
+from telethon.tl import types
+from telethon.tl.functions.users import GetUsersRequest
+
+from .admin_utils import daily_series, hourly_series
+from .broadcast import BroadcastSender
+from .carts import CartLine, add_to_cart, confirm_cart, get_cart, use_free_drinks
+from .catalog import catalog
+from .customers import customers
+from .dispatch import HIGH, LOW, NORMAL, OrderedDispatcher
+from .keyboards import KeyboardCache
+from .management.commands.run_telegram_bot import Command as TelegramBotCommand
+from .management.commands.run_telegram_bot import RelayedClient, pack_result, read_tl, update_user_id
+from .outbox import Outbox
+from .qr import QRCodeCache, qr_codes
+from .reaper import reap_orders, stale_pending_orders
+from .reports import daily_orders_report
+from .sessions import DatabaseSessionStore, MemorySessionStore, SessionState
+from .telethon_session import DatabaseSession
+from .utils import TELEGRAM_MESSAGE_LIMIT, business_timezone, split_message, to_business_date
+from .workers import Channel, WorkerLink, WorkerPool
+from .models import (
+    BotSessionState, Broadcast, Category, Product, ProductDailySales, Customer, LoyaltyEntry, Order, OrderItem,
+)
+
+
+class CatalogTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.coffee = Category.objects.create(name='Coffee')
+        cls.latte = Product.objects.create(category=cls.coffee, name='Latte', price='30.00', is_coffee=True)
+        cls.espresso = Product.objects.create(category=cls.coffee, name='Espresso', price='24.00', is_coffee=True)
+
+    def setUp(self):
+        catalog.invalidate()
+
+    def test_snapshot_is_reused_without_queries(self):
+        snapshot = catalog.snapshot()
+        with self.assertNumQueries(0):
+            self.assertIs(catalog.snapshot(), snapshot)
+        self.assertEqual([product.name for product in snapshot.category_products(self.coffee.id)], ['Latte', 'Espresso'])
+        self.assertEqual(snapshot.category_products(0), [])
+
+    def test_saving_a_product_rebuilds_the_snapshot(self):
+        snapshot = catalog.snapshot()
+        self.espresso.price = '26.00'
+        self.espresso.save()
+
+        rebuilt = catalog.snapshot()
+        self.assertGreater(rebuilt.version, snapshot.version)
+        self.assertEqual(rebuilt.products[self.espresso.id].price, Decimal('26.00'))
+        self.assertEqual(snapshot.products[self.espresso.id].price, Decimal('24.00'))
+
+    def test_snapshot_older_than_max_age_is_reloaded(self):
+        snapshot = catalog.snapshot()
+        with self.settings(CATALOG_MAX_AGE=0):
+            self.assertIsNot(catalog.snapshot(), snapshot)
+
+
+class CustomerCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(user_id=2, first_name='Ion', coffees_count=3)
+
+    def setUp(self):
+        customers.invalidate(self.customer.user_id)
+
+    def test_entry_is_dropped_once_the_ledger_change_commits(self):
+        customers._load(self.customer.user_id)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            LoyaltyEntry.record(self.customer, LoyaltyEntry.EARNED, coffees=1)
+            # A read before the commit caches the row as it was
+            customers._load(self.customer.user_id)
+            self.assertIsNotNone(customers.peek(self.customer.user_id))
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertIsNone(customers.peek(self.customer.user_id))
+        self.assertEqual(customers._load(self.customer.user_id).coffees_count, 4)
+
+    def test_baristas_keep_high_priority_once_their_entry_expires(self):
+        self.addCleanup(customers._load_baristas)
+        with self.captureOnCommitCallbacks(execute=True):
+            barista = Customer.objects.create(user_id=3, first_name='Ana', role=Customer.BARISTA)
+        customers._load(barista.user_id)
+        loaded_at, customer = customers._customers[barista.user_id]
+        customers._customers[barista.user_id] = (loaded_at - customers.ttl, customer)
+        command = TelegramBotCommand()
+
+        self.assertIsNone(customers.peek(barista.user_id))
+        self.assertEqual(command.update_priority(FakeEvent(barista.user_id)), HIGH)
+        self.assertEqual(command.update_priority(FakeEvent(self.customer.user_id)), LOW)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            barista.role = 'customer'
+            barista.save()
+        self.assertEqual(command.update_priority(FakeEvent(barista.user_id)), LOW)
+        customers._load_baristas()
+        self.assertFalse(customers.is_barista(barista.user_id))
+
+
+class KeyboardCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.coffee = Category.objects.create(name='Coffee')
+        cls.products = [
+            Product.objects.create(category=cls.coffee, name=f'Coffee {i}', price='20.00') for i in range(5)
+        ]
+
+    def setUp(self):
+        catalog.invalidate()
+        self.keyboards = KeyboardCache(
+            catalog, lambda text, data: (text, data), lambda rows: rows, footer=[('Înapoi', 'back')], page_size=2,
+        )
+
+    async def test_pages_are_built_once_per_snapshot(self):
+        first = await self.keyboards.category_page(self.coffee.id)
+        self.assertEqual(first.markup, [
+            [('Coffee 0 - 20.00 MDL', f'product_{self.products[0].id}')],
+            [('Coffee 1 - 20.00 MDL', f'product_{self.products[1].id}')],
+            [('Înainte ➡️', f'category_{self.coffee.id}_1')],
+            [('Înapoi', 'back')],
+        ])
+        self.assertIs(await self.keyboards.category_page(self.coffee.id), first)
+
+        last = await self.keyboards.category_page(self.coffee.id, 99)
+        self.assertEqual((last.page, last.pages, last.product_count), (2, 3, 5))
+        self.assertEqual(last.markup[-2], [('⬅️ Înapoi', f'category_{self.coffee.id}_1')])
+        self.assertIsNone(await self.keyboards.category_page(0))
+
+    async def test_changing_a_product_rebuilds_the_pages(self):
+        first = await self.keyboards.category_page(self.coffee.id)
+        self.products[0].name = 'Ristretto'
+        await sync_to_async(self.products[0].save)()
+
+        rebuilt = await self.keyboards.category_page(self.coffee.id)
+        self.assertIsNot(rebuilt, first)
+        self.assertEqual(rebuilt.markup[0], [('Ristretto - 20.00 MDL', f'product_{self.products[0].id}')])
+
+
+class OrderAdminChangelistTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        coffee = Category.objects.create(name='Coffee')
+        drinks = Category.objects.create(name='Drinks')
+        cls.products = [
+            Product.objects.create(category=coffee, name='Espresso', price='24.00', is_coffee=True),
+            Product.objects.create(category=coffee, name='Cappuccino', price='28.00', is_coffee=True),
+            Product.objects.create(category=drinks, name='Lemonade', price='35.00'),
+        ]
+        cls.barista = Customer.objects.create(user_id=1, username='barista', first_name='Ana', role=Customer.BARISTA)
+
+    def create_orders(self, count):
+        for i in range(count):
+            customer = Customer.objects.create(user_id=1000 + Order.objects.count(), first_name=f'Client {i}')
+            order = Order.objects.create(user_created=self.barista, customer=customer, free_drinks=i % 2)
+            for product in self.products:
+                order.add_item(product.id, 2)
+
+    def changelist_queries(self):
+        self.client.force_login(self.admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:bot_order_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.create_orders(3)
+        small_page = self.changelist_queries()
+
+        self.create_orders(47)
+        full_page = self.changelist_queries()
+
+        self.assertEqual(small_page, full_page)
+        self.assertLessEqual(full_page, 20)
+
+    def test_totals_match_order_pricing_after_a_price_change(self):
+        self.create_orders(4)
+        Product.objects.filter(pk=self.products[0].pk).update(price='30.00')
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:bot_order_changelist'))
+
+        model_admin = response.context_data['cl'].model_admin
+        result_list = response.context_data['cl'].result_list
+        pricing = Order.objects.filter(pk__in=[order.pk for order in result_list]).pricing()
+        for order in result_list:
+            price = pricing[order.pk]
+            self.assertEqual(model_admin.order_total(order), '{:.2f}'.format(order.total_price()[0]))
+            self.assertEqual(order.total_price()[0], price.subtotal - price.free_discount)
+
+
+class OrderTotalsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        coffee = Category.objects.create(name='Coffee')
+        cls.espresso = Product.objects.create(category=coffee, name='Espresso', price='24.00', is_coffee=True)
+
+    def test_removing_a_line_after_a_price_change_takes_off_what_it_added(self):
+        order = Order.objects.create()
+        item = order.add_item(self.espresso.id, 2)
+        Product.objects.filter(pk=self.espresso.pk).update(price='30.00')
+
+        order.add_item(self.espresso.id, 1)
+        order.refresh_from_db()
+        self.assertEqual((order.subtotal, order.coffee_count), (Decimal('72.00'), 3))
+
+        OrderItem.objects.get(pk=item.pk).delete()
+        order.refresh_from_db()
+        self.assertEqual((order.subtotal, order.coffee_count), (0, 0))
+
+    def test_pricing_agrees_with_the_stored_totals(self):
+        lemonade = Product.objects.create(category=self.espresso.category, name='Lemonade', price='35.00')
+        for free_drinks in (0, 1, 3, 5):
+            order = Order.objects.create(free_drinks=free_drinks)
+            order.add_item(self.espresso.id, 2)
+            order.add_item(lemonade.id, 1)
+            Product.objects.filter(pk=self.espresso.pk).update(price='30.00')
+            order.add_item(Product.objects.create(
+                category=self.espresso.category, name=f'Latte {free_drinks}', price='28.00', is_coffee=True,
+            ).id, 1)
+            Product.objects.filter(pk=self.espresso.pk).update(price='24.00')
+
+        pricing = Order.objects.pricing()
+        for order in Order.objects.all():
+            price = pricing[order.pk]
+            with self.subTest(free_drinks=order.free_drinks):
+                self.assertEqual(
+                    (price.subtotal, price.coffee_count, price.free_discount, price.used_free),
+                    (order.subtotal, order.coffee_count, order.free_discount, order.used_free),
+                )
+                self.assertEqual(order.total_price(), (price.subtotal - price.free_discount, price.used_free))
+
+    def test_bulk_item_changes_keep_the_totals(self):
+        order = Order.objects.create()
+        order.add_item(self.espresso.id, 2)
+
+        OrderItem.objects.filter(order=order).update(quantity=3)
+        order.refresh_from_db()
+        self.assertEqual((order.subtotal, order.coffee_count), (Decimal('72.00'), 3))
+
+        OrderItem.objects.filter(order=order).delete()
+        order.refresh_from_db()
+        self.assertEqual((order.subtotal, order.coffee_count), (0, 0))
+
+    def test_a_sold_product_cannot_be_deleted(self):
+        Order.objects.create().add_item(self.espresso.id, 1)
+        with self.assertRaises(ProtectedError):
+            Product.objects.get(pk=self.espresso.pk).delete()
+
+    def test_open_carts_follow_a_change_of_is_coffee(self):
+        cart = Order.objects.create()
+        cart.add_item(self.espresso.id, 2)
+        confirmed = Order.objects.create()
+        confirmed.add_item(self.espresso.id, 1)
+        confirmed.status = 'confirmed'
+        confirmed.save()
+
+        product = Product.objects.get(pk=self.espresso.pk)
+        product.is_coffee = False
+        product.save()
+
+        cart.refresh_from_db()
+        confirmed.refresh_from_db()
+        self.assertEqual((cart.coffee_count, confirmed.coffee_count), (0, 1))
+
+
+class SalesRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        coffee = Category.objects.create(name='Coffee')
+        cls.espresso = Product.objects.create(category=coffee, name='Espresso', price='24.00', is_coffee=True)
+        cls.latte = Product.objects.create(category=coffee, name='Latte', price='30.00', is_coffee=True)
+
+    def assertRollupMatchesOrders(self):
+        live = OrderItem.objects.filter(order__status='confirmed').values('product_id', 'order__business_date').annotate(
+            total_quantity=Sum('quantity'), total_revenue=Sum(F('quantity') * F('unit_price')),
+        ).order_by()
+        self.assertEqual(
+            {(row.product_id, row.business_date): (row.quantity, row.revenue) for row in ProductDailySales.objects.all()},
+            {
+                (row['product_id'], row['order__business_date']): (row['total_quantity'], row['total_revenue'])
+                for row in live
+            },
+        )
+
+    def confirmed_order(self):
+        order = Order.objects.create()
+        order.add_item(self.espresso.id, 2)
+        order.add_item(self.latte.id, 1)
+        order.status = 'confirmed'
+        order.save()
+        self.assertRollupMatchesOrders()
+        return order
+
+    def test_rollup_follows_confirm_and_cancel(self):
+        order = self.confirmed_order()
+        self.assertTrue(ProductDailySales.objects.exists())
+
+        order.status = 'cancelled'
+        order.save()
+        self.assertRollupMatchesOrders()
+        self.assertFalse(ProductDailySales.objects.exists())
+
+    def test_rollup_follows_item_edits_of_a_confirmed_order(self):
+        order = self.confirmed_order()
+        espresso, latte = OrderItem.objects.filter(order=order).order_by('pk')
+
+        espresso.quantity = 3
+        espresso.save()
+        self.assertRollupMatchesOrders()
+        latte.delete()
+        self.assertRollupMatchesOrders()
+        OrderItem(order=Order.objects.get(pk=order.pk), product=self.latte, quantity=2).save()
+        self.assertRollupMatchesOrders()
+        OrderItem.objects.filter(order=order).update(quantity=4)
+        self.assertRollupMatchesOrders()
+
+    def test_rollup_follows_deleted_orders(self):
+        kept = self.confirmed_order()
+        self.confirmed_order()
+        Order.objects.exclude(pk=kept.pk).delete()
+        self.assertRollupMatchesOrders()
+        kept.delete()
+        self.assertFalse(ProductDailySales.objects.exists())
+
+
+class CartTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        coffee = Category.objects.create(name='Coffee')
+        drinks = Category.objects.create(name='Drinks')
+        cls.espresso = Product.objects.create(category=coffee, name='Espresso', price='24.00', is_coffee=True)
+        cls.lemonade = Product.objects.create(category=drinks, name='Lemonade', price='35.00')
+        cls.barista = Customer.objects.create(user_id=1, first_name='Ana', role=Customer.BARISTA)
+        cls.customer = Customer.objects.create(user_id=2, first_name='Ion', coffees_count=4)
+
+    def test_adding_merges_lines_and_confirming_earns_a_free_coffee(self):
+        cart = add_to_cart(None, self.espresso.id, 1, self.barista.user_id)
+        cart = add_to_cart(cart.order_id, self.lemonade.id, 1, self.barista.user_id)
+        cart = add_to_cart(cart.order_id, self.espresso.id, 1, self.barista.user_id)
+        self.assertEqual(cart.lines, [
+            CartLine('Espresso', Decimal('24.00'), 2), CartLine('Lemonade', Decimal('35.00'), 1),
+        ])
+        self.assertEqual((cart.total, cart.coffee_count), (Decimal('83.00'), 2))
+
+        confirmed = confirm_cart(cart.order_id, self.customer.pk, coffee_limit=5)
+
+        self.assertEqual((confirmed.customer_user_id, confirmed.earned_free), (2, 1))
+        self.customer.refresh_from_db()
+        self.assertEqual((self.customer.coffees_count, self.customer.coffees_free), (1, 1))
+        self.assertEqual(Order.objects.get(pk=cart.order_id).total_paid, Decimal('83.00'))
+        self.assertIsNone(get_cart(cart.order_id))
+        self.assertIsNone(confirm_cart(cart.order_id, self.customer.pk))
+
+    def test_free_drinks_are_redeemed_on_confirmation(self):
+        Customer.objects.filter(pk=self.customer.pk).update(coffees_free=1)
+        cart = add_to_cart(None, self.espresso.id, 1, self.barista.user_id)
+        cart = use_free_drinks(cart.order_id, self.customer.pk)
+        self.assertEqual((cart.total, cart.used_free), (0, 1))
+
+        confirm_cart(cart.order_id, self.customer.pk, coffee_limit=5)
+
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.coffees_free, 0)
+        self.assertEqual(
+            list(LoyaltyEntry.objects.values_list('kind', 'free_drinks')), [(LoyaltyEntry.REDEEMED, -1)],
+        )
+
+    def test_no_free_drinks_leaves_the_cart_alone(self):
+        self.assertIsNone(use_free_drinks(None, self.customer.pk))
+
+
+class QRCodeCacheTests(SimpleTestCase):
+    async def test_codes_of_the_same_user_are_kept_apart_by_their_data(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        order_link = 'https://t.me/zxcbot?start=create_order_7'
+
+        first = QRCodeCache(directory=directory)
+        card = await first.get_png('zxcbot', 7)
+        order = await first.get_png('zxcbot', 7, order_link)
+        self.assertNotEqual(card, order)
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+        # Read back from disk by a new process
+        second = QRCodeCache(directory=directory)
+        with mock.patch('bot.qr.render_qr_png') as render:
+            self.assertEqual(await second.get_png('zxcbot', 7, order_link), order)
+            self.assertEqual(await second.get_png('zxcbot', 7), card)
+        render.assert_not_called()
+
+
+class PhotoClient:
+    def __init__(self, reject=None):
+        self.reject = reject
+        self.sent = []
+
+    async def send_file(self, chat_id, file, caption=None):
+        if self.reject and isinstance(file, types.InputPhoto):
+            raise self.reject
+        self.sent.append(file)
+        return mock.Mock(photo=mock.Mock(id=7, access_hash=8, file_reference=b'\x0c'))
+
+
+class QRFileIdTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(user_id=2, first_name='Ion', qr_file_id='1:2:0a0b')
+
+    def setUp(self):
+        customers.invalidate(self.customer.user_id)
+        self.command = TelegramBotCommand()
+        self.command.bot_username = 'zxcbot'
+        patcher = mock.patch.object(qr_codes, 'get_file', mock.AsyncMock(return_value=b'png'))
+        self.get_file = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def send_qr(self, client):
+        customer = await customers.get(self.customer.user_id)
+        await self.command.send_qr(client, 2, customer, caption="Cod QR")
+        return await Customer.objects.values_list('qr_file_id', flat=True).aget(pk=self.customer.pk)
+
+    async def test_a_stored_photo_is_sent_without_uploading(self):
+        client = PhotoClient()
+
+        self.assertEqual(await self.send_qr(client), '1:2:0a0b')
+        self.assertEqual(client.sent, [types.InputPhoto(1, 2, b'\x0a\x0b')])
+        self.get_file.assert_not_called()
+
+    async def test_a_rejected_photo_is_uploaded_again_and_replaced(self):
+        for error in (ValueError('Invalid file id'), FileReferenceExpiredError(request=None)):
+            with self.subTest(error=type(error).__name__):
+                await Customer.objects.filter(pk=self.customer.pk).aupdate(qr_file_id='1:2:0a0b')
+                customers.invalidate(self.customer.user_id)
+                client = PhotoClient(reject=error)
+
+                with self.assertLogs(level='WARNING'):
+                    self.assertEqual(await self.send_qr(client), '7:8:0c')
+                self.assertEqual(client.sent, [b'png'])
+                self.assertIsNone(customers.peek(self.customer.user_id))
+
+
+class OrderChartTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def order(self, created_at, status='confirmed', total_paid='30.00'):
+        order = Order.objects.create(status=status, total_paid=total_paid)
+        Order.objects.filter(pk=order.pk).update(created_at=created_at, business_date=to_business_date(created_at))
+        order.refresh_from_db()
+        return order
+
+    def test_settled_days_are_served_from_the_cache(self):
+        self.order(timezone.now() - timedelta(days=3))
+        with self.assertNumQueries(2):
+            first = daily_series()
+        with self.assertNumQueries(1):  # the open days only
+            second = daily_series()
+
+        self.assertEqual(first, second)
+        self.assertEqual(first[to_business_date() - timedelta(days=3)], (1, Decimal('30.00')))
+
+    def test_a_cancelled_order_leaves_its_cached_day(self):
+        order = self.order(timezone.now() - timedelta(days=3))
+        daily_series()
+        with self.captureOnCommitCallbacks(execute=True):
+            order.status = 'cancelled'
+            order.save()
+
+        self.assertEqual(daily_series()[order.business_date], (0, 0))
+
+    def test_a_cart_confirmed_late_is_counted_in_its_hour(self):
+        tz = business_timezone()
+        now = datetime(2026, 3, 10, 12, 30, tzinfo=tz)
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            cart = self.order(now - timedelta(hours=2, minutes=40), status='pending')
+            hourly_series()
+            # Confirmed without signals, so only the open hours can show it
+            Order.objects.filter(pk=cart.pk).update(status='confirmed')
+            series = hourly_series()
+
+        self.assertEqual(series[datetime(2026, 3, 10, 9, tzinfo=tz)], (1, Decimal('30.00')))
+
+
+class DailyOrdersReportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        coffee = Category.objects.create(name='Coffee')
+        cls.espresso = Product.objects.create(category=coffee, name='Espresso', price='24.00', is_coffee=True)
+        cls.latte = Product.objects.create(category=coffee, name='Latte', price='30.00', is_coffee=True)
+
+    def test_one_query_gives_every_order_and_the_total(self):
+        first = Order.objects.create()
+        first.add_item(self.espresso.id, 2)
+        first.add_item(self.latte.id, 1)
+        empty = Order.objects.create()
+        free = Order.objects.create(free_drinks=1)
+        free.add_item(self.latte.id, 2)
+
+        with self.assertNumQueries(1):
+            summaries, total = daily_orders_report(to_business_date())
+
+        self.assertEqual([(summary.order_id, summary.items, summary.total) for summary in summaries], [
+            (first.id, ['Espresso x 2', 'Latte x 1'], Decimal('78.00')),
+            (empty.id, [], 0),
+            (free.id, ['Latte x 2'], Decimal('30.00')),
+        ])
+        self.assertEqual(total, Decimal('108.00'))
+
+    def test_long_reports_are_split_under_the_message_limit(self):
+        lines = [f"Comanda {number}: " + 'x' * 100 for number in range(100)]
+        messages = split_message(lines)
+
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(all(len(message) <= TELEGRAM_MESSAGE_LIMIT for message in messages))
+        self.assertEqual(''.join(messages).splitlines(), lines)
+
+
+class BusinessDateTests(TestCase):
+    # 00:30 on 11 March in Chisinau, still 10 March in UTC
+    now = datetime(2026, 3, 10, 22, 30, tzinfo=dt_timezone.utc)
+
+    @classmethod
+    def setUpTestData(cls):
+        coffee = Category.objects.create(name='Coffee')
+        cls.espresso = Product.objects.create(category=coffee, name='Espresso', price='24.00', is_coffee=True)
+        cls.barista = Customer.objects.create(user_id=1, first_name='Ana', role=Customer.BARISTA)
+
+    def setUp(self):
+        customers.invalidate(self.barista.user_id)
+        patcher = mock.patch('django.utils.timezone.now', return_value=self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def order_at(self, created_at):
+        with mock.patch('django.utils.timezone.now', return_value=created_at):
+            order = Order.objects.create(user_created=self.barista)
+        order.add_item(self.espresso.id, 1)
+        return order
+
+    def test_orders_after_local_midnight_belong_to_the_new_day(self):
+        before = self.order_at(self.now - timedelta(hours=1))
+        after = self.order_at(self.now - timedelta(minutes=15))
+
+        self.assertEqual(before.created_at.date(), after.created_at.date())
+        self.assertEqual(before.business_date, datetime(2026, 3, 10).date())
+        self.assertEqual(after.business_date, datetime(2026, 3, 11).date())
+        self.assertEqual(Order.objects.get(pk=after.pk).business_date, after.business_date)
+
+    def test_admin_shows_the_orders_of_the_business_day_by_default(self):
+        self.order_at(self.now - timedelta(hours=1))
+        after = self.order_at(self.now - timedelta(minutes=15))
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+        response = self.client.get(reverse('admin:bot_order_changelist'))
+
+        self.assertEqual(list(response.context_data['cl'].result_list), [after])
+
+    async def test_info_reports_the_orders_of_the_business_day(self):
+        await sync_to_async(self.order_at)(self.now - timedelta(hours=1))
+        after = await sync_to_async(self.order_at)(self.now - timedelta(minutes=15))
+        event = MessageEvent(self.barista.user_id)
+
+        await command_handlers()['info'](event)
+
+        self.assertEqual(event.replies, [
+            f"Comenzile de astăzi:\n#1: Espresso x 1 = {after.subtotal}\n\nTotal azi: {after.subtotal} MDL\n",
+        ])
+
+
+class ReaperTests(TestCase):
+    def test_only_carts_left_unchanged_are_reaped(self):
+        coffee = Category.objects.create(name='Coffee')
+        espresso = Product.objects.create(category=coffee, name='Espresso', price='24.00', is_coffee=True)
+        hours_ago = timezone.now() - timedelta(hours=4)
+        abandoned = Order.objects.create()
+        active = Order.objects.create()
+        confirmed = Order.objects.create(status='confirmed')
+        Order.objects.update(created_at=hours_ago, updated_at=hours_ago)
+
+        active.add_item(espresso.id, 1)
+        reaped = reap_orders(stale_pending_orders(60 * 60))
+
+        self.assertEqual(reaped, [abandoned.pk])
+        self.assertQuerySetEqual(Order.objects.order_by('pk'), [active, confirmed])
+
+    def test_a_cart_confirmed_after_it_was_picked_is_kept(self):
+        atomic = transaction.atomic
+        for cancel in (False, True):
+            with self.subTest(cancel=cancel):
+                hours_ago = timezone.now() - timedelta(hours=4)
+                confirmed_meanwhile = Order.objects.create()
+                abandoned = Order.objects.create()
+                Order.objects.filter(status='pending').update(created_at=hours_ago, updated_at=hours_ago)
+
+                def confirm_first(*args, **kwargs):
+                    Order.objects.filter(pk=confirmed_meanwhile.pk).update(status='confirmed')
+                    return atomic(*args, **kwargs)
+
+                with mock.patch('bot.reaper.transaction.atomic', confirm_first):
+                    reaped = reap_orders(stale_pending_orders(60 * 60), cancel=cancel)
+
+                self.assertEqual(reaped, [abandoned.pk])
+                self.assertEqual(Order.objects.get(pk=confirmed_meanwhile.pk).status, 'confirmed')
+
+
+class SessionStoreTests(TestCase):
+    async def check_forget_orders(self, store):
+        cart = await Order.objects.acreate()
+        await store.save(SessionState(1, order_id=cart.pk))
+        await store.save(SessionState(2, order_id=cart.pk, last_message_id=10))
+
+        await store.forget_orders([cart.pk])
+
+        self.assertTrue((await store.get(1)).is_empty())
+        self.assertEqual(await store.get(2), SessionState(2, last_message_id=10))
+
+    async def test_memory_store_forgets_orders(self):
+        await self.check_forget_orders(MemorySessionStore())
+
+    async def test_only_the_database_store_keeps_carts_across_restarts(self):
+        cart = await Order.objects.acreate()
+        customer = await Customer.objects.acreate(user_id=5, first_name='Ion')
+        state = SessionState(1, order_id=cart.pk, customer_id=customer.pk)
+        for store in (MemorySessionStore(), DatabaseSessionStore()):
+            await store.save(state)
+            await store.save(SessionState(2, last_message_id=10))
+
+        self.assertEqual(await MemorySessionStore().warm_up(), [])
+        self.assertEqual(await DatabaseSessionStore().warm_up(), [state])
+
+    async def test_database_store_forgets_orders_and_removes_empty_rows(self):
+        await self.check_forget_orders(DatabaseSessionStore())
+        self.assertEqual([row.user_id async for row in BotSessionState.objects.all()], [2])
+
+
+class DatabaseSessionTests(TransactionTestCase):
+    # The session reads and writes on its own thread, so on its own connection
+
+    def user(self, user_id, username):
+        return types.User(id=user_id, access_hash=user_id * 7, username=username, first_name='Ana')
+
+    def session(self):
+        session = DatabaseSession('test')
+        self.addCleanup(session.close)
+        return session
+
+    def test_entities_saved_by_one_session_resolve_in_the_next(self):
+        first = DatabaseSession('test')
+        first.process_entities([self.user(1, 'ana')])
+        first.save()
+        first.close()
+
+        session = self.session()
+        self.assertEqual(session.get_input_entity(1), types.InputPeerUser(1, 7))
+        self.assertEqual(session.get_input_entity('ana'), types.InputPeerUser(1, 7))
+        self.assertEqual(session.get_entity_rows_by_id(1, exact=False), (1, 7))
+
+    def test_missing_entities_are_fetched_in_the_background_once(self):
+        session = self.session()
+        other = self.session()
+        other.process_entities([self.user(2, 'bob')])
+        other.save()
+        fetched = []
+        fetch_entity = session._fetch_entity
+        session._fetch_entity = lambda lookup: fetched.append(lookup) or fetch_entity(lookup)
+
+        # Not waited for, found by the next lookup
+        self.assertIsNone(session.get_entity_rows_by_username('bob'))
+        session.save()
+        self.assertEqual(session.get_entity_rows_by_username('bob'), (2, 14))
+
+        self.assertIsNone(session.get_entity_rows_by_username('nobody'))
+        session.save()
+        self.assertIsNone(session.get_entity_rows_by_username('nobody'))
+        session.save()
+        self.assertEqual(fetched, [{'username': 'bob'}, {'username': 'nobody'}])
+
+
+class RecomputeLoyaltyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        coffee = Category.objects.create(name='Coffee')
+        espresso = Product.objects.create(category=coffee, name='Espresso', price='24.00', is_coffee=True)
+        cls.customer = Customer.objects.create(user_id=2, first_name='Ion')
+        # Opening balance, then an order
+        LoyaltyEntry.record(cls.customer, LoyaltyEntry.ADJUSTED, coffees=2)
+        cart = add_to_cart(None, espresso.id, 2, None)
+        confirm_cart(cart.order_id, cls.customer.pk, coffee_limit=5)
+
+    def recompute(self, *args):
+        call_command('recompute_loyalty', *args, stdout=StringIO())
+        self.customer.refresh_from_db()
+        return self.customer.coffees_count, self.customer.coffees_free
+
+    def test_replays_orders_on_top_of_adjustments(self):
+        Customer.objects.filter(pk=self.customer.pk).update(coffees_count=0)
+
+        self.assertEqual(self.recompute(), (4, 0))
+        self.assertEqual(self.customer.loyalty_entries.get(kind=LoyaltyEntry.RECOMPUTED).coffees, 4)
+        self.assertEqual(self.recompute(), (4, 0))
+        self.assertEqual(self.customer.loyalty_entries.filter(kind=LoyaltyEntry.RECOMPUTED).count(), 1)
+
+    def test_applies_a_new_coffee_limit(self):
+        self.assertEqual(self.recompute('--coffee-limit', '3', '--dry-run'), (4, 0))
+        self.assertEqual(self.recompute('--coffee-limit', '3'), (1, 1))
+
+    def test_replays_orders_from_before_the_ledger_instead_of_the_opening_balance(self):
+        espresso = Product.objects.get(name='Espresso')
+        customer = Customer.objects.create(user_id=3, first_name='Ana', coffees_count=4)
+        order = Order.objects.create(customer=customer)
+        order.add_item(espresso.id, 4)
+        order.status = 'confirmed'
+        order.save()
+        # As written by migration 0016, then marked by 0024
+        opening = LoyaltyEntry.objects.create(customer=customer, kind=LoyaltyEntry.ADJUSTED, coffees=4)
+        LoyaltyEntry.objects.filter(pk=opening.pk).update(created_at=timezone.now() - timedelta(days=30))
+        import_module('bot.migrations.0024_loyaltyentry_opening').mark_opening_balances(apps, None)
+        self.assertEqual(customer.loyalty_entries.get().kind, LoyaltyEntry.OPENING)
+        self.assertEqual(self.customer.loyalty_entries.filter(kind=LoyaltyEntry.OPENING).count(), 1)
+
+        call_command('recompute_loyalty', '--coffee-limit', '3', '--keep-opening-balances', stdout=StringIO())
+        customer.refresh_from_db()
+        self.assertEqual((customer.coffees_count, customer.coffees_free), (4, 0))
+
+        call_command('recompute_loyalty', '--coffee-limit', '3', stdout=StringIO())
+        customer.refresh_from_db()
+        self.assertEqual((customer.coffees_count, customer.coffees_free), (1, 1))
+
+
+class CustomerAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.customer = Customer.objects.create(user_id=2, first_name='Ion', coffees_count=3)
+
+    def post_change(self, **data):
+        self.client.force_login(self.admin)
+        form = {
+            'user_id': self.customer.user_id, 'username': '', 'first_name': 'Ion', 'role': 'customer',
+            'adjust_coffees': 0, 'adjust_free_drinks': 0,
+        }
+        for prefix in ('order_set', 'loyalty_entries'):
+            form.update({f'{prefix}-TOTAL_FORMS': 0, f'{prefix}-INITIAL_FORMS': 0})
+        form.update(data)
+        response = self.client.post(reverse('admin:bot_customer_change', args=[self.customer.pk]), form)
+        self.assertEqual(response.status_code, 302)
+        self.customer.refresh_from_db()
+
+    def test_saving_keeps_coffees_earned_since_the_form_was_opened(self):
+        LoyaltyEntry.record(self.customer, LoyaltyEntry.EARNED, coffees=1)
+
+        # As posted by a form rendered before that order
+        self.post_change(first_name='Ion Popescu', coffees_count=3, coffees_free=0)
+
+        self.assertEqual((self.customer.first_name, self.customer.coffees_count), ('Ion Popescu', 4))
+        self.assertFalse(self.customer.loyalty_entries.filter(kind=LoyaltyEntry.ADJUSTED).exists())
+
+    def test_adjustments_are_added_through_the_ledger(self):
+        self.post_change(adjust_coffees=-1, adjust_free_drinks=2)
+
+        self.assertEqual((self.customer.coffees_count, self.customer.coffees_free), (2, 2))
+        entry = self.customer.loyalty_entries.get()
+        self.assertEqual((entry.kind, entry.coffees, entry.free_drinks), (LoyaltyEntry.ADJUSTED, -1, 2))
+
+
+class OutboxTests(SimpleTestCase):
+    async def test_messages_go_out_in_order_within_the_limits(self):
+        sent = []
+
+        async def send(chat_id, text):
+            sent.append((time.monotonic(), chat_id, text))
+
+        outbox = Outbox(send, rate=50, chat_interval=0.1)
+        outbox.start()
+        outbox.notify(1, 'a1')
+        outbox.notify(2, 'b1')
+        outbox.notify(3, 'c1')
+        await asyncio.sleep(0.01)
+        # Waiting for chat 1's interval, so sent together
+        outbox.notify(1, 'a2')
+        outbox.notify(1, 'a3')
+        await outbox.close(timeout=2)
+
+        self.assertEqual([(chat_id, text) for _, chat_id, text in sent], [
+            (1, 'a1'), (2, 'b1'), (3, 'c1'), (1, 'a2\n\na3'),
+        ])
+        times = [at for at, _, _ in sent]
+        for earlier, later in zip(times, times[1:]):
+            self.assertGreaterEqual(later - earlier, 1 / 50 - 0.005)
+        self.assertGreaterEqual(times[3] - times[0], 0.1 - 0.005)
+        self.assertEqual((outbox.sent, outbox.pending), (4, 0))
+
+
+class FloodWait(Exception):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Crash(BaseException):
+    pass
+
+
+class FakeClient:
+    def __init__(self, flood_once=(), blocked=(), crash_after=None):
+        self.flood_once = set(flood_once)
+        self.blocked = set(blocked)
+        self.crash_after = crash_after
+        self.messages = []
+
+    async def send(self, chat_id, text):
+        if chat_id in self.flood_once:
+            self.flood_once.discard(chat_id)
+            raise FloodWait(0.01)
+        if chat_id in self.blocked:
+            raise ValueError('Forbidden: bot was blocked by the user')
+        if self.crash_after is not None and len(self.messages) >= self.crash_after:
+            raise Crash()
+        self.messages.append((chat_id, text))
+
+    def sender(self):
+        return BroadcastSender(
+            self.send,
+            flood_wait=lambda error: error.seconds if isinstance(error, FloodWait) else None,
+            rate=1000,
+            chunk_size=3,
+        )
+
+
+class BroadcastTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customers = [Customer.objects.create(user_id=100 + i, first_name=f'Client {i}') for i in range(8)]
+        Customer.objects.create(user_id=99, first_name='Barista', role=Customer.BARISTA)
+
+    def user_ids(self, messages):
+        return sorted(chat_id for chat_id, _ in messages)
+
+    async def test_sends_to_every_customer_and_records_stats(self):
+        broadcast = await Broadcast.objects.acreate(text='Puncte duble azi!', status=Broadcast.QUEUED)
+        client = FakeClient(flood_once=[101, 104], blocked=[103])
+
+        broadcast = await client.sender().run(broadcast)
+
+        self.assertEqual(self.user_ids(client.messages), [100, 101, 102, 104, 105, 106, 107])
+        self.assertEqual((broadcast.sent, broadcast.failed), (7, 1))
+        self.assertEqual(broadcast.status, Broadcast.DONE)
+        self.assertEqual(broadcast.last_customer_id, self.customers[-1].pk)
+        self.assertIsNotNone(broadcast.finished_at)
+
+    async def test_resumes_after_the_last_checkpoint(self):
+        broadcast = await Broadcast.objects.acreate(text='Puncte duble azi!', status=Broadcast.QUEUED)
+        client = FakeClient(crash_after=4)
+        with self.assertRaises(Crash):
+            await client.sender().run(broadcast)
+
+        await broadcast.arefresh_from_db()
+        self.assertEqual(broadcast.status, Broadcast.SENDING)
+        self.assertEqual(broadcast.last_customer_id, self.customers[2].pk)
+        self.assertEqual(broadcast.sent, 3)
+
+        resumed = FakeClient()
+        broadcast = await resumed.sender().run(broadcast)
+
+        self.assertEqual(self.user_ids(resumed.messages), [103, 104, 105, 106, 107])
+        self.assertEqual((broadcast.sent, broadcast.failed), (8, 0))
+        self.assertEqual(broadcast.status, Broadcast.DONE)
+
+
+class OrderedDispatcherTests(SimpleTestCase):
+    def telegram_client(self):
+        client = TelegramClient(MemorySession(), 1, 'unused')
+        client._mb_entity_cache.self_id = 42  # spares the get_me() call
+        return client
+
+    async def dispatch(self, client, update):
+        update._entities = {}
+        await client._dispatch_update(update)
+
+    async def test_queued_handlers_keep_their_own_match(self):
+        client = self.telegram_client()
+        dispatcher = OrderedDispatcher(limit=2)
+        seen = []
+
+        async def category_selected(event):
+            seen.append(('category', event.data_match and event.data_match.group(1)))
+
+        async def product_selected(event):
+            seen.append(('product', event.data_match))
+
+        async def start(event):
+            seen.append(('start', event.pattern_match and event.pattern_match.group(1), event.raw_text))
+
+        client.add_event_handler(
+            dispatcher.handler(category_selected), events.CallbackQuery(data=re.compile(b'category_(\\d+)')),
+        )
+        client.add_event_handler(
+            dispatcher.handler(product_selected), events.CallbackQuery(data=re.compile(b'product_(\\d+)')),
+        )
+        client.add_event_handler(dispatcher.handler(start), events.NewMessage(pattern='/start (\\w+)'))
+        client.add_event_handler(dispatcher.handler(start), events.NewMessage(pattern='/menu'))
+
+        await self.dispatch(client, types.UpdateBotCallbackQuery(
+            query_id=1, user_id=1000, peer=types.PeerUser(1000), msg_id=1, chat_instance=1, data=b'category_3',
+        ))
+        await self.dispatch(client, types.UpdateNewMessage(types.Message(
+            id=2, peer_id=types.PeerUser(1000), date=timezone.now(), message='/start qr', out=False,
+        ), pts=1, pts_count=1))
+        await dispatcher.join()
+
+        self.assertEqual(seen, [('category', b'3'), ('start', 'qr', '/start qr')])
+
+    async def test_updates_of_a_user_run_in_order(self):
+        dispatcher = OrderedDispatcher(limit=4)
+        log = []
+
+        async def handle(user_id, number):
+            log.append((user_id, number, 'start'))
+            await asyncio.sleep(0.01 if (user_id, number) == (1, 0) else 0)
+            log.append((user_id, number, 'end'))
+
+        for number in range(3):
+            for user_id in (1, 2):
+                dispatcher.submit(user_id, handle, user_id, number)
+        await dispatcher.join()
+
+        for user_id in (1, 2):
+            own = [(number, step) for user, number, step in log if user == user_id]
+            self.assertEqual(own, [(number, step) for number in range(3) for step in ('start', 'end')])
+        # Another user is not held up behind user 1's slow first update
+        self.assertLess(log.index((2, 0, 'end')), log.index((1, 0, 'end')))
+
+
+class FakeEvent:
+    def __init__(self, sender_id):
+        self.sender_id = sender_id
+
+
+class MessageEvent(FakeEvent):
+    def __init__(self, sender_id):
+        super().__init__(sender_id)
+        self.replies = []
+
+    async def respond(self, message, **kwargs):
+        self.replies.append(message)
+
+
+def command_handlers():
+    """
+    The handlers of the Telethon bot by name, called directly instead of
+    through the dispatcher.
+    """
+    client = mock.Mock()
+    with mock.patch.object(OrderedDispatcher, 'handler', lambda self, handler, **kwargs: handler):
+        TelegramBotCommand().add_handlers(client, MemorySessionStore())
+    return {handler.__name__: handler for (handler, _), _ in client.add_event_handler.call_args_list}
+
+
+class DispatcherPriorityTests(SimpleTestCase):
+    async def test_low_priority_is_shed_past_the_threshold(self):
+        dispatcher = OrderedDispatcher(limit=1, max_pending=4, shed_threshold=2)
+        gate = asyncio.Event()
+
+        async def handle():
+            await gate.wait()
+
+        self.assertTrue(dispatcher.submit(1, handle, priority=LOW))
+        self.assertTrue(dispatcher.submit(2, handle, priority=LOW))
+        self.assertFalse(dispatcher.accepts(LOW))
+        self.assertFalse(dispatcher.submit(3, handle, priority=LOW))
+        self.assertTrue(dispatcher.submit(4, handle, priority=NORMAL))
+        self.assertTrue(dispatcher.submit(5, handle, priority=HIGH))
+        self.assertFalse(dispatcher.submit(6, handle, priority=HIGH))
+        self.assertEqual(dispatcher.stats()['priorities']['low']['shed'], 1)
+        self.assertEqual(dispatcher.stats()['priorities']['high']['shed'], 1)
+
+        gate.set()
+        await dispatcher.join()
+        self.assertEqual(dispatcher.pending, 0)
+        self.assertTrue(dispatcher.accepts(LOW))
+
+    async def test_freed_slot_goes_to_the_best_priority(self):
+        dispatcher = OrderedDispatcher(limit=1)
+        gate = asyncio.Event()
+        order = []
+
+        async def handle(name):
+            if name == 'first':
+                await gate.wait()
+            order.append(name)
+
+        dispatcher.submit(1, handle, 'first', priority=NORMAL)
+        await asyncio.sleep(0)
+        dispatcher.submit(2, handle, 'customer', priority=LOW)
+        dispatcher.submit(3, handle, 'tap', priority=NORMAL)
+        dispatcher.submit(4, handle, 'barista', priority=HIGH)
+        await asyncio.sleep(0)
+        gate.set()
+        await dispatcher.join()
+
+        self.assertEqual(order, ['first', 'barista', 'tap', 'customer'])
+
+    async def test_shed_event_gets_one_busy_reply(self):
+        dispatcher = OrderedDispatcher(limit=1, max_pending=1, shed_threshold=1)
+        gate = asyncio.Event()
+        busy = []
+
+        async def handle(event):
+            await gate.wait()
+
+        async def reply_busy(event):
+            busy.append(event.sender_id)
+
+        first = dispatcher.handler(handle, on_shed=reply_busy)
+        second = dispatcher.handler(handle, on_shed=reply_busy)
+        await first(FakeEvent(1))
+        event = FakeEvent(2)
+        await first(event)
+        await second(event)
+        await asyncio.sleep(0)
+        gate.set()
+        await dispatcher.join()
+
+        self.assertEqual(busy, [2])
+
+
+class WorkerProtocolTests(SimpleTestCase):
+    async def connect(self):
+        receiver_end, worker_end = socket.socketpair()
+        self.pool = WorkerPool('unused', self.perform, 1)
+        channel = Channel(receiver_end)
+        await channel.open()
+        self.pool._attach(0, channel)
+        self.link = WorkerLink(worker_end)
+        await self.link.open()
+
+    async def perform(self, request):
+        if request == 'fail':
+            raise ValueError(request)
+        return request.upper()
+
+    async def test_updates_arrive_in_order(self):
+        await self.connect()
+        for number in range(3):
+            await self.pool.submit(7, f'update {number}')
+        await self.pool.stop()
+
+        received = [payload async for payload in self.link.updates()]
+        self.assertEqual(received, ['update 0', 'update 1', 'update 2'])
+
+    async def test_call_returns_the_answer_or_raises_the_error(self):
+        await self.connect()
+        self.assertEqual(await self.link.call('ping'), 'PING')
+        with self.assertRaisesMessage(ValueError, 'fail'):
+            await self.link.call('fail')
+        await self.pool.stop()
+
+
+class RelayedClientTests(SimpleTestCase):
+    async def test_requests_and_updates_go_through_the_receiver(self):
+        requests = []
+
+        async def perform(request):
+            request = read_tl(request)
+            requests.append(type(request).__name__)
+            if isinstance(request, GetUsersRequest):
+                return pack_result([types.User(id=42, bot=True, bot_info_version=1, access_hash=7, username='zxcbot', first_name='ZXC')])
+            if request.message == 'boom':
+                raise MessageNotModifiedError(request=None)
+            return pack_result(types.UpdateShortSentMessage(id=9, pts=1, pts_count=1, date=timezone.now()))
+
+        receiver_end, worker_end = socket.socketpair()
+        pool = WorkerPool('unused', perform, 1)
+        channel = Channel(receiver_end)
+        await channel.open()
+        pool._attach(0, channel)
+        link = WorkerLink(worker_end)
+        await link.open()
+        client = RelayedClient(link, MemorySession(), 1, 'hash')
+
+        replies = []
+
+        @client.on(events.NewMessage(pattern='/start'))
+        async def start(event):
+            replies.append((await event.respond('Salut')).id)
+            with self.assertRaises(MessageNotModifiedError):
+                await event.respond('boom')
+
+        me = await client.get_me()
+        user = types.User(id=1000, access_hash=55, first_name='Ana')
+        update = types.UpdateNewMessage(
+            types.Message(id=1, peer_id=types.PeerUser(1000), date=timezone.now(), message='/start'),
+            pts=1, pts_count=1,
+        )
+        await pool.submit(update_user_id(update), (bytes(update), [bytes(user)]))
+        async for payload in link.updates():
+            await client.dispatch(payload)
+            break
+        await pool.stop()
+
+        self.assertEqual(me.username, 'zxcbot')
+        self.assertEqual(replies, [9])
+        self.assertEqual(requests, ['GetUsersRequest', 'SendMessageRequest', 'SendMessageRequest'])
+
+
+class EchoWorker:
+    """
+    Worker command of WorkerSupervisionTests: hands every update back as a call.
+    """
+
+    def work(self, sock, workers):
+        async def main():
+            link = WorkerLink(sock)
+            await link.open()
+            async for payload in link.updates():
+                await link.call((os.getpid(), payload))
+
+        asyncio.run(main())
+
+
+class WorkerSupervisionTests(SimpleTestCase):
+    async def test_a_killed_worker_is_started_again(self):
+        calls = asyncio.Queue()
+
+        async def perform(request):
+            await calls.put(request)
+
+        pool = WorkerPool(f'{__name__}.EchoWorker', perform, 1)
+        await pool.start()
+        try:
+            await pool.submit(1, 'first')
+            pid, _ = await asyncio.wait_for(calls.get(), 30)
+            os.kill(pid, signal.SIGKILL)
+            while pool._processes[0].pid == pid:
+                await asyncio.sleep(0.05)
+
+            await pool.submit(1, 'second')
+            new_pid, payload = await asyncio.wait_for(calls.get(), 30)
+        finally:
+            await pool.stop()
+
+        self.assertEqual(payload, 'second')
+        self.assertNotEqual(new_pid, pid)
+        self.assertFalse(pool._processes[0].is_alive())
+
+    async def test_stopping_lets_the_workers_finish_their_updates(self):
+        calls = []
+
+        async def perform(request):
+            calls.append(request[1])
+
+        pool = WorkerPool(f'{__name__}.EchoWorker', perform, 2)
+        await pool.start()
+        for number in range(6):
+            await pool.submit(number, f'update {number}')
+        await pool.stop()
+
+        self.assertEqual(sorted(calls), [f'update {number}' for number in range(6)])
+        self.assertFalse(any(process.is_alive() for process in pool._processes))
@@ -1,21 +1,69 @@
 from io import BytesIO
+from zoneinfo import ZoneInfo
 
 import qrcode
+from django.conf import settings
+from django.utils import timezone
 from qrcode.image.pil import PilImage
 
 
-def generate_qr_code(bot_username, user_id):
-    link = f"https://t.me/{bot_username}?start=user_id_{user_id}"
+def qr_code_link(bot_username, user_id):
+    return f"https://t.me/{bot_username}?start=user_id_{user_id}"
+
+
+def render_qr_png(data):
+    """
+    PNG bytes of a QR code encoding `data`. CPU bound, keep it off the event loop.
+    """
     qr = qrcode.QRCode(
         version=1,
         box_size=10,
         border=4,
     )
-    qr.add_data(link)
+    qr.add_data(data)
     qr.make(fit=True)
     img = qr.make_image(fill='black', back_color='white', image_factory=PilImage)
     buffer = BytesIO()
     img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def qr_file(png):
+    buffer = BytesIO(png)
     buffer.name = 'qr_code.png'
-    buffer.seek(0)
     return buffer
+
+
+def generate_qr_code(bot_username, user_id):
+    return qr_file(render_qr_png(qr_code_link(bot_username, user_id)))
+
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_message(lines, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Joins `lines` into as few messages as possible, each under Telegram's limit.
+    """
+    messages = []
+    current = ''
+    for line in lines:
+        line = line[:limit - 1]
+        if current and len(current) + len(line) + 1 > limit:
+            messages.append(current)
+            current = ''
+        current += line + '\n'
+    if current:
+        messages.append(current)
+    return messages
+
+
+def business_timezone():
+    return ZoneInfo(settings.BUSINESS_TIME_ZONE)
+
+
+def to_business_date(value=None):
+    """
+    Calendar date of `value` (default: now) in the cafe's time zone.
+    """
+    return timezone.localtime(value or timezone.now(), business_timezone()).date()
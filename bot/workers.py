@@ -0,0 +1,293 @@
+"""
+Receiver/worker split of the bots, to use more than one CPU core.
+
+A single receiver process keeps the connection to Telegram and hands every
+update to one of BOT_WORKERS worker processes. The worker is picked by the
+update's user id, so all updates of a user go to the same worker, in the
+order they arrived, and that worker's in-memory state (carts, conversations)
+stays consistent. Workers run the handlers: ORM, QR codes, reports. Each
+request they make to Telegram is passed back to the receiver, which sends it
+over its own connection and returns the answer or the error.
+
+Receiver and workers talk over socket pairs, in frames of a 4 byte length
+followed by a pickled message:
+
+- ('update', payload) from the receiver to a worker,
+- ('call', call_id, request) from a worker to the receiver,
+- ('result', call_id, ok, value) back from the receiver, `value` being the
+  answer if `ok`, else the exception to raise in the worker,
+- ('stop',) from the receiver when it shuts down: the worker finishes the
+  updates it was given, its calls still answered meanwhile, and exits.
+
+What a payload and a request are is up to the bot using it (see
+run_telegram_bot and runbot).
+
+The receiver watches its workers: one that exits on its own (a crash, the OOM
+killer) is started again in its place, and the updates of its users wait for
+it. Workers ignore SIGINT and SIGTERM, so stopping the receiver with Ctrl-C or
+a service manager lets them finish their updates first.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import pickle
+import signal
+import socket
+import struct
+import time
+
+import django
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('!I')
+# A worker that exits sooner than this after it started is started again with
+# an increasing delay, up to RESTART_DELAY_MAX seconds
+MIN_UPTIME = 60
+RESTART_DELAY_MAX = 60
+
+
+class RemoteError(Exception):
+    """
+    An error of the receiver that could not be sent to the worker as it was.
+    """
+
+
+class Channel:
+    def __init__(self, sock):
+        self.sock = sock
+        self._reader = None
+        self._writer = None
+
+    async def open(self):
+        self._reader, self._writer = await asyncio.open_connection(sock=self.sock)
+
+    async def send(self, message):
+        data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        self._writer.write(FRAME_HEADER.pack(len(data)) + data)
+        await self._writer.drain()
+
+    async def receive(self):
+        """
+        The next message, or None once the other end is closed.
+        """
+        try:
+            header = await self._reader.readexactly(FRAME_HEADER.size)
+            data = await self._reader.readexactly(FRAME_HEADER.unpack(header)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        return pickle.loads(data)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            self.sock.close()
+
+
+def start_worker(sock, command, workers):
+    # Stopped by the receiver, once their updates are done
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_IGN)
+    django.setup()
+    import_string(command)().work(sock, workers)
+
+
+class WorkerPool:
+    def __init__(self, command, perform, count):
+        """
+        Each worker process runs `command().work(sock, count)` with its end of
+        the socket pair, `command` being the dotted path of the management
+        command. `perform(request)` carries out, in the receiver, a request of
+        a worker.
+        """
+        self.command = command
+        self.perform = perform
+        self.count = count
+        self._processes = [None] * count
+        self._channels = [None] * count
+        self._ready = [asyncio.Event() for _ in range(count)]
+        self._restarts = [0] * count
+        self._tasks = set()
+        self._stopping = False
+
+    async def start(self):
+        for number in range(self.count):
+            await self._start_worker(number)
+        logger.info("Started %d bot workers", self.count)
+
+    async def _start_worker(self, number):
+        # Workers start from a fresh interpreter, not a fork of the receiver
+        # with its open connections
+        context = multiprocessing.get_context('spawn')
+        receiver_end, worker_end = socket.socketpair()
+        process = context.Process(
+            target=start_worker, args=(worker_end, self.command, self.count),
+            name=f'bot-worker-{number}', daemon=True,
+        )
+        process.start()
+        worker_end.close()
+        channel = Channel(receiver_end)
+        await channel.open()
+        self._attach(number, channel, process)
+
+    def _attach(self, number, channel, process=None):
+        self._processes[number] = process
+        self._channels[number] = channel
+        self._spawn(self._serve(number, channel, process))
+        self._ready[number].set()
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def submit(self, user_id, payload):
+        """
+        Hands `payload` to the worker of `user_id`, waiting for it to be
+        started again if it exited.
+        """
+        number = user_id % self.count
+        while not self._stopping:
+            await self._ready[number].wait()
+            try:
+                await self._channels[number].send(('update', payload))
+                return
+            except ConnectionError:
+                self._ready[number].clear()
+        logger.warning("Update of %s not handled: the bot is stopping", user_id)
+
+    async def broadcast(self, payload):
+        """
+        Hands `payload` to every worker.
+        """
+        for number in range(self.count):
+            await self.submit(number, payload)
+
+    async def _serve(self, number, channel, process):
+        started_at = time.monotonic()
+        while (message := await channel.receive()) is not None:
+            _, call_id, request = message
+            # Calls of different users must not wait on each other; a worker
+            # waits for each answer, so one user's calls stay in order
+            self._spawn(self._perform(channel, call_id, request))
+        if self._stopping or process is None:
+            return
+
+        self._ready[number].clear()
+        channel.close()
+        await asyncio.to_thread(process.join)
+        if time.monotonic() - started_at < MIN_UPTIME:
+            self._restarts[number] += 1
+        else:
+            self._restarts[number] = 0
+        delay = min(2 ** self._restarts[number] - 1, RESTART_DELAY_MAX)
+        logger.error("Bot worker %d exited with code %s, starting it again in %ss",
+                     number, process.exitcode, delay)
+        await asyncio.sleep(delay)
+        if not self._stopping:
+            await self._start_worker(number)
+
+    async def _perform(self, channel, call_id, request):
+        try:
+            result = ('result', call_id, True, await self.perform(request))
+        except Exception as error:
+            try:
+                pickle.dumps(error)
+            except Exception:
+                error = RemoteError(repr(error))
+            result = ('result', call_id, False, error)
+        try:
+            await channel.send(result)
+        except ConnectionError:
+            pass  # the worker exited meanwhile
+
+    async def stop(self, timeout=10):
+        """
+        Lets the workers finish the updates they were given, answering their
+        calls meanwhile, then closes the connections. A worker still running
+        after `timeout` seconds is killed.
+        """
+        if self._stopping:
+            return
+        self._stopping = True
+        for ready in self._ready:
+            ready.set()  # submit() gives up instead of waiting for a worker
+        for channel in self._channels:
+            if channel is not None:
+                try:
+                    await channel.send(('stop',))
+                except ConnectionError:
+                    pass
+        for process in self._processes:
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.warning("Bot worker %s did not stop in %ss", process.name, timeout)
+                process.kill()
+        for channel in self._channels:
+            if channel is not None:
+                channel.close()
+
+
+class WorkerLink:
+    """
+    The worker's end: receives the updates and relays requests to the receiver.
+    """
+
+    def __init__(self, sock):
+        self.channel = Channel(sock)
+        self._calls = {}
+        self._call_ids = itertools.count()
+        self._updates = asyncio.Queue()
+        self._reader = None
+
+    async def open(self):
+        """
+        Starts taking messages from the receiver. Updates are queued until
+        read from updates(), answers to calls are delivered at once.
+        """
+        await self.channel.open()
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def call(self, request):
+        future = asyncio.get_running_loop().create_future()
+        call_id = next(self._call_ids)
+        self._calls[call_id] = future
+        try:
+            await self.channel.send(('call', call_id, request))
+            return await future
+        finally:
+            self._calls.pop(call_id, None)
+
+    async def updates(self):
+        """
+        The updates for this worker, in order, until the receiver stops or
+        goes away.
+        """
+        while (payload := await self._updates.get()) is not None:
+            yield payload
+
+    async def _read(self):
+        while (message := await self.channel.receive()) is not None:
+            if message[0] == 'update':
+                self._updates.put_nowait(message[1])
+                continue
+            if message[0] == 'stop':
+                self._updates.put_nowait(None)
+                continue
+            _, call_id, ok, value = message
+            future = self._calls.get(call_id)
+            if future is None or future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        for future in self._calls.values():
+            if not future.done():
+                future.set_exception(ConnectionError("The receiver closed the connection"))
+        self._updates.put_nowait(None)
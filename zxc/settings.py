@@ -48,6 +48,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'django.contrib.humanize',
     'bot.apps.BotConfig',
+    'bonus.apps.BonusConfig',
 ]
 
 MIDDLEWARE = [
@@ -124,6 +125,9 @@ USE_I18N = True
 
 USE_TZ = True
 
+# Orders are grouped by calendar day in the cafe's own time zone
+BUSINESS_TIME_ZONE = 'Europe/Chisinau'
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
@@ -137,10 +141,71 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 TELEGRAM_API_ID = int(os.getenv('TELEGRAM_API_ID', '0'))
 TELEGRAM_API_HASH = os.getenv('TELEGRAM_API_HASH', '')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
+# Where the Telethon bot keeps its login and known users: 'database' (see bot.telethon_session) or 'file'
+TELEGRAM_SESSION_BACKEND = os.getenv('TELEGRAM_SESSION_BACKEND', 'database')
+TELEGRAM_SESSION_NAME = os.getenv('TELEGRAM_SESSION_NAME', 'coffee_bot')
 
 ADMIN_USER_IDS = [int(id.strip()) for id in os.getenv('ADMIN_USER_IDS', '').split(',') if id.strip()]
 BARISTA_USERNAMES = [name.strip() for name in os.getenv('BARISTA_USERNAMES', '').split(',') if name.strip()]
 
+# Webhook of the bonus bot (runbot --webhook, or mounted into zxc.asgi), see bonus.webhook
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '')  # public URL Telegram posts to
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', '/telegram/')
+TELEGRAM_WEBHOOK_PORT = int(os.getenv('TELEGRAM_WEBHOOK_PORT', '8001'))
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv('TELEGRAM_WEBHOOK_MAX_CONNECTIONS', '40'))
+# Larger webhook requests are refused with 413 before being parsed
+TELEGRAM_WEBHOOK_MAX_BODY_SIZE = int(os.getenv('TELEGRAM_WEBHOOK_MAX_BODY_SIZE', str(1024 * 1024)))
+TELEGRAM_WEBHOOK_MOUNT = os.getenv('TELEGRAM_WEBHOOK_MOUNT', 'False').lower() == 'true'
+
+# QR codes kept in memory, and an optional directory to keep them across restarts (see bot.qr)
+QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', '1000'))
+QR_CACHE_DIR = os.getenv('QR_CACHE_DIR', '')
+
+# Coffees a customer buys to earn a free one
+LOYALTY_COFFEE_LIMIT = int(os.getenv('LOYALTY_COFFEE_LIMIT', '5'))
+
+# Seconds before the bots reload the in-memory catalog snapshot (see bot.catalog)
+CATALOG_MAX_AGE = int(os.getenv('CATALOG_MAX_AGE', '300'))
+
+# Where the Telegram bot keeps carts between taps (see bot.sessions)
+BOT_SESSION_STORE = os.getenv('BOT_SESSION_STORE', 'bot.sessions.MemorySessionStore')
+BOT_SESSION_TTL = int(os.getenv('BOT_SESSION_TTL', str(60 * 60 * 12)))
+BOT_SESSION_MAX_ENTRIES = int(os.getenv('BOT_SESSION_MAX_ENTRIES', '1000'))
+
+# Updates the bots handle at the same time; a user's own updates always run in order (see bot.dispatch)
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', '16'))
+# Worker processes running the handlers behind one receiver, 0 to run everything in one process (see bot.workers)
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '0'))
+# Waiting updates past which customer commands get a "busy" reply, and the hard bound for all updates
+BOT_SHED_THRESHOLD = int(os.getenv('BOT_SHED_THRESHOLD', '100'))
+BOT_MAX_PENDING_UPDATES = int(os.getenv('BOT_MAX_PENDING_UPDATES', '500'))
+
+# Pace of the messages the bots send to customers on their own (see bot.outbox)
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '25'))
+OUTBOX_CHAT_INTERVAL = float(os.getenv('OUTBOX_CHAT_INTERVAL', '1'))
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '5'))
+OUTBOX_RETRY_DELAY = float(os.getenv('OUTBOX_RETRY_DELAY', '1'))
+OUTBOX_CLOSE_TIMEOUT = float(os.getenv('OUTBOX_CLOSE_TIMEOUT', '10'))
+
+# Pace and checkpoint interval of the messages to all customers (see bot.broadcast)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '100'))
+
+# Products per page of the bots' category keyboards (see bot.keyboards)
+KEYBOARD_PAGE_SIZE = int(os.getenv('KEYBOARD_PAGE_SIZE', '8'))
+
+# Customers kept in the bot's identity cache, and for how many seconds (see bot.customers)
+CUSTOMER_CACHE_TTL = int(os.getenv('CUSTOMER_CACHE_TTL', '300'))
+CUSTOMER_CACHE_MAX_ENTRIES = int(os.getenv('CUSTOMER_CACHE_MAX_ENTRIES', '5000'))
+
+# Pending carts left unchanged for this many seconds are removed (see bot.reaper)
+PENDING_ORDER_MAX_AGE = int(os.getenv('PENDING_ORDER_MAX_AGE', str(60 * 60 * 3)))
+PENDING_ORDER_REAP_INTERVAL = int(os.getenv('PENDING_ORDER_REAP_INTERVAL', '600'))
+PENDING_ORDER_REAP_BATCH_SIZE = 500
+# 'delete' or 'cancel'
+PENDING_ORDER_REAP_ACTION = os.getenv('PENDING_ORDER_REAP_ACTION', 'delete')
+
 # uvicorn zxc.asgi:application --host 0.0.0.0 --port 8011
 
 